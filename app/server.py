@@ -12,11 +12,10 @@ import re
 import os
 from flask import Flask, render_template, redirect, url_for
 from flask_session import Session
-from pymongo import MongoClient
 from waitress import serve
 import msftconfig # NOQA
 
-from util.database import Database, do_upgrades
+from util.database import Database, do_upgrades, get_client
 from views.admin.admin_routes import admin_routes
 from views.discovery.discovery_routes import discovery_routes
 from views.crm.crm_routes import crm_routes
@@ -44,7 +43,7 @@ app = Flask(__name__)
 app.config.from_mapping(
     CLIENT_SECRET=os.environ['AZURE_CLIENT_SECRET'],
     SESSION_TYPE='mongodb',
-    SESSION_MONGODB=MongoClient(os.environ['DB_URL']),
+    SESSION_MONGODB=get_client(),
     SECRET_KEY=os.environ.get('FLASK_FORM_SECRET_KEY', 'aas;ldfkjiruetnviupi842nvutj4iv'),
     EXPLAIN_TEMPLATE_LOADING=False
 )
@@ -0,0 +1,142 @@
+"""
+bulk_letters.py - Merge one template for many recipients into a ZIP file.
+
+The worker process (see worker.py) selects the recipients and passes each one
+here as an attachment name and a flattened dict of merge fields. The letters
+are rendered by a pool of processes, each keeping its own parsed copy of the
+template (see merge_engine), and written to the ZIP in recipient order as they
+finish. At most a few letters per process are in flight at a time, so memory
+stays flat however many recipients there are.
+
+Time the pipeline with 1, 2, 4 ... processes with:
+
+    python -m util.bulk_letters --benchmark [letters]
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import sys
+import time
+from zipfile import ZipFile, ZIP_STORED
+
+from util.logger import get_logger
+from util.merge_engine import get_template, merge_document
+
+# Rendering processes; letters queued per process ahead of the ZIP writer.
+LETTER_WORKERS = int(os.environ.get('LETTER_WORKERS', '0')) or os.cpu_count() or 1
+LETTERS_AHEAD = 4
+
+# Report progress after this many letters.
+PROGRESS_EVERY = 25
+
+LOGGER = get_logger('bulk_letters')
+
+
+def render_letter(template_path: str, fields: dict) -> bytes:
+    """
+    Merge one letter. Runs in a pool process.
+    """
+    return merge_document(template_path, fields).getvalue()
+
+
+def write_letters_zip(template_path: str, recipients, total: int, output, progress=None, workers: int = None) -> int:
+    """
+    Merge *template_path* for each recipient and write the letters to a ZIP file.
+
+    Args:
+        template_path (str): Local path of the .docx template
+        recipients (iterable): (attachment name, merge fields) for each letter
+        total (int): Number of recipients, for progress reports
+        output (str or file): Where to write the ZIP file
+        progress (callable): Called with (letters written, total) as the job proceeds (optional)
+        workers (int): Rendering processes (default=LETTER_WORKERS)
+    Returns:
+        (int): Number of letters written
+    """
+    workers = workers or LETTER_WORKERS
+    get_template(template_path)  # Fail here, not in every pool process, if the template is bad.
+    names = set()
+    written = 0
+
+    # Letters are .docx files, which are already compressed. Pool processes come from a
+    # forkserver, since forking the worker after its threads have started can deadlock.
+    with ZipFile(output, 'w', ZIP_STORED) as letters, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver'),
+                                initializer=get_template, initargs=(template_path,)) as pool:
+        pending = deque()
+
+        def write_next():
+            nonlocal written
+            name, future = pending.popleft()
+            letters.writestr(name, future.result())
+            written += 1
+            if progress and written % PROGRESS_EVERY == 0:
+                progress(written, total)
+
+        for name, fields in recipients:
+            pending.append((_unique_name(name, names), pool.submit(render_letter, template_path, fields)))
+            if len(pending) >= workers * LETTERS_AHEAD:
+                write_next()
+        while pending:
+            write_next()
+
+    if progress:
+        progress(written, total)
+    return written
+
+
+def _unique_name(name: str, names: set) -> str:
+    """
+    *name*, numbered if it has already been used, e.g. two clients named Smith.
+    """
+    base, extension = os.path.splitext(name)
+    unique = name
+    count = 1
+    while unique in names:
+        count += 1
+        unique = f'{base} ({count}){extension}'
+    names.add(unique)
+    return unique
+
+
+def _benchmark(letters: int):
+    """
+    Write *letters* letters from a sample template with 1, 2, 4 ... processes, up to the number of cores.
+    """
+    import tempfile
+
+    from util.merge_engine import _sample_template
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'letterhead.docx')
+        _sample_template(path)
+        fields = sorted(get_template(path).fields)
+        recipients = [
+            (f'Last{n % 50} - Letter to Client {n}.docx', {field: f'{field} {n}' for field in fields})
+            for n in range(letters)
+        ]
+
+        workers = 1
+        while True:
+            output = os.path.join(tmp_dir, f'letters-{workers}.zip')
+            started = time.perf_counter()
+            write_letters_zip(path, recipients, letters, output, workers=workers)
+            seconds = time.perf_counter() - started
+            print(f"{workers:2} processes: {letters / seconds:8.1f} letters/sec, "
+                  f"{os.path.getsize(output) / 1024 / 1024:.1f} MB ZIP in {seconds:.2f}s")
+            if workers >= (os.cpu_count() or 1):
+                break
+            workers = min(workers * 2, os.cpu_count())
+
+
+if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        args = [a for a in sys.argv[1:] if not a.startswith('--')]
+        _benchmark(int(args[0]) if args else 500)
+    else:
+        print(__doc__)
@@ -0,0 +1,74 @@
+"""
+client_enrichment.py - Add the read-only display fields to a list of clients.
+
+Client lists show an email subject, a cc list and whether each client has
+notes or discovery requests. These are computed for the whole list at once:
+the subject and cc list from the documents we already have and the flags
+from one grouped query per collection, rather than several queries per row.
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from util.db_client_discovery import DbClientDiscovery
+from util.db_client_notes import DbClientNotes
+from util.db_clients import make_email_subject
+
+DBDISCOVERY = DbClientDiscovery()
+DBNOTES = DbClientNotes()
+
+
+def enrich_clients(clients: list, user_email: str, user_cc_list: str = None) -> list:
+    """
+    Add '_email_subject', '_email_cc_list', '_notes_flag' and '_discovery_flag'
+    to each client document. The underscore indicates that the data in that
+    column are read-only.
+
+    Args:
+        clients (list): Documents from the clients collection. Updated in place.
+        user_email (str): This user's email address
+        user_cc_list (str): Delimited list of email-ccs for this user
+    Returns:
+        (list): The same list of clients.
+    """
+    clients_ids = [client['_id'] for client in clients]
+    with_notes = DBNOTES.clients_having_any(clients_ids)
+    with_discovery = DBDISCOVERY.clients_having_any(clients_ids)
+
+    for client in clients:
+        client['_email_subject'] = make_email_subject(client)
+        client['_email_cc_list'] = client_email_cc_list(client.get('email_cc_list'), user_cc_list, user_email)
+        client['_notes_flag'] = client['_id'] in with_notes
+        client['_discovery_flag'] = client['_id'] in with_discovery
+    return clients
+
+
+def client_email_cc_list(client_cc_list: str, user_cc_list: str, user_email: str) -> str:
+    """
+    Create a fixed-up and filtered email cc list for emails to the client.
+    The client can have a cc-list
+    that is specific to that client. If so, use that. If not, use the default
+    cc-list for this user. Remove this user from the cc-list.
+
+    Args:
+        client_cc_list (str): Delimited list of email-ccs for this client
+        user_cc_list (str): Delimited list of email-ccs for this user
+        user_email (str): This user's email address
+
+    Returns:
+        (str): Delimited list of emails to cc on an email for this case.
+    """
+    my_email = user_email.replace(' ', '').lower()
+    if client_cc_list:
+        ccs = client_cc_list.replace(' ', '').replace(',', ';').lower()
+        ccs = ccs.split(';')
+        ccs = [email for email in ccs if email != my_email]
+        return ';'.join(ccs)
+
+    if user_cc_list:
+        ccs = user_cc_list.replace(' ', '').replace(',', ';').lower()
+        ccs = ccs.split(';')
+        ccs = [email for email in ccs if email != my_email]
+        return ';'.join(ccs)
+
+    return ''
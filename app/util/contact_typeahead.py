@@ -0,0 +1,408 @@
+"""
+contact_typeahead.py - In-memory prefix index for contact typeahead.
+
+The index is a sorted list of the distinct terms found in contacts' names,
+organizations and emails plus the digits of their telephone numbers, and
+beside it, for each term, the contacts having it. Every term starting with
+a prefix sits in one contiguous run of that list, so a lookup is a binary
+search followed by a short scan.
+
+The index is built on first use. DbContacts.save() updates it for changes
+made by this process, and lookups pick up changes made by other processes
+by reading contacts whose last_edit_date is newer than the last refresh.
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from array import array
+from bisect import bisect_left
+from datetime import datetime, timedelta
+import sys
+import threading
+import time
+
+from util.database import Database, DB_NAME
+from util.logger import get_logger
+import util.search_tokens as TOKENS
+
+COLLECTION_NAME = 'contacts'
+
+# Rank at most this many contacts matching the most selective query word.
+# Terms are scanned in order, so contacts having the word itself as a term
+# come before contacts where it is only a prefix.
+CANDIDATE_LIMIT = 1000
+
+# Other query words narrow the candidates by set intersection when they match
+# no more than this many contacts, and by checking each candidate's terms otherwise.
+SET_LIMIT = 5000
+
+# How often, in seconds, to look for contacts changed by other processes.
+REFRESH_SECONDS = 30
+
+# Refreshes reread contacts edited this long before the newest edit we have
+# seen, to allow for clock differences between servers and for MongoDB
+# storing times to the millisecond.
+REFRESH_OVERLAP = timedelta(seconds=5)
+
+NAME_FIELDS = ['first_name', 'middle_name', 'last_name', 'suffix']
+PHONE_FIELDS = ['office_phone', 'cell_phone']
+PROJECTION = {'name': 1, 'organization': 1, 'email': 1, 'office_phone': 1, 'cell_phone': 1, 'last_edit_date': 1}
+
+# Positions in the per-contact record tuple.
+ID, NAME, ORGANIZATION, EMAIL, TERMS, SORT_NAME = range(6)
+
+
+class ContactTypeahead(object):
+    """
+    Prefix index over contacts, shared by every request in this process.
+    """
+    def __init__(self, db_name: str = DB_NAME):
+        self.db_name = db_name
+        self.lock = threading.RLock()
+        self.logger = get_logger('contact_typeahead')
+        self.terms = None
+        self.postings = []
+        self.contacts = []
+        self.ordinals = {}
+        self.free = []
+        self.watermark = None
+        self.last_refresh = 0
+        self.build_ms = 0.0
+        self.index_bytes = 0
+
+    def lookup(self, query: str, limit: int = 10) -> list:
+        """
+        Find contacts having a term that starts with each word in *query*.
+
+        Contacts having more of the words as whole terms rank first; ties are
+        listed by name.
+
+        Args:
+            query (str): What the user has typed so far
+            limit (int): Maximum number of contacts to return
+        Returns:
+            (list): Dicts with '_id', 'name', 'organization', and 'email'.
+        """
+        self._ensure_current()
+        words = TOKENS.query_terms(query)
+        if not words:
+            return []
+
+        with self.lock:
+            spans = {word: self._span(word) for word in words}
+            sizes = {word: self._count(*spans[word], SET_LIMIT) for word in words}
+            words.sort(key=lambda w: (sizes[w], -len(w)))
+
+            candidates = []
+            seen = set()
+            lo, hi = spans[words[0]]
+            for position in range(lo, hi):
+                for ordinal in _members(self.postings[position]):
+                    if ordinal not in seen:
+                        seen.add(ordinal)
+                        candidates.append(ordinal)
+                        if len(candidates) >= CANDIDATE_LIMIT:
+                            break
+                if len(candidates) >= CANDIDATE_LIMIT:
+                    break
+
+            for word in words[1:]:
+                if not candidates:
+                    break
+                if sizes[word] <= SET_LIMIT:
+                    lo, hi = spans[word]
+                    matches = set()
+                    for position in range(lo, hi):
+                        matches.update(_members(self.postings[position]))
+                    candidates = [o for o in candidates if o in matches]
+                else:
+                    candidates = [o for o in candidates if any(t.startswith(word) for t in self.contacts[o][TERMS])]
+
+            ranked = []
+            for ordinal in candidates:
+                contact = self.contacts[ordinal]
+                exact = sum(1 for word in words if word in contact[TERMS])
+                ranked.append((-exact, contact[SORT_NAME], contact))
+
+        ranked.sort(key=lambda r: (r[0], r[1]))
+        return [
+            {'_id': c[ID], 'name': c[NAME], 'organization': c[ORGANIZATION], 'email': c[EMAIL]}
+            for _, _, c in ranked[:limit]
+        ]
+
+    def update(self, contact: dict):
+        """
+        Add or replace one contact in the index. A no-op until the index is built.
+        """
+        with self.lock:
+            if self.terms is None:
+                return
+            self._remove(str(contact['_id']))
+            self._add(contact)
+
+    def remove(self, contact_id):
+        """
+        Drop one contact from the index.
+        """
+        with self.lock:
+            if self.terms is not None:
+                self._remove(str(contact_id))
+
+    def build(self):
+        """
+        Load every contact and build the index from scratch.
+        """
+        contacts = Database(self.db_name).dbconn[COLLECTION_NAME].find({}, PROJECTION)
+        self.load(contacts)
+
+    def load(self, contacts):
+        """
+        Build the index from an iterable of contact documents.
+        """
+        started = time.perf_counter()
+        with self.lock:
+            self.contacts = []
+            self.ordinals = {}
+            self.free = []
+            self.watermark = None
+            by_term = {}
+            for contact in contacts:
+                ordinal, terms = self._record(contact)
+                for term in terms:
+                    by_term.setdefault(term, []).append(ordinal)
+            self.terms = sorted(by_term)
+            self.postings = [_posting(by_term[term]) for term in self.terms]
+            self.last_refresh = time.monotonic()
+            self.index_bytes = self._measure()
+            self.build_ms = (time.perf_counter() - started) * 1000
+        self.logger.info("Indexed %s contacts for typeahead in %.0fms", len(self.ordinals), self.build_ms)
+
+    def stats(self) -> dict:
+        """
+        Size of the index and an estimate of the memory it occupies.
+        """
+        with self.lock:
+            return {
+                'contacts': len(self.ordinals),
+                'terms': len(self.terms or []),
+                'index_bytes': self.index_bytes,
+                'build_ms': round(self.build_ms, 1),
+                'process_max_rss_bytes': _max_rss()
+            }
+
+    def _ensure_current(self):
+        """
+        Build the index on first use, then periodically fold in contacts other processes changed.
+        """
+        with self.lock:
+            if self.terms is None:
+                self.build()
+                return
+            if time.monotonic() - self.last_refresh < REFRESH_SECONDS:
+                return
+            self.last_refresh = time.monotonic()
+            watermark = self.watermark
+
+        filter_ = {'last_edit_date': {'$gt': watermark - REFRESH_OVERLAP} if watermark else {'$exists': True}}
+        changed = list(Database(self.db_name).dbconn[COLLECTION_NAME].find(filter_, PROJECTION))
+        for contact in changed:
+            self.update(contact)
+        if changed:
+            self.logger.debug("Refreshed %s changed contacts", len(changed))
+
+    def _span(self, prefix: str) -> tuple:
+        """
+        The slice of self.terms holding the terms that start with *prefix*.
+        """
+        lo = bisect_left(self.terms, prefix)
+        hi = bisect_left(self.terms, prefix + '\uffff', lo)
+        return lo, hi
+
+    def _count(self, lo: int, hi: int, limit: int) -> int:
+        """
+        Number of postings for terms lo through hi, counting no further than just past *limit*.
+        """
+        count = 0
+        for position in range(lo, hi):
+            posting = self.postings[position]
+            count += 1 if isinstance(posting, int) else len(posting)
+            if count > limit:
+                break
+        return count
+
+    def _measure(self) -> int:
+        """
+        Walk the whole index to total the memory it occupies. Later changes adjust
+        the total as they go, so this runs once per build.
+        """
+        total = sys.getsizeof(self.terms) + sys.getsizeof(self.postings)
+        total += sys.getsizeof(self.contacts) + sys.getsizeof(self.ordinals)
+        total += sum(sys.getsizeof(t) for t in self.terms)
+        total += sum(sys.getsizeof(p) for p in self.postings)
+        total += sum(_record_bytes(c) for c in self.contacts if c is not None)
+        return total
+
+    def _record(self, contact: dict) -> tuple:
+        """
+        Store the record for *contact* and return its ordinal and its terms.
+        """
+        contact_id = str(contact['_id'])
+        name = contact.get('name', {}) or {}
+        terms = []
+        for field in NAME_FIELDS:
+            terms += TOKENS.terms(name.get(field))
+        terms += TOKENS.terms(contact.get('organization'))
+        terms += TOKENS.terms(contact.get('email'))
+        for field in PHONE_FIELDS:
+            terms += TOKENS.phone_terms(contact.get(field))
+        terms = tuple(sys.intern(t) for t in sorted(set(terms)))
+
+        display_name = ' '.join(str(name.get(field) or '') for field in NAME_FIELDS)
+        record = (
+            contact_id,
+            ' '.join(display_name.split()),
+            contact.get('organization', ''),
+            contact.get('email', ''),
+            terms,
+            f"{TOKENS.normalize(name.get('last_name'))} {TOKENS.normalize(name.get('first_name'))}"
+        )
+        if self.free:
+            ordinal = self.free.pop()
+            self.contacts[ordinal] = record
+        else:
+            ordinal = len(self.contacts)
+            self.contacts.append(record)
+        self.ordinals[contact_id] = ordinal
+
+        edited = contact.get('last_edit_date')
+        if isinstance(edited, datetime) and (self.watermark is None or edited > self.watermark):
+            self.watermark = edited
+        return ordinal, terms
+
+    def _add(self, contact: dict):
+        """
+        Add a contact to the built index.
+        """
+        ordinal, terms = self._record(contact)
+        self.index_bytes += _record_bytes(self.contacts[ordinal])
+        for term in terms:
+            position = bisect_left(self.terms, term)
+            if position < len(self.terms) and self.terms[position] == term:
+                old = self.postings[position]
+                self.postings[position] = _posting(list(_members(old)) + [ordinal])
+                self.index_bytes += sys.getsizeof(self.postings[position]) - sys.getsizeof(old)
+            else:
+                self.terms.insert(position, term)
+                self.postings.insert(position, ordinal)
+                self.index_bytes += sys.getsizeof(term) + sys.getsizeof(ordinal)
+
+    def _remove(self, contact_id: str):
+        """
+        Remove a contact from the built index and free its ordinal for reuse.
+        """
+        ordinal = self.ordinals.pop(contact_id, None)
+        if ordinal is None:
+            return
+        for term in self.contacts[ordinal][TERMS]:
+            position = bisect_left(self.terms, term)
+            if position == len(self.terms) or self.terms[position] != term:
+                continue
+            old = self.postings[position]
+            members = [o for o in _members(old) if o != ordinal]
+            if members:
+                self.postings[position] = _posting(members)
+                self.index_bytes += sys.getsizeof(self.postings[position]) - sys.getsizeof(old)
+            else:
+                self.index_bytes -= sys.getsizeof(term) + sys.getsizeof(old)
+                del self.terms[position]
+                del self.postings[position]
+        self.index_bytes -= _record_bytes(self.contacts[ordinal])
+        self.contacts[ordinal] = None
+        self.free.append(ordinal)
+
+
+def _posting(ordinals: list):
+    """
+    Compact storage for a term's contacts: a bare int for one contact, else an unsigned int array.
+    Most telephone and email terms belong to a single contact.
+    """
+    if len(ordinals) == 1:
+        return ordinals[0]
+    return array('I', ordinals)
+
+
+def _record_bytes(record: tuple) -> int:
+    """
+    Memory held by one contact record. Its terms are shared with self.terms, so
+    only the tuple referring to them is counted.
+    """
+    return sys.getsizeof(record) + sum(sys.getsizeof(f) for f in record)
+
+
+def _members(posting):
+    """
+    The contact ordinals in a posting.
+    """
+    if isinstance(posting, int):
+        return (posting,)
+    return posting
+
+
+def _max_rss() -> int:
+    """
+    Peak resident memory of this process in bytes, where the platform reports it.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+TYPEAHEAD = ContactTypeahead()
+
+
+def _benchmark(contact_count: int):
+    """
+    Build the index over *contact_count* synthetic contacts and time lookups.
+    """
+    import random
+    from bson.objectid import ObjectId
+
+    rng = random.Random(42)
+    first_names = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Maria']
+    last_names = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez']
+    organizations = ['Law Office', 'Family Services', 'Counseling Group', 'Appraisals', 'Title Co.', '']
+    contacts = []
+    for n in range(contact_count):
+        first = rng.choice(first_names)
+        last = rng.choice(last_names) + str(n % 997)
+        contacts.append({
+            '_id': ObjectId(),
+            'name': {'title': '', 'first_name': first, 'middle_name': '', 'last_name': last, 'suffix': ''},
+            'organization': f'{last} {rng.choice(organizations)}'.strip(),
+            'email': f'{first}.{last}@example.com'.lower(),
+            'office_phone': f'+1214{n:07d}',
+            'cell_phone': f'+1972{n:07d}'
+        })
+    typeahead = ContactTypeahead()
+    typeahead.load(contacts)
+    del contacts
+    print(f"Indexed {contact_count:,} contacts in {typeahead.build_ms:.0f}ms")
+    print(typeahead.stats())
+
+    for query in ['s', 'smi', 'smith12', 'jen gar', 'maria law', '2140001', 'james.smith', 'zzz']:
+        timings = []
+        for _ in range(20):
+            started = time.perf_counter()
+            found = typeahead.lookup(query)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        print(f"{query!r:14} median {timings[10]:6.2f}ms  max {timings[-1]:6.2f}ms  ({len(found)} shown)")
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    _benchmark(int(args[0]) if args else 100000)
@@ -4,25 +4,74 @@ court_directory.py - Download and cache a court directory for Texas
 Build URLs at:
 https://card.txcourts.gov/DirectorySearch.aspx
 
+The parsed directory is saved as a small SQLite database. Worker processes
+open it read-only and memory-mapped the first time a lookup needs it, so
+they share its pages through the OS cache rather than each holding a parsed
+copy. The county, court type and court names, which back the select boxes,
+are read once into sorted tuples; personnel are read per court.
+
+Each refresh that changes anything is saved as a new numbered snapshot,
+directory.v<N>.sqlite, and published by rewriting directory.current, which
+holds the current version number. Both live in COURT_DIRECTORY_DIR, by default
+a court_directory folder under TMP_DIR. Running processes check that pointer at
+most once a second and switch to a new snapshot on their next lookup.
+
+Compare the cost of loading the directory as JSON and as SQLite with:
+
+    python -m util.court_directory --benchmark
+
 Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 """
 import csv
+import glob
+import gzip
+import hashlib
 import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+from time import monotonic
 try:
     from util.logger import get_logger
 except ModuleNotFoundError:
     import logging
+from util.court_personnel_search import PersonnelSearch
 import requests
 from datetime import date, time
 
 URL = 'https://card.txcourts.gov/ExcelExportPublic.aspx?type=P&export=E&SortBy=tblCounty.Sort_ID,%20tblCourt.Court_Identifier&Active_Flg=true&Court_Type_CD=0&Court_Sub_Type_CD=0&County_ID=0&City_CD=0&Court=&DistrictPrimaryLocOnly=1&AdminJudicialRegion=0&COADistrictId=0'  # noqa
 URL = 'https://card.txcourts.gov/ExcelExportPublic.aspx?type=P&export=E&CommitteeID=0&Court=&SortBy=tblCounty.Sort_ID,%20Last_Name&Active_Flg=true&Last_Name=&First_Name=&Court_Type_CD=0&Court_Sub_Type_CD=0&County_ID=0&City_CD=0&Address_Type_CD=0&Annual_Report_CD=0&PersonnelType1=&PersonnelType2=&DistrictPrimaryLocOnly=0&AdminJudicialRegion=0&COADistrictId=0'  # noqa
 
-DIRECTORY_FILE = 'util/data/directory.json'
-CACHE_FILE = 'util/data/court_directory_cache.tsv'
+# Snapshots are generated, so they are kept outside the source tree.
+DATA_DIR = os.environ.get('COURT_DIRECTORY_DIR') or os.path.join(
+    os.environ.get('TMP_DIR') or os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tmp'),
+    'court_directory'
+)
+DIRECTORY_FILE = os.path.join(DATA_DIR, 'directory.v{version}.sqlite')
+CURRENT_FILE = os.path.join(DATA_DIR, 'directory.current')
+CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'court_directory_cache.tsv')
+CACHE_ENCODING = 'cp1252'
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Snapshots kept on disk, and seconds between checks for a newer one.
+KEEP_VERSIONS = 3
+CHECK_SECONDS = 1.0
+
+# Entry fields, in the order they are stored.
+FIELDS = (
+    'court_type', 'court', 'county', 'prefix', 'first_name', 'middle_name', 'last_name', 'suffix',
+    'title', 'address', 'city', 'state', 'postal_code', 'telephone', 'email'
+)
+# Fields that identify a person in a court. The rest are reported as changes.
+KEY_FIELDS = ('county', 'court_type', 'court', 'last_name', 'first_name', 'middle_name', 'suffix')
+MMAP_SIZE = 64 * 1024 * 1024
 
 
 class Entry(object):
+    __slots__ = FIELDS
+
     if 'get_logger' in globals():
         logger = get_logger('court_directory')
     else:
@@ -71,23 +120,151 @@ class Entry(object):
         except IndexError:
             pass
 
+    def key(self) -> tuple:
+        """
+        The fields that identify this person, see KEY_FIELDS.
+        """
+        return tuple(getattr(self, f) for f in KEY_FIELDS)
+
+    def values(self) -> tuple:
+        """
+        All fields, in the order of FIELDS.
+        """
+        return tuple(getattr(self, f) for f in FIELDS)
+
 
 class CourtDirectory(object):
-    directory = None
+    # The snapshot version in use and when we last looked for a newer one.
+    version = None
+    checked = 0.0
+
+    # (version, counties, {county: court types}, {(county, court type): courts}),
+    # read from the database on first use.
+    names = None
+
+    # (version, PersonnelSearch), built on the first search.
+    search_index = None
+
+    # The county -> court type -> courts tree as JSON, see bundle().
+    court_bundle = None
+    lock = threading.Lock()
+    connections = threading.local()
 
     def __init__(self):
         """
-        Load the cached court directory.
+        Nothing is read until the first lookup.
+        """
+        pass
+
+    @staticmethod
+    def current_version() -> int:
+        """
+        The published snapshot version or None if nothing has been published.
         """
-        if not CourtDirectory.directory:
-            with open(DIRECTORY_FILE, 'r') as fp:
-                CourtDirectory.directory = json.load(fp)
+        try:
+            with open(CURRENT_FILE, 'r') as fp:
+                return int(fp.read().strip())
+        except (FileNotFoundError, ValueError):
+            return None
 
-    def get_counties(self) -> list:
+    @staticmethod
+    def _check_version():
+        """
+        Switch to a newer snapshot if one has been published since we last looked.
+        The check reads a few bytes and happens at most every CHECK_SECONDS.
+        """
+        now = monotonic()
+        if CourtDirectory.version is not None and now - CourtDirectory.checked < CHECK_SECONDS:
+            return
+        CourtDirectory.checked = now
+        version = CourtDirectory.current_version()
+        if version is None and os.path.exists(CACHE_FILE):
+            with CourtDirectory.lock:
+                version = CourtDirectory.current_version() or CourtDirectory.save(CourtDirectory.parse())
+        if version != CourtDirectory.version:
+            if CourtDirectory.version is not None:
+                Entry.logger.info("Court directory: switching from version %s to %s", CourtDirectory.version, version)
+            CourtDirectory.version = version
+
+    @staticmethod
+    def _connection(version: int = None) -> sqlite3.Connection:
+        """
+        This thread's read-only connection to the current snapshot, or to *version*.
+        """
+        if version is None:
+            CourtDirectory._check_version()
+            version = CourtDirectory.version
+        cached = getattr(CourtDirectory.connections, 'cached', None)
+        if cached and cached[0] == version:
+            return cached[1]
+        if cached:
+            cached[1].close()
+        path = DIRECTORY_FILE.format(version=version)
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        connection.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+        CourtDirectory.connections.cached = (version, connection)
+        return connection
+
+    @staticmethod
+    def _names() -> tuple:
+        """
+        The county, court type and court names of the current snapshot, as sorted tuples.
+        """
+        CourtDirectory._check_version()
+        names = CourtDirectory.names
+        if names is not None and names[0] == CourtDirectory.version:
+            return names
+        with CourtDirectory.lock:
+            version = CourtDirectory.version
+            court_types = {}
+            courts = {}
+            rows = CourtDirectory._connection(version).execute(
+                'SELECT county, court_type, court FROM courts ORDER BY county, court_type, court'
+            )
+            for county, court_type, court in rows:
+                court_types.setdefault(county, []).append(court_type)
+                courts.setdefault((county, court_type), []).append(court)
+            names = (
+                version,
+                tuple(sorted(court_types)),
+                {c: tuple(sorted(set(t))) for c, t in court_types.items()},
+                {key: tuple(names) for key, names in courts.items()}
+            )
+            CourtDirectory.names = names
+        return names
+
+    def bundle(self) -> dict:
+        """
+        The county -> court type -> courts tree of the current snapshot as one
+        JSON document, serialized and gzipped once per snapshot. The same
+        snapshot gives the same bytes in every process, so its hash can name
+        a URL that browsers cache for good.
+
+        Returns:
+            (dict): 'version', 'etag' (hash of the JSON), 'json' and 'gzip' (bytes)
+        """
+        names = CourtDirectory._names()
+        cached = CourtDirectory.court_bundle
+        if cached is not None and cached['version'] == names[0]:
+            return cached
+
+        version, counties, court_types, courts = names
+        tree = {county: {t: courts.get((county, t), ()) for t in court_types[county]} for county in counties}
+        body = json.dumps({'version': version, 'counties': tree}, separators=(',', ':'), sort_keys=True).encode()
+        cached = {
+            'version': version,
+            'etag': hashlib.sha256(body).hexdigest()[:20],
+            'json': body,
+            'gzip': gzip.compress(body, compresslevel=9, mtime=0),
+        }
+        CourtDirectory.court_bundle = cached
+        return cached
+
+    def get_counties(self) -> tuple:
         """
         Get a list of counties
         """
-        return list(CourtDirectory.directory.keys())
+        return CourtDirectory._names()[1]
 
     def get_county_tuples(self) -> list:
         """
@@ -96,11 +273,11 @@ class CourtDirectory(object):
         counties = self.get_counties()
         return [(c, c) for c in counties]
 
-    def get_court_types(self, county: str) -> list:
+    def get_court_types(self, county: str) -> tuple:
         """
         Get a list of types of courts for the given county.
         """
-        return list(CourtDirectory.directory.get(county, {}).keys())
+        return CourtDirectory._names()[2].get(county, ())
 
     def get_court_type_tuples(self, county: str) -> list:
         """
@@ -109,15 +286,11 @@ class CourtDirectory(object):
         court_types = self.get_court_types(county)
         return [(c, c) for c in court_types]
 
-    def get_courts(self, county: str, court_type: str) -> list:
+    def get_courts(self, county: str, court_type: str) -> tuple:
         """
         Get a list of courts of the given type for the given county.
         """
-        try:
-            return list(CourtDirectory.directory[county][court_type].keys())
-        except KeyError:
-            pass
-        return list()
+        return CourtDirectory._names()[3].get((county, court_type), ())
 
     def get_court_tuples(self, county: str, court_type: str) -> list:
         """
@@ -130,74 +303,232 @@ class CourtDirectory(object):
         """
         Get a list of people who work in the given court.
         """
-        try:
-            return list(CourtDirectory.directory[county][court_type][court])
-        except KeyError:
-            pass
-        return list()
+        rows = CourtDirectory._connection().execute(
+            f'SELECT {", ".join(FIELDS)} FROM personnel WHERE county = ? AND court_type = ? AND court = ? ORDER BY seq',
+            (county, court_type, court)
+        )
+        return [dict(zip(FIELDS, row)) for row in rows]
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """
+        Find court personnel by partial or misspelled names, titles, courts,
+        cities or phone digits. See court_personnel_search.
+
+        Returns:
+            (list): Matching people, best first
+        """
+        CourtDirectory._check_version()
+        cached = CourtDirectory.search_index
+        if cached is None or cached[0] != CourtDirectory.version:
+            with CourtDirectory.lock:
+                cached = CourtDirectory.search_index
+                if cached is None or cached[0] != CourtDirectory.version:
+                    version = CourtDirectory.version
+                    rows = CourtDirectory._connection(version).execute(
+                        f'SELECT {", ".join(FIELDS)} FROM personnel ORDER BY county, court_type, court, seq'
+                    )
+                    cached = (version, PersonnelSearch(dict(zip(FIELDS, row)) for row in rows))
+                    CourtDirectory.search_index = cached
+                    Entry.logger.info("Court personnel search index built: %s", cached[1].stats())
+        return cached[1].search(query, limit)
 
     @staticmethod
-    def process():
+    def process() -> dict:
         """
-        This method will download a refreshed personnel list and update the
-        cache files.
+        This method will download a refreshed personnel list and, if anything
+        changed, publish it as a new snapshot.
+
+        Returns:
+            (dict): The changes, see diff()
         """
         CourtDirectory.retrieve()
         directory = CourtDirectory.parse()
-        CourtDirectory.save(directory)
+        changes = CourtDirectory.diff(directory)
+        if CourtDirectory.current_version() is None or any(changes.values()):
+            version = CourtDirectory.save(directory)
+            Entry.logger.info(
+                "Court directory version %s: %s added, %s removed, %s changed",
+                version, len(changes['added']), len(changes['removed']), len(changes['changed'])
+            )
+            for person in changes['added']:
+                Entry.logger.info("Court directory added: %s", person)
+            for person in changes['removed']:
+                Entry.logger.info("Court directory removed: %s", person)
+            for before, after in changes['changed']:
+                Entry.logger.info(
+                    "Court directory changed: %s",
+                    {f: (before[f], after[f]) for f in FIELDS if before[f] != after[f]}
+                )
+        else:
+            Entry.logger.info("Court directory unchanged")
+        return changes
 
     @staticmethod
-    def retrieve():
+    def retrieve() -> bool:
         """
-        Retrieve court directory and save it to a set of cached files.
+        Download the court directory to CACHE_FILE, a piece at a time. The
+        previous download is replaced only once the new one is complete.
+
+        Returns:
+            (bool): True if a new file was downloaded
         """
+        tmp_file = f'{CACHE_FILE}.part'
         try:
-            result = requests.get(URL)
-            if result.status_code == 200:
-                with open(CACHE_FILE, 'w') as fp:
-                    fp.write(result.text)
+            with requests.get(URL, stream=True, timeout=60) as result:
+                if result.status_code != 200:
+                    Entry.logger.error("Court directory download failed: HTTP %s", result.status_code)
+                    return False
+                with open(tmp_file, 'wb') as fp:
+                    for chunk in result.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        fp.write(chunk)
+            os.replace(tmp_file, CACHE_FILE)
+            return True
         except FileNotFoundError as e:
             Entry.logger.error(f"Error opening {CACHE_FILE}: %s (Does file path exist?)", e)
         except Exception as e:
             Entry.logger.error(e)
+        return False
 
     @staticmethod
-    def parse():
-        counties = {}
-
-        with open(CACHE_FILE, newline='') as tsvfile:
-            reader = csv.reader(tsvfile, delimiter='\t', quotechar='"')
-            for row in reader:
-                # Skip blank rows
-                if not row:
-                    continue
-
-                # Create object with named fields
-                entry = Entry(row)
-                if not entry.county or not entry.court or len(entry.court.strip()) == 0:
-                    continue
+    def parse(lines=None) -> dict:
+        """
+        Build the county -> court type -> court -> [Entry] tree from the
+        downloaded directory, one row at a time.
 
-                # Update list of counties if we have not seen this one before
-                if entry.county and entry.county not in counties:
-                    counties[entry.county] = {}
+        Args:
+            lines (iterable): Lines of TSV text (default=the lines of CACHE_FILE)
+        """
+        if lines is None:
+            with open(CACHE_FILE, newline='', encoding=CACHE_ENCODING, errors='replace') as tsvfile:
+                return CourtDirectory.parse(tsvfile)
 
-                # Add to the court types for this county
-                if entry.court_type not in counties[entry.county]:
-                    counties[entry.county][entry.court_type] = {}
+        counties = {}
+        for entry in read_entries(lines):
+            counties \
+                .setdefault(entry.county, {}) \
+                .setdefault(entry.court_type, {}) \
+                .setdefault(entry.court, []) \
+                .append(entry)
+        return counties
 
-                # Add to the courts of this type for this county
-                if entry.court not in counties[entry.county][entry.court_type]:
-                    counties[entry.county][entry.court_type][entry.court] = []
+    @staticmethod
+    def diff(directory: dict, version: int = None) -> dict:
+        """
+        Compare a directory returned by parse() with a saved snapshot.
+        People are matched on KEY_FIELDS.
+
+        Args:
+            directory (dict): The new directory
+            version (int): Snapshot to compare with (default=the current one)
+        Returns:
+            (dict): 'added' and 'removed' lists of people, and a 'changed' list
+                    of (before, after) tuples. People are dicts of FIELDS.
+        """
+        if version is None:
+            version = CourtDirectory.current_version()
+
+        before = {}
+        if version is not None:
+            rows = CourtDirectory._connection(version).execute(f'SELECT {", ".join(FIELDS)} FROM personnel')
+            for row in rows:
+                person = dict(zip(FIELDS, row))
+                before[tuple(person[f] for f in KEY_FIELDS)] = person
+
+        after = {}
+        for court_types in directory.values():
+            for courts in court_types.values():
+                for personnel in courts.values():
+                    for entry in personnel:
+                        after[entry.key()] = dict(zip(FIELDS, entry.values()))
+
+        return {
+            'added': [after[key] for key in after.keys() - before.keys()],
+            'removed': [before[key] for key in before.keys() - after.keys()],
+            'changed': [(before[key], after[key]) for key in after.keys() & before.keys() if before[key] != after[key]],
+        }
 
-                # Add to to this court's personnel
-                counties[entry.county][entry.court_type][entry.court].append(entry)
+    @staticmethod
+    def save(directory: dict) -> int:
+        """
+        Write the directory returned by parse() as the next snapshot version
+        and publish it. The snapshot is built under a temporary name and then
+        renamed, and the version pointer is replaced the same way, so a process
+        never sees either half-written.
 
-        return counties
+        Returns:
+            (int): The new version number
+        """
+        os.makedirs(DATA_DIR, exist_ok=True)
+        version = (CourtDirectory.current_version() or 0) + 1
+        path = DIRECTORY_FILE.format(version=version)
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        connection = sqlite3.connect(tmp_file)
+        try:
+            connection.execute(
+                'CREATE TABLE courts (county TEXT, court_type TEXT, court TEXT, '
+                'PRIMARY KEY (county, court_type, court)) WITHOUT ROWID'
+            )
+            connection.execute(
+                f'CREATE TABLE personnel ({", ".join(f"{f} TEXT" for f in FIELDS)}, seq INTEGER, '
+                'PRIMARY KEY (county, court_type, court, seq)) WITHOUT ROWID'
+            )
+            for county, court_types in directory.items():
+                for court_type, courts in court_types.items():
+                    for court, personnel in courts.items():
+                        connection.execute('INSERT INTO courts VALUES (?, ?, ?)', (county, court_type, court))
+                        connection.executemany(
+                            f'INSERT INTO personnel VALUES ({", ".join("?" * (len(FIELDS) + 1))})',
+                            [entry.values() + (seq,) for seq, entry in enumerate(personnel)]
+                        )
+            connection.commit()
+            connection.execute('VACUUM')
+        finally:
+            connection.close()
+        os.replace(tmp_file, path)
+
+        tmp_file = f'{CURRENT_FILE}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as fp:
+            fp.write(str(version))
+        os.replace(tmp_file, CURRENT_FILE)
+
+        # Look for the new version on the next lookup in this process.
+        CourtDirectory.checked = 0.0
+        CourtDirectory._remove_old_versions(version)
+        return version
 
     @staticmethod
-    def save(directory: dict):
-        with open(DIRECTORY_FILE, 'w') as fp:
-            json.dump(directory, fp, indent=4, default=serialize, sort_keys=True)
+    def _remove_old_versions(version: int):
+        """
+        Delete all but the newest KEEP_VERSIONS snapshots. A process still
+        reading one of them keeps its open file until it switches.
+        """
+        for path in glob.glob(DIRECTORY_FILE.format(version='*')):
+            match = re.search(r'\.v(\d+)\.sqlite$', path)
+            if match and int(match.group(1)) <= version - KEEP_VERSIONS:
+                try:
+                    os.remove(path)
+                except OSError as e:
+                    Entry.logger.warning("Unable to remove %s: %s", path, e)
+
+
+def read_entries(lines):
+    """
+    Generate an Entry for each personnel row of the TSV *lines*, skipping
+    the heading row, blank rows and rows without a county or court.
+    """
+    reader = csv.reader(lines, delimiter='\t', quotechar='"')
+    for row in reader:
+        # Skip blank rows and the heading row
+        if not row or row[0] == 'Court Type':
+            continue
+
+        # Create object with named fields
+        entry = Entry(row)
+        if not entry.county or not entry.court or len(entry.court.strip()) == 0:
+            continue
+        yield entry
 
 
 def serialize(obj):
@@ -209,10 +540,69 @@ def serialize(obj):
         serial = obj.isoformat()
         return serial
 
+    if isinstance(obj, Entry):
+        return dict(zip(FIELDS, obj.values()))
+
     return obj.__dict__
 
 
+_BENCHMARK_JSON = """
+import json, time, psutil
+rss = psutil.Process().memory_info().rss
+started = time.perf_counter()
+with open({path!r}) as fp:
+    directory = json.load(fp)
+types = list(directory['Collin'].keys())
+people = list(directory['Collin']['District']['416th District Court'])
+print(time.perf_counter() - started, psutil.Process().memory_info().rss - rss)
+"""
+
+_BENCHMARK_SQLITE = """
+import time, psutil
+from util.court_directory import CourtDirectory
+rss = psutil.Process().memory_info().rss
+started = time.perf_counter()
+directory = CourtDirectory()
+types = directory.get_court_types('Collin')
+people = directory.get_court_personnel('Collin', 'District', '416th District Court')
+print(time.perf_counter() - started, psutil.Process().memory_info().rss - rss)
+"""
+
+
+def _benchmark():
+    """
+    Report the time and memory a fresh process needs to load the directory
+    and answer its first lookups, from the JSON file we used to write and
+    from the SQLite file.
+    """
+    import subprocess
+    import tempfile
+
+    directory = CourtDirectory.parse()
+    sqlite_file = DIRECTORY_FILE.format(version=CourtDirectory.save(directory))
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as fp:
+        json.dump(directory, fp, indent=4, default=serialize, sort_keys=True)
+        json_file = fp.name
+
+    try:
+        for label, path, code in [
+            ('json', json_file, _BENCHMARK_JSON.format(path=json_file)),
+            ('sqlite', sqlite_file, _BENCHMARK_SQLITE)
+        ]:
+            output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+            seconds, rss = output.split()
+            print(
+                f"{label:8} {os.path.getsize(path) / 1024:8.0f} KB on disk, "
+                f"{float(seconds) * 1000:7.1f} ms to first lookup, {int(rss) / 1024 / 1024:6.1f} MB RSS"
+            )
+    finally:
+        os.remove(json_file)
+
+
 if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        _benchmark()
+        sys.exit()
     print("Processing . . .", end='')
     CourtDirectory.process()
     print("Done")
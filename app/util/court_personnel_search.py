@@ -0,0 +1,202 @@
+"""
+court_personnel_search.py - Typo-tolerant search over court personnel.
+
+Every person in the court directory is indexed under the terms found in
+their name and title, their court's name, county and city, and the digits of
+their telephone number. A query word matches a term that starts with it or,
+failing that, a term sharing enough of its trigrams (three letter pieces),
+so 'janwya' still finds 'Janway'. A person must match every query word.
+
+The terms are kept in a sorted list, so prefix matches are a binary search.
+Beside it, each trigram lists the terms containing it, and each term lists
+the people having it. The index is built from the current directory snapshot
+on the first search and rebuilt when a new snapshot is published.
+
+Time searches over the current directory with:
+
+    python -m util.court_personnel_search
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from array import array
+from bisect import bisect_left
+import sys
+import time
+
+import util.search_tokens as TOKENS
+
+# A term is a fuzzy match for a query word when this share of their
+# trigrams are the same (Dice coefficient).
+FUZZY_THRESHOLD = 0.5
+
+# Scores for a query word matching a term exactly, as a prefix, and fuzzily.
+# A fuzzy match scores FUZZY_WEIGHT times its similarity.
+EXACT_SCORE = 1.0
+PREFIX_SCORE = 0.9
+FUZZY_WEIGHT = 0.8
+
+NAME_FIELDS = ['prefix', 'first_name', 'middle_name', 'last_name', 'suffix']
+TEXT_FIELDS = ['title', 'court', 'county', 'city']
+RESULT_FIELDS = ['county', 'court_type', 'court', 'title', 'telephone', 'email', 'address', 'city', 'postal_code']
+
+
+class PersonnelSearch(object):
+    """
+    Term and trigram index over a list of people.
+    """
+    def __init__(self, people: list):
+        """
+        Args:
+            people (list): Dicts with the court_directory FIELDS
+        """
+        started = time.perf_counter()
+        self.people = []
+        postings = {}
+        for person in people:
+            ordinal = len(self.people)
+            self.people.append(_record(person))
+            for term in person_terms(person):
+                postings.setdefault(term, []).append(ordinal)
+
+        self.terms = sorted(postings)
+        self.postings = [array('I', postings[term]) for term in self.terms]
+
+        trigrams = {}
+        for position, term in enumerate(self.terms):
+            if not term.isdigit():
+                for trigram in set(_trigrams(term)):
+                    trigrams.setdefault(trigram, []).append(position)
+        self.trigrams = {trigram: array('I', positions) for trigram, positions in trigrams.items()}
+        self.build_ms = (time.perf_counter() - started) * 1000
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """
+        Find the people matching every word of *query*, best matches first.
+
+        Args:
+            query (str): Partial or misspelled names, titles, courts, cities or phone digits
+            limit (int): Maximum number of people to return
+        Returns:
+            (list): Dicts with 'name', 'score' and the RESULT_FIELDS
+        """
+        words = TOKENS.query_terms(query)
+        if not words:
+            return []
+
+        scores = None
+        for word in sorted(words, key=len, reverse=True):
+            matches = self._match(word)
+            if scores is None:
+                scores = matches
+            else:
+                scores = {o: s + matches[o] for o, s in scores.items() if o in matches}
+            if not scores:
+                return []
+
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], self.people[item[0]][0]))
+        return [
+            {'name': self.people[o][0], 'score': round(s, 3), **dict(zip(RESULT_FIELDS, self.people[o][1:]))}
+            for o, s in ranked[:limit]
+        ]
+
+    def stats(self) -> dict:
+        """
+        Size of the index.
+        """
+        return {
+            'people': len(self.people),
+            'terms': len(self.terms),
+            'trigrams': len(self.trigrams),
+            'build_ms': round(self.build_ms, 1),
+        }
+
+    def _match(self, word: str) -> dict:
+        """
+        The people having a term matching *word*, each with the best score any of their terms earned.
+        """
+        term_scores = {}
+        lo = bisect_left(self.terms, word)
+        hi = bisect_left(self.terms, word + '\uffff', lo)
+        for position in range(lo, hi):
+            term_scores[position] = EXACT_SCORE if self.terms[position] == word else PREFIX_SCORE
+
+        if len(word) >= 3 and not word.isdigit():
+            word_trigrams = set(_trigrams(word))
+            shared = {}
+            for trigram in word_trigrams:
+                for position in self.trigrams.get(trigram, ()):
+                    shared[position] = shared.get(position, 0) + 1
+            for position, count in shared.items():
+                if position in term_scores:
+                    continue
+                similarity = 2 * count / (len(word_trigrams) + len(self.terms[position]))
+                if similarity >= FUZZY_THRESHOLD:
+                    term_scores[position] = FUZZY_WEIGHT * similarity
+
+        people = {}
+        for position, score in term_scores.items():
+            for ordinal in self.postings[position]:
+                if score > people.get(ordinal, 0):
+                    people[ordinal] = score
+        return people
+
+
+def person_terms(person: dict) -> set:
+    """
+    The terms a person is found by.
+    """
+    terms = []
+    for field in NAME_FIELDS + TEXT_FIELDS:
+        terms += TOKENS.terms(person.get(field))
+    for digits in TOKENS.phone_terms(person.get('telephone')):
+        terms.append(digits)
+        # Also the local number, e.g. '5484520' in '(972)548-4520'.
+        if len(digits) == 10:
+            terms.append(digits[3:])
+    return set(sys.intern(t) for t in terms)
+
+
+def _trigrams(term: str) -> list:
+    """
+    The trigrams of *term*, marking its start and end so that 'smith' and
+    'smithers' differ in more than length: '$sm', 'smi', 'mit', 'ith', 'th$'.
+    A term of n letters has n trigrams.
+    """
+    padded = f'${term}$'
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+def _record(person: dict) -> tuple:
+    """
+    What a search result shows for *person*: the full name, then the RESULT_FIELDS.
+    """
+    name = ' '.join(person.get(f) for f in NAME_FIELDS if person.get(f))
+    return (name,) + tuple((person.get(f) or '').strip() for f in RESULT_FIELDS)
+
+
+def _benchmark():
+    """
+    Build the index over the current court directory and time searches.
+    """
+    from util.court_directory import CourtDirectory
+
+    directory = CourtDirectory()
+    directory.search('')
+    index = CourtDirectory.search_index[1]
+    print(index.stats())
+
+    for query in ['janway', 'janwya', 'coordinator collin', 'cordinator colin', '548-4520', 'mckinney clerk', 'zzzz']:
+        timings = []
+        for _ in range(20):
+            started = time.perf_counter()
+            found = directory.search(query)
+            timings.append((time.perf_counter() - started) * 1000)
+        timings.sort()
+        first = found[0]['name'] if found else ''
+        print(f"{query!r:22} median {timings[10]:6.2f}ms  max {timings[-1]:6.2f}ms  ({len(found)} shown) {first}")
+
+
+if __name__ == '__main__':
+    _benchmark()
@@ -5,11 +5,19 @@ database.py - Class for access our persistent data store for publicdataws.
 @version 0.0.1
 Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 """
+import base64
+import binascii
+import copy
 import os
 import re
+import threading
+import time
 
+from bson import json_util
+from bson.objectid import ObjectId
+from flask import g, has_app_context
 import phonenumbers
-from pymongo import MongoClient
+from pymongo import ASCENDING, DESCENDING, MongoClient, monitoring
 from datetime import date
 from decimal import Decimal
 from util.logger import get_logger
@@ -24,6 +32,22 @@ except KeyError as e:
 
 DB_NAME = 'payment_redirect'
 
+# Connection pool settings. Anything not set in the environment is left to
+# pymongo's defaults. Each entry is (environment variable, MongoClient option, type).
+CLIENT_OPTIONS = [
+    ('DB_MAX_POOL_SIZE', 'maxPoolSize', int),
+    ('DB_MIN_POOL_SIZE', 'minPoolSize', int),
+    ('DB_MAX_IDLE_TIME_MS', 'maxIdleTimeMS', int),
+    ('DB_WAIT_QUEUE_TIMEOUT_MS', 'waitQueueTimeoutMS', int),
+    ('DB_CONNECT_TIMEOUT_MS', 'connectTimeoutMS', int),
+    ('DB_SERVER_SELECTION_TIMEOUT_MS', 'serverSelectionTimeoutMS', int),
+    ('DB_SOCKET_TIMEOUT_MS', 'socketTimeoutMS', int),
+    ('DB_READ_CONCERN', 'readConcernLevel', str),
+    ('DB_WRITE_CONCERN', 'w', str),
+    ('DB_WRITE_TIMEOUT_MS', 'wtimeoutMS', int),
+    ('DB_READ_PREFERENCE', 'readPreference', str),
+]
+
 # Flag values for get_clients()
 MEDIATION_RETAINER_DUE = 'M'
 TRIAL_RETAINER_DUE = 'T'
@@ -35,6 +59,170 @@ class MissingFieldException(Exception):
         return super(message)
 
 
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """
+    Collects connection pool statistics for every client in the registry.
+    pymongo publishes these events synchronously on the thread that is
+    checking out the connection, so wait times are measured per thread.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.pools_created = 0
+        self.pools_cleared = 0
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_ms_total = 0.0
+        self.wait_ms_max = 0.0
+
+    def pool_created(self, event):
+        with self.lock:
+            self.pools_created += 1
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self.lock:
+            self.pools_cleared += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self.lock:
+            self.connections_created += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self.lock:
+            self.connections_closed += 1
+
+    def connection_check_out_started(self, event):
+        self.local.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        waited = self._waited_ms()
+        with self.lock:
+            self.checkout_failures += 1
+            self.wait_ms_total += waited
+            self.wait_ms_max = max(self.wait_ms_max, waited)
+
+    def connection_checked_out(self, event):
+        waited = self._waited_ms()
+        with self.lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out, self.checked_out)
+            self.wait_ms_total += waited
+            self.wait_ms_max = max(self.wait_ms_max, waited)
+
+    def connection_checked_in(self, event):
+        with self.lock:
+            self.checked_out -= 1
+
+    def _waited_ms(self) -> float:
+        started = getattr(self.local, 'started', None)
+        self.local.started = None
+        if started is None:
+            return 0.0
+        return (time.perf_counter() - started) * 1000.0
+
+    def stats(self) -> dict:
+        """
+        Return a snapshot of the pool statistics.
+        """
+        with self.lock:
+            attempts = self.checkouts + self.checkout_failures
+            return {
+                'uptime_seconds': round(time.time() - self.started, 1),
+                'clients': len(_CLIENTS),
+                'pools_created': self.pools_created,
+                'pools_cleared': self.pools_cleared,
+                'connections_created': self.connections_created,
+                'connections_closed': self.connections_closed,
+                'connections_open': self.connections_created - self.connections_closed,
+                'checked_out': self.checked_out,
+                'max_checked_out': self.max_checked_out,
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'wait_ms_total': round(self.wait_ms_total, 3),
+                'wait_ms_max': round(self.wait_ms_max, 3),
+                'wait_ms_avg': round(self.wait_ms_total / attempts, 3) if attempts else 0.0,
+                'max_pool_size': client_options().get('maxPoolSize', 100),
+            }
+
+
+POOL_METRICS = PoolMetrics()
+
+# Counts for the request-scoped identity map. 'hits' are round trips avoided.
+IDENTITY_METRICS = {'hits': 0, 'misses': 0}
+_IDENTITY_LOCK = threading.Lock()
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def client_options() -> dict:
+    """
+    Build the MongoClient keyword arguments from the environment.
+    """
+    options = {}
+    for env_name, option, option_type in CLIENT_OPTIONS:
+        value = os.environ.get(env_name)
+        if value in [None, '']:
+            continue
+        if option == 'w' and value.isdigit():
+            option_type = int
+        options[option] = option_type(value)
+    return options
+
+
+def get_client(url: str = None) -> MongoClient:
+    """
+    Return the process-wide MongoClient for *url*, creating it on first use.
+    Every Database subclass and the Flask-Session backend share these clients
+    so that the whole process draws from one connection pool per cluster.
+
+    Args:
+        url (str): Connection string. Defaults to DB_URL.
+    Returns:
+        (MongoClient): Shared client instance.
+    """
+    url = url or DB_URL
+    client = _CLIENTS.get(url)
+    if client is not None:
+        return client
+
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(url)
+        if client is None:
+            client = MongoClient(url, event_listeners=[POOL_METRICS], **client_options())
+            _CLIENTS[url] = client
+    return client
+
+
+def pool_stats() -> dict:
+    """
+    Live connection pool statistics for the shared clients.
+    """
+    return POOL_METRICS.stats()
+
+
+def identity_map_stats() -> dict:
+    """
+    How many get_one() round trips the request-scoped identity map has avoided ('hits').
+    """
+    with _IDENTITY_LOCK:
+        return dict(IDENTITY_METRICS)
+
+
 class Database(object):
     """
     Encapsulates a database accessor that is agnostic as to the underlying
@@ -66,6 +254,7 @@ class Database(object):
         """
         if self.db_name in Database.database_connections:
             self.dbconn = Database.database_connections[self.db_name]
+            self.client = self.dbconn.client
             self.logger.debug("Reusing connection to %s for %s", self.db_name, self.__class__.__name__)
             return True
 
@@ -78,7 +267,7 @@ class Database(object):
                 self.db_name,
                 DB_URL,
                 self.__class__.__name__)
-            client = MongoClient(DB_URL)
+            client = get_client()
             dbconn = client[self.db_name]
             self.client = client
             self.dbconn = dbconn
@@ -90,6 +279,66 @@ class Database(object):
 
         return success
 
+    def find_by_id(self, collection_name: str, id) -> dict:
+        """
+        Retrieve a document by _id through the request's identity map.
+
+        The first time a document is read in a request it comes from the
+        database. Later reads of the same document in that request are served
+        from memory. Each caller gets its own copy, so changes made by one
+        caller are not seen by another. Outside a request this is a plain find_one().
+
+        Args:
+            collection_name (str): Name of collection to read
+            id (str|ObjectId): _id of the document
+        Returns:
+            (dict): The located document or None
+        """
+        id = ObjectId(id)
+        documents = self._identity_map(collection_name)
+        if documents is not None and id in documents:
+            with _IDENTITY_LOCK:
+                IDENTITY_METRICS['hits'] += 1
+            self.logger.debug("Identity map hit for %s.%s %s", self.db_name, collection_name, id)
+            return copy.deepcopy(documents[id])
+
+        document = self.dbconn[collection_name].find_one({'_id': id})
+        with _IDENTITY_LOCK:
+            IDENTITY_METRICS['misses'] += 1
+        if documents is not None:
+            documents[id] = copy.deepcopy(document)
+        return document
+
+    def remember(self, collection_name: str, id, fields: dict = None):
+        """
+        Bring the request's identity map up to date after a write. The fields
+        written with $set are merged into the document if we hold it. Without
+        *fields*, the document is dropped and the next read will fetch it.
+
+        Args:
+            collection_name (str): Name of collection that was written
+            id (str|ObjectId): _id of the document
+            fields (dict): Fields that were $set on the document (optional)
+        """
+        documents = self._identity_map(collection_name)
+        if documents is None:
+            return
+        id = ObjectId(id)
+        if fields is None or documents.get(id) is None:
+            documents.pop(id, None)
+        else:
+            documents[id].update(copy.deepcopy(fields))
+
+    def _identity_map(self, collection_name: str) -> dict:
+        """
+        The documents of *collection_name* read during this request, by _id,
+        or None when there is no request.
+        """
+        if not has_app_context():
+            return None
+        maps = g.setdefault('identity_maps', {})
+        return maps.setdefault((self.db_name, collection_name), {})
+
     def test_connection(self) -> bool:
         """
         Test the underlying connection.
@@ -107,6 +356,117 @@ class Database(object):
         return status
 
 
+def keyset_page(collection, filter_: dict, order_by: list, after: str = None, before: str = None, page_size: int = 25, projection: dict = None) -> dict:
+    """
+    Retrieve one page of documents using keyset (cursor) pagination.
+
+    Rather than skipping over earlier documents, each page starts from the
+    sort key of the last document on the page before it, so page 100 costs
+    the same as page 1 when *order_by* is served by an index. _id is added
+    as the final sort key so that every document has a distinct position.
+
+    Args:
+        collection (Collection): Collection to query
+        filter_ (dict): Filter
+        order_by (list): List of (field, direction) tuples
+        after (str): Token from a previous page's 'next'. Return the page after it.
+        before (str): Token from a previous page's 'prev'. Return the page before it.
+        page_size (int): Number of documents per page (default=25)
+        projection (dict): Fields to return (optional)
+    Returns:
+        (dict): 'items' is the list of documents, and 'next' and 'prev' are tokens for the
+                adjoining pages, or None when there are no more documents in that direction.
+    """
+    order_by = list(order_by)
+    if '_id' not in [field for field, _ in order_by]:
+        order_by.append(('_id', ASCENDING))
+
+    token = before or after
+    values = decode_cursor(token, len(order_by)) if token else None
+    backwards = values is not None and before is not None
+    if backwards:
+        sort = [(field, -direction) for field, direction in order_by]
+    else:
+        sort = order_by
+
+    if values is not None:
+        filter_ = {'$and': [filter_ or {}, _keyset_filter(sort, values)]}
+
+    documents = list(collection.find(filter_, projection).sort(sort).limit(page_size + 1))
+    has_more = len(documents) > page_size
+    documents = documents[:page_size]
+    if backwards:
+        documents.reverse()
+
+    page = {'items': documents, 'next': None, 'prev': None}
+    if documents:
+        if has_more or backwards:
+            page['next'] = encode_cursor(documents[-1], order_by)
+        if (has_more and backwards) or (values is not None and not backwards):
+            page['prev'] = encode_cursor(documents[0], order_by)
+    return page
+
+
+def encode_cursor(document: dict, order_by: list) -> str:
+    """
+    Encode the sort key values of *document* as an opaque, URL-safe token.
+    """
+    values = [_dotted_value(document, field) for field, _ in order_by]
+    return base64.urlsafe_b64encode(json_util.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token: str, key_count: int) -> list:
+    """
+    Decode a token created by encode_cursor(). A token that cannot be decoded,
+    e.g. one edited by hand, is logged and treated as the start of the list.
+    """
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json_util.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+        if isinstance(values, list) and len(values) == key_count:
+            return values
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        get_logger('database').warning("Ignoring invalid page token %s: %s", token, e)
+    return None
+
+
+def _keyset_filter(sort: list, values: list) -> dict:
+    """
+    Filter matching documents that sort after *values* under *sort*.
+
+    For sort keys (a, b, _id) that is: a beyond its value, or a equal and b
+    beyond its value, or a and b equal and _id beyond its value. MongoDB sorts
+    null and missing values before everything else, so "beyond" a null in
+    ascending order is any non-null value, and "beyond" a value in descending
+    order includes the nulls.
+    """
+    branches = []
+    for position, (field, direction) in enumerate(sort):
+        branch = {f: {'$eq': v} for (f, _), v in zip(sort[:position], values[:position])}
+        value = values[position]
+        if direction == DESCENDING:
+            if value is None:
+                continue
+            branch[field] = {'$lt': value}
+            branches.append({'$or': [branch, dict(branch, **{field: {'$eq': None}})]})
+            continue
+        branch[field] = {'$ne': None} if value is None else {'$gt': value}
+        branches.append(branch)
+    return {'$or': branches} if branches else {'_id': {'$exists': False}}
+
+
+def _dotted_value(document: dict, path: str):
+    """
+    Get the value at a dotted *path* in *document*, or None.
+    """
+    value = document
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
 def multidict2dict(d, blank_dict: dict = None) -> dict:
     """
     Create a dict from the given multidict.
@@ -232,4 +592,13 @@ def normalize_telephone_number(telephone_number: str) -> str:
 
 
 def do_upgrades():
-    pass
+    """
+    Bring the database up to date at startup.
+    """
+    # Imported here because these modules import this one.
+    from util.db_indexes import reconcile_indexes
+    from util.db_client_search import DbClientSearch
+    from util.db_note_index import DbNoteIndex
+    reconcile_indexes()
+    DbClientSearch().ensure_built()
+    DbNoteIndex().ensure_built()
@@ -5,10 +5,15 @@ db_admins.py - Class for access our persistent data store for admins.
 @version 0.0.1
 Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 """
+import copy
 import os
+import threading
+
+from flask import g, has_app_context
 
 from util.logger import get_logger
 from util.database import Database
+from util.ttl_cache import MISSING, TTLCache
 
 try:
     DB_URL = os.environ["DB_URL"]
@@ -20,6 +25,16 @@ except KeyError as e:
 
 COLLECTION_NAME = 'admins'
 
+# Admin records are read by the decorators and again by most views, so they
+# are memoized for the request in flask.g and across requests for a short time.
+# DbUsers.save() invalidates them; other processes see a change within the TTL.
+ADMIN_CACHE = TTLCache(
+    max_size=int(os.environ.get('ADMIN_CACHE_SIZE', 256)),
+    ttl_seconds=float(os.environ.get('ADMIN_CACHE_TTL', 60))
+)
+REQUEST_METRICS = {'requests': 0, 'request_hits': 0}
+_METRICS_LOCK = threading.Lock()
+
 
 class DbAdmins(Database):
     """
@@ -35,12 +50,40 @@ class DbAdmins(Database):
         e.g. ['TJD']. For paralegals, it will probably have a list with
         an entry for each attorney she or he supports, e.g. ['TJD', 'BSL']
         """
-        # Create lookup filter
-        filter_ = {'email': email.lower()}
+        email = email.lower()
+        if has_app_context():
+            records = g.setdefault('admin_records', {})
+            with _METRICS_LOCK:
+                if email in records:
+                    REQUEST_METRICS['request_hits'] += 1
+                else:
+                    REQUEST_METRICS['requests'] += 1
+        else:
+            records = {}
+
+        document = records.get(email, MISSING)
+        if document is MISSING:
+            document = ADMIN_CACHE.get(email)
+            if document is MISSING:
+                # Locate matching admin record
+                document = self.dbconn[COLLECTION_NAME].find_one({'email': email})
+                ADMIN_CACHE.put(email, document)
+            records[email] = document
 
-        # Locate matching admin record
-        document = self.dbconn[COLLECTION_NAME].find_one(filter_)
-        return document
+        # Callers may change the record they get back; keep the cached copy clean.
+        return copy.deepcopy(document)
+
+    @staticmethod
+    def invalidate(email: str = None):
+        """
+        Forget the cached admin record for *email*, or all of them if no email is given.
+        """
+        if email is None:
+            ADMIN_CACHE.invalidate()
+        else:
+            ADMIN_CACHE.invalidate(email.lower())
+        if has_app_context():
+            g.pop('admin_records', None)
 
     # FKA get_authorizations
     def authorizations(self, email: str) -> list:
@@ -76,3 +119,16 @@ class DbAdmins(Database):
         admin_record = self.admin_record(email)
         print(f"********* EMAIL: '{email}'")
         return admin_record.get('click_up_workspace_name', os.environ.get('CLICK_UP_DEFAULT_WORKSPACE'))
+
+
+def admin_cache_stats() -> dict:
+    """
+    Statistics for the admin record cache. 'misses' is the number of times
+    we went to the database, so misses / requests is the number of admin
+    lookups per request, which should be one or fewer.
+    """
+    stats = ADMIN_CACHE.stats()
+    with _METRICS_LOCK:
+        stats.update(REQUEST_METRICS)
+    stats['lookups_per_request'] = round(stats['misses'] / stats['requests'], 3) if stats['requests'] else 0.0
+    return stats
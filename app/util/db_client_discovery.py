@@ -10,7 +10,7 @@ import json  # noqa
 from pymongo import DESCENDING
 from bson.objectid import ObjectId
 
-from util.database import Database
+from util.database import Database, keyset_page
 
 DB_NAME = 'discoverybot'
 COLLECTION_NAME = 'discovery_requests'
@@ -31,9 +31,7 @@ class DbClientDiscovery(Database):
         Returns:
             (dict): The located document or None
         """
-        filter_ = {'_id': ObjectId(id)}
-        document = self.dbconn[COLLECTION_NAME].find_one(filter_)
-        return document
+        return self.find_by_id(COLLECTION_NAME, id)
 
     def get_list(self, email: str, clients_id: str, where: dict = None, page_num: int = 1, page_size: int = 25) -> list:
         """
@@ -73,6 +71,23 @@ class DbClientDiscovery(Database):
 
         return list(discovery)
 
+    def get_page(self, email: str, clients_id: str, after: str = None, before: str = None, page_size: int = 25) -> dict:
+        """
+        Retrieve a page of discovery requests using cursor pagination. See keyset_page().
+
+        Args:
+            email (str): Email address of admin user.
+            clients_id (str): ID of client for whom to retrieve discovery requests
+            after (str): 'next' token from the previous page
+            before (str): 'prev' token from the following page
+            page_size (int): Number of documents per page (default=25)
+        Returns:
+            (dict): 'items' is the list of requests, 'next' and 'prev' are page tokens or None.
+        """
+        filter_ = {'client_id': ObjectId(clients_id)}
+        order_by = [('time', DESCENDING)]
+        return keyset_page(self.dbconn[COLLECTION_NAME], filter_, order_by, after=after, before=before, page_size=page_size)
+
     def has_any(self, clients_id: str) -> bool:
         """
         See if there are any discovery requests for this client. This is used in rendering the UI.
@@ -88,6 +103,25 @@ class DbClientDiscovery(Database):
             return True
         return False
 
+    def clients_having_any(self, clients_ids: list) -> set:
+        """
+        Which of the given clients have any discovery requests? One grouped query answers
+        has_any() for a whole list of clients.
+
+        Args:
+            clients_ids (list): IDs of clients to check.
+
+        Returns:
+            (set): ObjectIds of the clients that have discovery requests.
+        """
+        if not clients_ids:
+            return set()
+        pipeline = [
+            {'$match': {'client_id': {'$in': [ObjectId(_id) for _id in clients_ids]}}},
+            {'$group': {'_id': '$client_id'}}
+        ]
+        return {doc['_id'] for doc in self.dbconn[COLLECTION_NAME].aggregate(pipeline)}
+
     def del_one_request(self, email: str, doc_id: str, request_number: str) -> dict:
         """
         Delete one discovery request from the discovery_requests document.
@@ -104,6 +138,7 @@ class DbClientDiscovery(Database):
             {'_id': ObjectId(doc_id)},
             {'$pull': {'requests': {'number': int(request_number)}}}
         )
+        self.remember(COLLECTION_NAME, doc_id)
 
         if result.matched_count == 0:
             return {'success': False, 'message': "Document not found."}
@@ -135,6 +170,7 @@ class DbClientDiscovery(Database):
         except Exception as e:
             self.logger.error(e)
             return {'success': False, 'message': str(e)}
+        self.remember(COLLECTION_NAME, query['_id'])
 
         if result.matched_count == 0:
             return {'success': False, 'message': "Document not found."}
@@ -167,6 +203,7 @@ class DbClientDiscovery(Database):
         filter_ = {'_id': ObjectId(doc['_id'])}
         del doc['_id']
         result = self.dbconn[COLLECTION_NAME].update_one(filter_, {'$set': doc})
+        self.remember(COLLECTION_NAME, filter_['_id'], doc)
         if result.modified_count == 1:
             message = "Discovery request updated"
             return {'success': True, 'message': message}
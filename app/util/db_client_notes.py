@@ -10,7 +10,8 @@ import json  # noqa
 from pymongo import DESCENDING
 from bson.objectid import ObjectId
 
-from util.database import Database
+from util.database import Database, keyset_page
+from util.db_note_index import DbNoteIndex
 
 COLLECTION_NAME = 'notes'
 
@@ -28,9 +29,7 @@ class DbClientNotes(Database):
         Returns:
             (dict): The located document or None
         """
-        filter_ = {'_id': ObjectId(id)}
-        document = self.dbconn[COLLECTION_NAME].find_one(filter_)
-        return document
+        return self.find_by_id(COLLECTION_NAME, id)
 
     def get_list(self, email: str, clients_id: str, where: dict = None, page_num: int = 1, page_size: int = 25) -> list:
         """
@@ -70,6 +69,23 @@ class DbClientNotes(Database):
 
         return list(notes)
 
+    def get_page(self, email: str, clients_id: str, after: str = None, before: str = None, page_size: int = 25) -> dict:
+        """
+        Retrieve a page of notes using cursor pagination. See keyset_page().
+
+        Args:
+            email (str): Email address of admin user.
+            clients_id (str): ID of client for whom to retrieve notes
+            after (str): 'next' token from the previous page
+            before (str): 'prev' token from the following page
+            page_size (int): Number of documents per page (default=25)
+        Returns:
+            (dict): 'items' is the list of notes, 'next' and 'prev' are page tokens or None.
+        """
+        filter_ = {'clients_id': ObjectId(clients_id)}
+        order_by = [('created_date', DESCENDING)]
+        return keyset_page(self.dbconn[COLLECTION_NAME], filter_, order_by, after=after, before=before, page_size=page_size)
+
     def has_any(self, clients_id: str) -> bool:
         """
         See if there are any notes for this client. This is used in rendering the UI.
@@ -85,7 +101,26 @@ class DbClientNotes(Database):
             return True
         return False
 
-    def search(self, email: str, clients_id: str, query: str, page_num: int = 1, page_size: int = 25) -> list:
+    def clients_having_any(self, clients_ids: list) -> set:
+        """
+        Which of the given clients have any notes? One grouped query answers
+        has_any() for a whole list of clients.
+
+        Args:
+            clients_ids (list): IDs of clients to check.
+
+        Returns:
+            (set): ObjectIds of the clients that have notes.
+        """
+        if not clients_ids:
+            return set()
+        pipeline = [
+            {'$match': {'clients_id': {'$in': [ObjectId(_id) for _id in clients_ids]}}},
+            {'$group': {'_id': '$clients_id'}}
+        ]
+        return {doc['_id'] for doc in self.dbconn[COLLECTION_NAME].aggregate(pipeline)}
+
+    def search(self, email: str, clients_id: str, query: str, page_num: int = 1, page_size: int = 25, tag: str = None) -> dict:
         """
         Search for notes matching the words in *query*.
 
@@ -95,28 +130,21 @@ class DbClientNotes(Database):
             query (str): Query string from user
             page_num (int): Which page number is going to be displayed? (default=1)
             page_size (int): Number of documents per page (default=25)
+            tag (str): Only include notes having this tag (optional)
         Returns:
-            (list): List of docs or None
+            (dict): 'notes' is the list of ranked notes on the requested page, each with a
+                    highlighted '_snippet' in place of its text, 'total' is the number of
+                    matching notes, and 'tags' maps tags to counts of matching notes.
         """
-        search_fields = [
-            'text',
-            'tags']
-        search_words = query.split()
-        conditions = []
-        for search_field in search_fields:
-            for search_word in search_words:
-                regex = f'.*{search_word}.*'
-                conditions.append({search_field: {'$regex': regex, '$options': 'i'}})
-
-        where = {'$or': conditions}
-
-        return self.get_list(
-            email=email,
-            clients_id=clients_id,
-            where=where,
-            page_num=page_num,
-            page_size=page_size
-        )
+        index = DbNoteIndex()
+        result = index.search(clients_id, query, tag=tag, page_num=page_num, page_size=page_size)
+        return {
+            'notes': index.snippets(result['ids'], result['words']),
+            'total': result['total'],
+            'tags': result['tags'],
+            'page_num': page_num,
+            'page_size': page_size
+        }
 
     def save(self, email: str, doc: dict) -> dict:
         """
@@ -134,6 +162,7 @@ class DbClientNotes(Database):
 
             result = self.dbconn[COLLECTION_NAME].insert_one(doc)
             if result.inserted_id:
+                DbNoteIndex().index_note(doc)
                 message = "Note added"
                 return {'success': True, 'message': message}
             message = "Failed to add new note"
@@ -143,7 +172,9 @@ class DbClientNotes(Database):
         filter_ = {'_id': ObjectId(doc['_id'])}
         del doc['_id']
         result = self.dbconn[COLLECTION_NAME].update_one(filter_, {'$set': doc})
+        self.remember(COLLECTION_NAME, filter_['_id'], doc)
         if result.modified_count == 1:
+            DbNoteIndex().index_note(self.dbconn[COLLECTION_NAME].find_one(filter_))
             message = "Note updated"
             return {'success': True, 'message': message}
 
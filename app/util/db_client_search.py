@@ -0,0 +1,291 @@
+"""
+db_client_search.py - Search index for the clients collection.
+
+Each client has one document in the client_search collection holding the
+normalized terms for the fields staff search on, plus the fields we filter
+search results by. DbClients.save() keeps it current. Prefix lookups are
+range scans on a multikey index, so the cost of a search depends on the
+number of matches rather than on the number of clients.
+
+Run this module directly to rebuild the index or to benchmark it:
+
+    python -m util.db_client_search --rebuild
+    python -m util.db_client_search --benchmark [client_count]
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import random
+import sys
+import time
+
+from pymongo import ReplaceOne
+
+from util.database import Database, DB_NAME
+from util.logger import get_logger
+import util.search_tokens as TOKENS
+
+COLLECTION_NAME = 'client_search'
+CLIENTS_COLLECTION_NAME = 'clients'
+
+# Fields that identify the client by name. Matches here rank highest.
+NAME_FIELDS = ['first_name', 'last_name', 'middle_name', 'suffix']
+
+# Other searchable fields, by dotted path.
+TEXT_FIELDS = ['email', 'address.street', 'address.city', 'case_county', 'court_name', 'cause_number', 'oag_number']
+PHONE_FIELDS = ['telephone']
+
+# Points for the best way a query term matched a client.
+NAME_EXACT = 4
+NAME_PREFIX = 3
+OTHER_EXACT = 2
+OTHER_PREFIX = 1
+
+
+class DbClientSearch(Database):
+    """
+    Encapsulates a database accessor for the client search index.
+    """
+    def __init__(self, db_name: str = DB_NAME):
+        super().__init__(db_name)
+        self.logger = get_logger('db_client_search')
+
+    def index_client(self, client: dict):
+        """
+        Add or refresh the search entry for one client document.
+        """
+        entry = search_entry(client)
+        self.dbconn[COLLECTION_NAME].replace_one({'_id': entry['_id']}, entry, upsert=True)
+
+    def remove_client(self, client_id):
+        """
+        Remove a client from the search index.
+        """
+        self.dbconn[COLLECTION_NAME].delete_one({'_id': client_id})
+
+    def search(self, email: str, query: str, page_num: int = 1, page_size: int = 25, crm_state: str = None, include_inactive: bool = False) -> dict:
+        """
+        Find clients whose indexed fields have a term starting with any word in *query*.
+
+        Results are ranked so that clients matching more of the query words,
+        and matching them on their names, come first.
+
+        Args:
+            email (str): Email of user performing the search.
+            query (str): Query string from user.
+            page_num (int): Which page number is going to be displayed? (default=1)
+            page_size (int): Number of documents per page (default=25)
+            crm_state (str): CRM State to select. None or '*' for all CRM States.
+            include_inactive (bool): Include inactive clients in the results?
+        Returns:
+            (dict): 'ids' is the list of client ObjectIds on the requested page, in rank order,
+                    and 'total' is the number of matching clients.
+        """
+        words = TOKENS.query_terms(query)
+        if not words:
+            return {'ids': [], 'total': 0}
+
+        filter_ = {
+            '$and': [
+                {'admin_users': email.lower()},
+                {'$or': [{'terms': {'$elemMatch': TOKENS.prefix_range(word)}} for word in words]}
+            ]
+        }
+        if not include_inactive:
+            filter_['$and'].append({'active_flag': 'Y'})
+        if crm_state and crm_state != '*':
+            filter_['$and'].append({'crm_state': crm_state})
+
+        projection = {'terms': 1, 'name_terms': 1, 'sort_name': 1}
+        ranked = []
+        for candidate in self.dbconn[COLLECTION_NAME].find(filter_, projection):
+            ranked.append((
+                -score(words, candidate.get('name_terms', []), candidate.get('terms', [])),
+                candidate.get('sort_name', ''),
+                candidate['_id']
+            ))
+        ranked.sort()
+
+        skips = page_size * (max(page_num, 1) - 1)
+        return {
+            'ids': [r[2] for r in ranked[skips:skips + page_size]],
+            'total': len(ranked)
+        }
+
+    def rebuild(self, batch_size: int = 500) -> int:
+        """
+        Rebuild the search index from the clients collection.
+
+        Returns:
+            (int): Number of clients indexed.
+        """
+        count = 0
+        batch = []
+        seen = []
+        for client in self.dbconn[CLIENTS_COLLECTION_NAME].find({}, index_projection()).batch_size(batch_size):
+            entry = search_entry(client)
+            batch.append(ReplaceOne({'_id': entry['_id']}, entry, upsert=True))
+            seen.append(entry['_id'])
+            if len(batch) >= batch_size:
+                self.dbconn[COLLECTION_NAME].bulk_write(batch, ordered=False)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.dbconn[COLLECTION_NAME].bulk_write(batch, ordered=False)
+            count += len(batch)
+
+        # Remove entries for clients that no longer exist.
+        self.dbconn[COLLECTION_NAME].delete_many({'_id': {'$nin': seen}})
+        self.logger.info("Indexed %s clients for search", count)
+        return count
+
+    def ensure_built(self):
+        """
+        Build the index if it has never been built, e.g. right after this upgrade is deployed.
+        """
+        if self.dbconn[COLLECTION_NAME].estimated_document_count() == 0 \
+                and self.dbconn[CLIENTS_COLLECTION_NAME].estimated_document_count() > 0:
+            self.rebuild()
+
+
+def index_projection() -> dict:
+    """
+    Projection that loads just the client fields the search index needs.
+    """
+    fields = ['name', 'admin_users', 'active_flag', 'crm_state'] + TEXT_FIELDS + PHONE_FIELDS
+    return {field: 1 for field in fields}
+
+
+def search_entry(client: dict) -> dict:
+    """
+    Build the client_search document for a client document.
+    """
+    name = client.get('name', {}) or {}
+    name_terms = []
+    for field in NAME_FIELDS:
+        name_terms += TOKENS.terms(name.get(field))
+
+    other_terms = []
+    for field in TEXT_FIELDS:
+        other_terms += TOKENS.terms(_get_path(client, field))
+    for field in PHONE_FIELDS:
+        other_terms += TOKENS.phone_terms(_get_path(client, field))
+
+    admin_users = client.get('admin_users', [])
+    if isinstance(admin_users, str):
+        admin_users = [admin_users]
+
+    return {
+        '_id': client['_id'],
+        'admin_users': [user.strip().lower() for user in admin_users],
+        'active_flag': client.get('active_flag'),
+        'crm_state': client.get('crm_state'),
+        'name_terms': sorted(set(name_terms)),
+        'terms': sorted(set(name_terms + other_terms)),
+        'sort_name': ' '.join([TOKENS.normalize(name.get('last_name')), TOKENS.normalize(name.get('first_name'))])
+    }
+
+
+def score(words: list, name_terms: list, terms: list) -> int:
+    """
+    Rank a candidate: each query word earns points for the best way it matched.
+    """
+    total = 0
+    for word in words:
+        if word in name_terms:
+            total += NAME_EXACT
+        elif any(t.startswith(word) for t in name_terms):
+            total += NAME_PREFIX
+        elif word in terms:
+            total += OTHER_EXACT
+        elif any(t.startswith(word) for t in terms):
+            total += OTHER_PREFIX
+    return total
+
+
+def _get_path(doc: dict, path: str):
+    """
+    Get the value at a dotted *path* in *doc*, or None.
+    """
+    value = doc
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def _benchmark(client_count: int):
+    """
+    Load *client_count* synthetic clients into a scratch database and compare
+    indexed search with the regular expression search it replaced.
+    """
+    from util.db_indexes import INDEX_CATALOG, reconcile_indexes
+
+    bench_db = f'{DB_NAME}_bench'
+    for (db_name, collection_name), specs in list(INDEX_CATALOG.items()):
+        if db_name == DB_NAME and collection_name in [COLLECTION_NAME, CLIENTS_COLLECTION_NAME]:
+            INDEX_CATALOG[(bench_db, collection_name)] = specs
+
+    searcher = DbClientSearch(bench_db)
+    clients = searcher.dbconn[CLIENTS_COLLECTION_NAME]
+    clients.drop()
+    searcher.dbconn[COLLECTION_NAME].drop()
+    reconcile_indexes()
+
+    rng = random.Random(42)
+    first_names = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Maria']
+    last_names = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', "O'Brien"]
+    counties = ['Collin', 'Dallas', 'Denton', 'Tarrant', 'Rockwall']
+    docs = []
+    for n in range(client_count):
+        first = rng.choice(first_names)
+        last = rng.choice(last_names) + ('' if n % 7 else str(n % 97))
+        docs.append({
+            'name': {'title': '', 'first_name': first, 'middle_name': '', 'last_name': last, 'suffix': ''},
+            'email': f'{first}.{last}{n}@example.com'.lower(),
+            'telephone': f'+1214{n:07d}',
+            'address': {'street': f'{n} Main St', 'city': 'Plano'},
+            'case_county': rng.choice(counties),
+            'court_name': f'{rng.randint(199, 471)}th District Court',
+            'cause_number': f'{rng.randint(199, 471)}-{n:05d}-{2015 + n % 10}',
+            'oag_number': f'{n:010d}',
+            'admin_users': ['bench@example.com'],
+            'active_flag': 'Y',
+            'crm_state': '070:retained_active'
+        })
+    clients.insert_many(docs)
+
+    started = time.perf_counter()
+    searcher.rebuild()
+    print(f"Indexed {client_count:,} clients in {time.perf_counter() - started:.2f}s")
+
+    queries = ['smith', 'jen', 'garcia maria', '416-0', '2145550', 'obrien', 'collin']
+    for query in queries:
+        started = time.perf_counter()
+        result = searcher.search('bench@example.com', query, page_size=25, crm_state='*', include_inactive=True)
+        indexed_ms = (time.perf_counter() - started) * 1000
+
+        conditions = []
+        for field in ['name.first_name', 'name.last_name', 'email', 'telephone', 'address.street', 'address.city',
+                      'case_county', 'court_name', 'cause_number', 'oag_number']:
+            for word in query.split():
+                conditions.append({field: {'$regex': f'.*{word}.*', '$options': 'i'}})
+        started = time.perf_counter()
+        regex_count = len(list(clients.find({'admin_users': 'bench@example.com', '$or': conditions})))
+        regex_ms = (time.perf_counter() - started) * 1000
+        print(f"{query!r:16} indexed: {indexed_ms:8.1f}ms ({result['total']:,} matches)   regex: {regex_ms:8.1f}ms ({regex_count:,} matches)")
+
+    clients.drop()
+    searcher.dbconn[COLLECTION_NAME].drop()
+
+
+if __name__ == '__main__':
+    if '--rebuild' in sys.argv:
+        DbClientSearch().rebuild()
+    elif '--benchmark' in sys.argv:
+        args = [a for a in sys.argv[1:] if not a.startswith('--')]
+        _benchmark(int(args[0]) if args else 50000)
+    else:
+        print(__doc__)
@@ -12,9 +12,10 @@ import os
 from pymongo import ASCENDING
 from bson.objectid import ObjectId
 
-import pandas as pd
-
 from util.database import Database, multidict2dict, csv_to_list, str_to_dollars, set_missing_flags, normalize_telephone_number, convert_types
+from util.db_client_search import DbClientSearch, index_projection
+from util.export_engine import stream_export, with_total
+from util.export_profiles import CLIENT_LIST, ExportProfile
 from util.us_states import US_STATE_NAMES
 from util.logger import get_logger
 
@@ -25,6 +26,14 @@ MEDIATION_RETAINER_DUE = 'M'
 TRIAL_RETAINER_DUE = 'T'
 EVERGREEN_PAYMENT_DUE = 'E'
 
+LIST_ORDER = [
+    ('crm_state', ASCENDING),
+    ('name.last_name', ASCENDING),
+    ('name.first_name', ASCENDING),
+    ('email', ASCENDING)
+]
+LIST_PROJECTION = {"case_events": 0, "health_ins": 0, "dental_ins": 0, "mediation_date": 0}
+
 
 class DbClients(Database):
     """
@@ -49,51 +58,24 @@ class DbClients(Database):
         Returns:
             (list): Of client docs.
         """
-        filter_ = {
-            '$and': [
-                {'admin_users': {'$elemMatch': {'$eq': email.lower()}}},
-            ]
-        }
-
-        if not include_inactive:
-            filter_['$and'].append({'active_flag': {'$eq': 'Y'}})
-
-        # See if we have a flag to add to the filter
-        if flag:
-            if flag == MEDIATION_RETAINER_DUE:
-                filter_['$and'].append({'mediation_retainer_flag': {'$eq': 'Y'}})
-                filter_['$and'].append({'trial_retainer_flag': {'$eq': 'N'}})
-            elif flag == TRIAL_RETAINER_DUE:
-                filter_['$and'].append({'trial_retainer_flag': {'$eq': 'Y'}})
-                filter_['$and'].append({'mediation_retainer_flag': {'$eq': 'N'}})
-            elif flag == EVERGREEN_PAYMENT_DUE:
-                filter_['$and'].append({'trial_retainer_flag': {'$eq': 'N'}})
-                filter_['$and'].append({'mediation_retainer_flag': {'$eq': 'N'}})
-            else:
-                return {}
-
-        if crm_state and crm_state != '*':
-            filter_['$and'].append({'crm_state': {'$eq': crm_state}})
-
-        if where:
-            filter_['$and'].append(where)
-
-        order_by = [
-            ('crm_state', ASCENDING),
-            ('name.last_name', ASCENDING),
-            ('name.first_name', ASCENDING),
-            ('email', ASCENDING)
-        ]
+        filter_ = _list_filter(email, flag, crm_state, where, include_inactive)
+        if filter_ is None:
+            return {}
 
-        projection = projection or {"case_events":0, "health_ins":0, "dental_ins":0, "mediation_date":0}
+        projection = projection or LIST_PROJECTION
 
-        documents = list(self.dbconn[COLLECTION_NAME].find(filter_, projection).sort(order_by))
+        documents = list(self.dbconn[COLLECTION_NAME].find(filter_, projection).sort(LIST_ORDER))
         return documents
 
-    def search(self, email: str, query: str, page_num: int = 1, page_size: int = 25, crm_state: str = None, include_inactive: bool = False) -> list:
+    def search(self, email: str, query: str, page_num: int = 1, page_size: int = 25, crm_state: str = None, include_inactive: bool = False) -> dict:
         """
         Search for clients matching the words in *query*.
 
+        Each word matches clients having a name, email, telephone, address,
+        court, cause number, or OAG number term that starts with that word.
+        Clients matching more of the words, and matching them on their names,
+        are listed first.
+
         Args:
             email (str): Email of user performing the search.
             query (str): Query string from user.
@@ -103,66 +85,56 @@ class DbClients(Database):
                                 None or '*' for all CRM States.
             include_inactive (bool): Include inactive clients in the results?
         Returns:
-            (list): List of docs or None
+            (dict): 'clients' is the list of docs on the requested page, 'total' is the
+                    number of matching clients, and 'page_num' and 'page_size' echo the request.
         """
-        search_fields = [
-            'name.first_name',
-            'name.last_name',
-            'name.middle_name',
-            'name.suffix',
-            'email',
-            'telephone',
-            'address.street',
-            'address.city',
-            'case_county',
-            'court_name',
-            'cause_number',
-            'oag_number'
-        ]
-        search_words = query.split()
-        conditions = []
-        for search_field in search_fields:
-            for search_word in search_words:
-                regex = f'.*{search_word}.*'
-                conditions.append({search_field: {'$regex': regex, '$options': 'i'}})
-
-        where = {'$or': conditions}
-
-        return self.get_list(
-            email=email,
-            where=where,
+        result = DbClientSearch().search(
+            email,
+            query,
+            page_num=page_num,
+            page_size=page_size,
             crm_state=crm_state,
             include_inactive=include_inactive
         )
 
-    def get_list_as_csv(self, email: str, crm_state=None, drop_cols=None) -> str:
+        documents = {
+            doc['_id']: doc for doc in self.dbconn[COLLECTION_NAME].find({'_id': {'$in': result['ids']}}, LIST_PROJECTION)
+        }
+        return {
+            'clients': [documents[_id] for _id in result['ids'] if _id in documents],
+            'total': result['total'],
+            'page_num': page_num,
+            'page_size': page_size
+        }
+
+    def get_list_as_csv(self, email: str, crm_state=None, profile: ExportProfile = CLIENT_LIST):
+        """
+        Generate the client list as CSV text, streamed from the database.
+        See get_list_export().
         """
-        Return the client list as a CSV string.
+        return self.get_list_export(email, 'csv', crm_state=crm_state, profile=profile)
+
+    def get_list_export(self, email: str, fmt: str, crm_state=None, profile: ExportProfile = CLIENT_LIST, progress=None):
         """
-        documents = self.get_list(email, crm_state=crm_state)
-
-        # Break out compound fields into individual columns
-        for document in documents:
-            name = document.get('name', {})
-            for key, value in name.items():
-                document[key] = value
-            address = document.get('address', {})
-            for key, value in address.items():
-                document[key] = value
-
-        clients = clients_to_dataframe(documents)
-
-        # Drop columns that don't need to be downloaded
-        if drop_cols is None:
-            drop_cols = [
-                '_id', 'admin_users', 'check_digit', 'client_dl', 'client_ssn',
-                'active_flag', 'name', 'address', 'address1', 'client_name'
-            ]
-        clients = clients.drop(columns=drop_cols, errors='ignore')
-
-        # Create and return CSV file.
-        csv_export = clients.to_csv(sep=",")
-        return csv_export
+        Generate the client list in format *fmt*, streamed from the database.
+        See export_engine.stream_export().
+
+        Args:
+            email (str): Email address of user who requested the export
+            fmt (str): 'csv', 'parquet' or 'xlsx'
+            crm_state (str): CRM State to select. None or '*' for all CRM States.
+            profile (ExportProfile): Columns to export (default=CLIENT_LIST)
+            progress (callable): Called with (rows written, total rows) as the export proceeds (optional)
+        """
+        filter_ = _list_filter(email, crm_state=crm_state)
+        return stream_export(
+            fmt,
+            self.dbconn[COLLECTION_NAME],
+            filter_,
+            profile,
+            order_by=LIST_ORDER,
+            progress=with_total(progress, self.dbconn[COLLECTION_NAME], filter_)
+        )
 
     def get_id_name_list(self, email: str, crm_state=None) -> str:
         """
@@ -181,12 +153,8 @@ class DbClients(Database):
         Return a client record given a client ID.
         """
         try:
-            # Create lookup filter
-            filter_ = {}
-            filter_['_id'] = ObjectId(client_id)
-
             # Locate matching client document
-            document = self.dbconn[COLLECTION_NAME].find_one(filter_)
+            document = self.find_by_id(COLLECTION_NAME, client_id)
         except Exception:
             document = None
         return document
@@ -236,13 +204,7 @@ class DbClients(Database):
         """
         client = self.get_one(client_id)
         if client:
-            subj_name = client.get('name', {}).get('last_name', "")
-            subj_cause = client.get('cause_number', None)
-            if not subj_cause:
-                subj_cause = client.get('case_style', None)
-            if subj_cause:
-                subj_cause = f"({subj_cause})"
-            return f"{subj_name} {subj_cause}:"
+            return make_email_subject(client)
 
         return None
 
@@ -271,6 +233,7 @@ class DbClients(Database):
                 doc['reference'] = f"Client ID {doc['billing_id']}.{doc['matter_id']}"
                 result = self.dbconn[COLLECTION_NAME].insert_one(doc)
                 if result.inserted_id:
+                    DbClientSearch().index_client(doc)
                     message = f"Client record added for {client_name}"
                     return {'success': True, 'message': message}
                 message = "Failed to add new client record"
@@ -282,7 +245,11 @@ class DbClients(Database):
             if 'billing_id' in doc:
                 doc['reference'] = f"Client ID {doc['billing_id']}.{doc['matter_id']}"
             result = self.dbconn[COLLECTION_NAME].update_one(filter_, {'$set': doc})
+            self.remember(COLLECTION_NAME, filter_['_id'], doc)
             if result.modified_count == 1:
+                client = self.dbconn[COLLECTION_NAME].find_one(filter_, index_projection())
+                if client:
+                    DbClientSearch().index_client(client)
                 message = f"{client_name}'s record updated"
                 return {'success': True, 'message': message}
 
@@ -317,6 +284,24 @@ def make_client_name(client: dict, include_title: bool = True) -> str:
     return " ".join(list(client['name'].values())[first_index:-1]).strip()
 
 
+def make_email_subject(client: dict) -> str:
+    """
+    Create the standard email subject for a client, e.g. 'Smith (416-55555-2021):'.
+
+    Args:
+        client (dict): Document from clients collection.
+    Returns:
+        (str): Email subject string.
+    """
+    subj_name = client.get('name', {}).get('last_name', "")
+    subj_cause = client.get('cause_number', None)
+    if not subj_cause:
+        subj_cause = client.get('case_style', None)
+    if subj_cause:
+        subj_cause = f"({subj_cause})"
+    return f"{subj_name} {subj_cause}:"
+
+
 def correct_check_digit(ssn: str, dl: str) -> str:
     s = f'{ssn}{dl}'
     total = 0
@@ -330,21 +315,43 @@ def correct_check_digit(ssn: str, dl: str) -> str:
     return CHECK_DIGITS[check_index]
 
 
-def clients_to_dataframe(documents: dict):
+def _list_filter(email: str, flag: str = None, crm_state: str = '070:retained_active', where: dict = None, include_inactive: bool = False) -> dict:
     """
-    Convert result set to dataframe.
+    Build the filter for get_list() and get_list_as_csv(). See get_list() for the arguments.
+
+    Returns:
+        (dict): MongoDb filter or None if *flag* is not valid.
     """
-    our_pay_url = os.environ.get('OUR_PAY_URL')
-    clients = pd.DataFrame(columns=[])
-    # pylint: disable=unused-variable
-    for num, client in enumerate(documents):
-        # pylint: enable=unused-variable
-        client_id = str(client['_id'])
-        client['_id'] = client_id
-        client['payment_link'] = f"{our_pay_url}{client['client_ssn']}{client['client_dl']}{client['check_digit']}"
-        series_obj = pd.Series(client, name=client_id)
-        clients = clients.append(series_obj)
-    return clients
+    filter_ = {
+        '$and': [
+            {'admin_users': {'$elemMatch': {'$eq': email.lower()}}},
+        ]
+    }
+
+    if not include_inactive:
+        filter_['$and'].append({'active_flag': {'$eq': 'Y'}})
+
+    # See if we have a flag to add to the filter
+    if flag:
+        if flag == MEDIATION_RETAINER_DUE:
+            filter_['$and'].append({'mediation_retainer_flag': {'$eq': 'Y'}})
+            filter_['$and'].append({'trial_retainer_flag': {'$eq': 'N'}})
+        elif flag == TRIAL_RETAINER_DUE:
+            filter_['$and'].append({'trial_retainer_flag': {'$eq': 'Y'}})
+            filter_['$and'].append({'mediation_retainer_flag': {'$eq': 'N'}})
+        elif flag == EVERGREEN_PAYMENT_DUE:
+            filter_['$and'].append({'trial_retainer_flag': {'$eq': 'N'}})
+            filter_['$and'].append({'mediation_retainer_flag': {'$eq': 'N'}})
+        else:
+            return None
+
+    if crm_state and crm_state != '*':
+        filter_['$and'].append({'crm_state': {'$eq': crm_state}})
+
+    if where:
+        filter_['$and'].append(where)
+
+    return filter_
 
 
 def cleanup(doc: dict):
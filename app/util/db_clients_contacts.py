@@ -7,15 +7,26 @@ Copyright (c) 2021 by Thomas J. Daley, J.D. All Rights Reserved.
 """
 from datetime import datetime
 import json  # noqa
+import sys
+import time
 from pymongo import ASCENDING
 from bson.objectid import ObjectId
 
-from util.database import Database
+from util.database import Database, DB_NAME, keyset_page, pool_stats
 from util.db_clients import DbClients
 from util.db_contacts import DbContacts
 
 COLLECTION_NAME = 'clients_contacts'
 
+# Parent fields shown by the crm/contact_clients.html and _client_contacts.html templates.
+CLIENT_FIELDS = {
+    'name': 1, 'crm_state': 1, 'billing_id': 1, 'attorney_initials': 1, 'case_type': 1,
+    'case_county': 1, 'court_name': 1, 'retained_date': 1, 'completion_date': 1, 'admin_users': 1
+}
+CONTACT_FIELDS = {
+    'name': 1, 'job_title': 1, 'email': 1, 'email_cc': 1, 'office_phone': 1, 'cell_phone': 1
+}
+
 
 class DbClientsContacts(Database):
     """
@@ -87,18 +98,8 @@ class DbClientsContacts(Database):
         if not contacts:
             return None
         contacts = list(contacts)
-
-        # Join the two tables.
-        # The underscore indicates that the data in that column are read-only
-        for contact in contacts:
-            _client = DbClientsContacts.DBCLIENTS.get_one(contact['clients_id'])
-            contact['_client'] =  _client
-            _contact = DbClientsContacts.DBCONTACTS.get_one(contact['contacts_id'])
-            contact['_contact'] = _contact
-            if contact.get('email_cc', None) is None:
-                contact['email_cc'] = _contact.get('email_cc', '')
-
-        return list(contacts)
+        self._join(contacts)
+        return contacts
 
     def get_clients(self, email: str, contacts_id: str, where: dict = None, page_num: int = 1, page_size: int = 50) -> list:
         """
@@ -135,23 +136,70 @@ class DbClientsContacts(Database):
         contacts = self.dbconn[COLLECTION_NAME].find(filter_).sort(order_by).skip(skips).limit(page_size)
 
         if not contacts:
-            print("@@@@ NO CLIENT_CONTACTS")
             return None
-        print(contacts)
-
-        # Join the two tables.
-        # The underscore indicates that the data in that column are read-only
         contacts = list(contacts)
-        for contact in contacts:
-            print("@@@@ Enriching for role", contact)
-            client = DbClientsContacts.DBCLIENTS.get_one(contact['clients_id'])
-            contact['_client'] =  client
-            contact = DbClientsContacts.DBCONTACTS.get_one(contact['contacts_id'])
-            contact['_contact'] = contact
-
-        print("@@@@ Found", len(contacts), "CLIENT_CONTACTS")
+        self._join(contacts)
         return contacts
 
+    def get_list_page(self, email: str, clients_id: str, after: str = None, before: str = None, page_size: int = 50) -> dict:
+        """
+        Retrieve a page of a client's contacts using cursor pagination. See keyset_page().
+
+        Args:
+            email (str): Email address of admin user.
+            clients_id (str): ID of client for whom to retrieve contacts
+            after (str): 'next' token from the previous page
+            before (str): 'prev' token from the following page
+            page_size (int): Number of documents per page (default=50)
+        Returns:
+            (dict): 'items' is the list of joined clients_contacts documents,
+                    'next' and 'prev' are page tokens or None.
+        """
+        filter_ = {'clients_id': ObjectId(clients_id), 'active': True}
+        order_by = [('contact_sort', ASCENDING)]
+        page = keyset_page(self.dbconn[COLLECTION_NAME], filter_, order_by, after=after, before=before, page_size=page_size)
+        self._join(page['items'])
+        return page
+
+    def get_clients_page(self, email: str, contacts_id: str, after: str = None, before: str = None, page_size: int = 50) -> dict:
+        """
+        Retrieve a page of a contact's clients using cursor pagination. See keyset_page().
+
+        Args:
+            email (str): Email address of admin user.
+            contacts_id (str): ID of contact for whom to retrieve clients
+            after (str): 'next' token from the previous page
+            before (str): 'prev' token from the following page
+            page_size (int): Number of documents per page (default=50)
+        Returns:
+            (dict): 'items' is the list of joined clients_contacts documents,
+                    'next' and 'prev' are page tokens or None.
+        """
+        filter_ = {'contacts_id': ObjectId(contacts_id)}
+        order_by = [('client_sort', ASCENDING)]
+        page = keyset_page(self.dbconn[COLLECTION_NAME], filter_, order_by, after=after, before=before, page_size=page_size)
+        self._join(page['items'])
+        return page
+
+    def _join(self, links: list):
+        """
+        Add the '_client' and '_contact' documents to each clients_contacts document.
+        The underscore indicates that the data in that column are read-only.
+
+        The parents for the whole page are fetched with one $in query per
+        collection, limited to the fields our templates display.
+        """
+        if not links:
+            return
+        client_ids = list({link['clients_id'] for link in links})
+        contact_ids = list({link['contacts_id'] for link in links})
+        clients = {doc['_id']: doc for doc in self.dbconn['clients'].find({'_id': {'$in': client_ids}}, CLIENT_FIELDS)}
+        contacts = {doc['_id']: doc for doc in self.dbconn['contacts'].find({'_id': {'$in': contact_ids}}, CONTACT_FIELDS)}
+
+        for link in links:
+            link['_client'] = clients.get(link['clients_id'])
+            link['_contact'] = contacts.get(link['contacts_id'])
+
     def has_any(self, clients_id: str) -> bool:
         """
         See if there are any contacts for this client. This is used in rendering the UI.
@@ -304,21 +352,20 @@ class DbClientsContacts(Database):
         if 'active' not in doc:
             doc['active'] = True
 
-        # Now add some sort hints for retrieval
-        client = DbClientsContacts.DBCLIENTS.get_one(doc['clients_id'])
-        contact = DbClientsContacts.DBCONTACTS.get_one(doc['contacts_id'])
+        # When linking a new contact, reactivate an inactive link if there is one . . .
+        if _id == '0' and self.was_linked(clients_id_str, contacts_id_str):
+            self.relink('', clients_id_str, contacts_id_str)
+            message = "Contact relinked to client"
+            return {'success': True, 'message': message}
+
+        # Now add some sort hints for retrieval. Only the names are needed.
+        client = self.dbconn['clients'].find_one({'_id': doc['clients_id']}, {'name': 1})
+        contact = self.dbconn['contacts'].find_one({'_id': doc['contacts_id']}, {'name': 1})
         doc['client_sort'] = _sort_hint(client['name'])
         doc['contact_sort'] = _sort_hint(contact['name'])
 
-        # Insert new clients_contacts record
+        # . . . Otherwise, insert a new record.
         if _id == '0':
-            # If there is an inactive link, reactivate it . . .
-            if self.was_linked(clients_id_str, contacts_id_str):
-                self.relink('', clients_id_str, contacts_id_str)
-                message = "Contact relinked to client"
-                return {'success': True, 'message': message}
-
-            # . . . Otherwise, insert a new record.
             doc['created_by'] = email
             doc['created_date'] = datetime.now()
 
@@ -330,7 +377,7 @@ class DbClientsContacts(Database):
             return {'success': False, 'message': message}
 
         # Update existing clients_contacts record
-        filter_ = {'_id': ObjectId('_id')}
+        filter_ = {'_id': ObjectId(_id)}
         result = self.dbconn[COLLECTION_NAME].update_one(filter_, {'$set': doc})
         if result.modified_count == 1:
             message = "Client contact updated"
@@ -347,3 +394,52 @@ def _sort_hint(name: dict) -> str:
     lname = name.get('last_name')[0:pad_length].ljust(pad_length, pad_char)
     mname = name.get('middle_name')[0:pad_length].ljust(pad_length, pad_char)
     return f'{lname}{fname}{mname}'
+
+
+def _benchmark(link_count: int):
+    """
+    Link *link_count* contacts to one client in a scratch database and compare
+    the number of database round trips needed to list them with the per-row
+    lookups get_list() used to make.
+    """
+    bench_db = f'{DB_NAME}_bench'
+    links = DbClientsContacts(bench_db)
+    for name in [COLLECTION_NAME, 'clients', 'contacts']:
+        links.dbconn[name].drop()
+
+    name = {'title': '', 'first_name': 'Bench', 'middle_name': '', 'last_name': 'Client', 'suffix': ''}
+    clients_id = links.dbconn['clients'].insert_one({'name': name, 'admin_users': ['bench@example.com']}).inserted_id
+    for n in range(link_count):
+        name = {'title': '', 'first_name': 'Contact', 'middle_name': '', 'last_name': f'{n:05d}', 'suffix': ''}
+        contacts_id = links.dbconn['contacts'].insert_one({'name': name, 'email': f'c{n}@example.com'}).inserted_id
+        links.dbconn[COLLECTION_NAME].insert_one({
+            'clients_id': clients_id, 'contacts_id': contacts_id, 'role': 'Witness', 'active': True,
+            'client_sort': 'Client', 'contact_sort': f'{n:05d}'
+        })
+
+    def round_trips(func) -> tuple:
+        checkouts = pool_stats()['checkouts']
+        started = time.perf_counter()
+        func()
+        return pool_stats()['checkouts'] - checkouts, (time.perf_counter() - started) * 1000
+
+    def per_row():
+        for link in links.dbconn[COLLECTION_NAME].find({'clients_id': clients_id}).limit(link_count):
+            link['_client'] = links.dbconn['clients'].find_one({'_id': link['clients_id']})
+            link['_contact'] = links.dbconn['contacts'].find_one({'_id': link['contacts_id']})
+
+    def batched():
+        links.get_list('bench@example.com', str(clients_id), page_size=link_count)
+
+    for label, func in [('per-row', per_row), ('batched', batched)]:
+        queries, elapsed_ms = round_trips(func)
+        print(f"{label:8} {link_count} rows: {queries:4} queries {elapsed_ms:8.1f}ms")
+
+    for name in [COLLECTION_NAME, 'clients', 'contacts']:
+        links.dbconn[name].drop()
+
+
+if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        args = [a for a in sys.argv[1:] if not a.startswith('--')]
+        _benchmark(int(args[0]) if args else 50)
@@ -5,14 +5,17 @@ db_contacts.py - Class for access our persistent data store for contacts.
 @version 0.0.1
 Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 """
+from datetime import datetime
 import json  # noqa
 import os
 from pymongo import ASCENDING
 from bson.objectid import ObjectId
-import pandas as pd
 
 from util.logger import get_logger
-from util.database import Database, normalize_telephone_number
+from util.contact_typeahead import TYPEAHEAD, PROJECTION as TYPEAHEAD_PROJECTION
+from util.database import Database, keyset_page, normalize_telephone_number
+from util.export_engine import stream_export, with_total
+from util.export_profiles import CONTACT_LIST, ExportProfile
 try:
     DB_URL = os.environ["DB_URL"]
 except KeyError as e:
@@ -23,6 +26,12 @@ except KeyError as e:
 
 COLLECTION_NAME = 'contacts'
 
+LIST_ORDER = [
+    ('name.last_name', ASCENDING),
+    ('name.first_name', ASCENDING),
+    ('organization', ASCENDING)
+]
+
 
 class DbContacts(Database):
     """
@@ -40,8 +49,7 @@ class DbContacts(Database):
         """
         contact_id = ObjectId(id)
         try:
-            filter_ = {'_id': contact_id}
-            document = self.dbconn[COLLECTION_NAME].find_one(filter_)
+            document = self.find_by_id(COLLECTION_NAME, contact_id)
         except Exception as e:
             self.logger.error("Error retrieving contact: %s", str(e))
             return None
@@ -52,6 +60,18 @@ class DbContacts(Database):
             document['_case_count'] = case_count
         return document
 
+    def get_many(self, ids: list) -> dict:
+        """
+        Return the contact records with the given IDs in one query.
+
+        Args:
+            ids (list): Contact IDs, as strings or ObjectIds
+        Returns:
+            (dict): The located documents, keyed by _id
+        """
+        filter_ = {'_id': {'$in': [ObjectId(id) for id in ids]}}
+        return {doc['_id']: doc for doc in self.dbconn[COLLECTION_NAME].find(filter_)}
+
     def get_list(self, email: str, where: dict = {}, page_num: int = 1, page_size: int = 25, client_id: str = None) -> list:
         """
         Retrieve a list of contacts viewable by this admin user.
@@ -68,63 +88,59 @@ class DbContacts(Database):
         """
 
         skips = page_size * (page_num - 1)
-
-        order_by = [
-            ('name.last_name', ASCENDING),
-            ('name.first_name', ASCENDING),
-            ('organization', ASCENDING)
-        ]
-
-        if where and client_id:
-            where = {
-                '$and': [
-                    where,
-                    {'linked_client_ids': {'$elemMatch': {'$eq': ObjectId(client_id)}}}
-                ]
-            }
-        elif where and not client_id:
-            pass
-
-        elif client_id and not where:
-            where = {'linked_client_ids': {'$elemMatch': {'$eq': ObjectId(client_id)}}}
-        else:
-            where = {}
-
-        contacts = self.dbconn[COLLECTION_NAME].find(where).sort(order_by).skip(skips).limit(page_size)
+        where = _list_filter(where, client_id)
+        contacts = self.dbconn[COLLECTION_NAME].find(where).sort(LIST_ORDER).skip(skips).limit(page_size)
 
         if not contacts:
             return None
 
         return list(contacts)
 
-    def get_list_as_csv(self, email: str, client_id=None) -> str:
-        """
-        Return the client list as a CSV string.
+    def get_page(self, email: str, where: dict = None, after: str = None, before: str = None, page_size: int = 25, client_id: str = None) -> dict:
         """
-        if not client_id:
-            client_id = None
-        documents = self.get_list(email, client_id=client_id)
+        Retrieve a page of contacts using cursor pagination. See keyset_page().
 
-        # Break out compound fields into individual columns
-        for document in documents:
-            name = document.get('name', {})
-            for key, value in name.items():
-                document[key] = value
-            address = document.get('address', {})
-            for key, value in address.items():
-                document[key] = value
+        Args:
+            email (str): Email address of admin user.
+            where (dict): Filter
+            after (str): 'next' token from the previous page
+            before (str): 'prev' token from the following page
+            page_size (int): Number of documents per page (default=25)
+            client_id (str): If provided, will filter for this client_id
+        Returns:
+            (dict): 'items' is the list of contacts, 'next' and 'prev' are page tokens or None.
+        """
+        filter_ = _list_filter(where, client_id)
+        return keyset_page(self.dbconn[COLLECTION_NAME], filter_, LIST_ORDER, after=after, before=before, page_size=page_size)
 
-        contacts = _to_dataframe(documents)
+    def get_list_as_csv(self, email: str, client_id=None, profile: ExportProfile = CONTACT_LIST):
+        """
+        Generate the contact list as CSV text, streamed from the database.
+        See get_list_export().
+        """
+        return self.get_list_export(email, 'csv', client_id=client_id, profile=profile)
 
-        # Drop columns that don't need to be downloaded
-        contacts = contacts.drop(
-            columns=[
-                '_id', 'name', 'address', 'linked_client_ids'
-            ])
+    def get_list_export(self, email: str, fmt: str, client_id=None, profile: ExportProfile = CONTACT_LIST, progress=None):
+        """
+        Generate the contact list in format *fmt*, streamed from the database.
+        See export_engine.stream_export().
 
-        # Create and return CSV file.
-        csv_export = contacts.to_csv(sep=",")
-        return csv_export
+        Args:
+            email (str): Email address of user who requested the export
+            fmt (str): 'csv', 'parquet' or 'xlsx'
+            client_id (str): If provided, only export this client's contacts
+            profile (ExportProfile): Columns to export (default=CONTACT_LIST)
+            progress (callable): Called with (rows written, total rows) as the export proceeds (optional)
+        """
+        if not client_id:
+            client_id = None
+        collection = self.dbconn[COLLECTION_NAME]
+        filter_ = _list_filter({}, client_id)
+        return stream_export(
+            fmt, collection, filter_, profile,
+            order_by=LIST_ORDER,
+            progress=with_total(progress, collection, filter_)
+        )
 
     def get_contact_name(self, contact_id, include_title: bool = True) -> str:
         """
@@ -199,6 +215,9 @@ class DbContacts(Database):
         if 'email' in doc:
             doc['email'] = doc['email'].strip().lower()
 
+        # Lets other processes find this change when refreshing their typeahead index
+        doc['last_edit_date'] = datetime.now()
+
         # Insert new contact record
         if doc.get('_id', '0') in ['0', '']:
             if '_id' in doc:
@@ -207,6 +226,7 @@ class DbContacts(Database):
 
             result = self.dbconn[COLLECTION_NAME].insert_one(doc)
             if result.inserted_id:
+                TYPEAHEAD.update(doc)
                 message = f"Contact record added for {contact_name}"
                 return {'success': True, 'message': message}
             message = "Failed to add new contact record"
@@ -216,7 +236,11 @@ class DbContacts(Database):
         filter_ = {'_id': ObjectId(doc['_id'])}
         del doc['_id']
         result = self.dbconn[COLLECTION_NAME].update_one(filter_, {'$set': doc})
+        self.remember(COLLECTION_NAME, filter_['_id'], doc)
         if result.modified_count == 1:
+            contact = self.dbconn[COLLECTION_NAME].find_one(filter_, TYPEAHEAD_PROJECTION)
+            if contact:
+                TYPEAHEAD.update(contact)
             message = f"{contact_name}'s record updated"
             return {'success': True, 'message': message}
 
@@ -224,6 +248,24 @@ class DbContacts(Database):
         return {'success': False, 'message': message}
 
 
+def _list_filter(where: dict, client_id: str) -> dict:
+    """
+    Combine a caller's filter with the optional client_id filter for get_list() and get_page().
+    """
+    if where and client_id:
+        return {
+            '$and': [
+                where,
+                {'linked_client_ids': {'$elemMatch': {'$eq': ObjectId(client_id)}}}
+            ]
+        }
+    if where:
+        return where
+    if client_id:
+        return {'linked_client_ids': {'$elemMatch': {'$eq': ObjectId(client_id)}}}
+    return {}
+
+
 def make_contact_name(contact: dict, include_title: bool = True) -> str:
     """
     Create a contact_name string from parts.
@@ -242,19 +284,3 @@ def make_contact_name(contact: dict, include_title: bool = True) -> str:
     else:
         first_index = 1
     return " ".join(list(contact['name'].values())[first_index:-1]).strip()
-
-
-
-def _to_dataframe(documents: dict):
-    """
-    Convert result set to dataframe.
-    """
-    contacts = pd.DataFrame(columns=[])
-    # pylint: disable=unused-variable
-    for num, contact in enumerate(documents):
-        # pylint: enable=unused-variable
-        contact_id = str(contact['_id'])
-        contact['_id'] = contact_id
-        series_obj = pd.Series(contact, name=contact_id)
-        contacts = contacts.append(series_obj)
-    return contacts
@@ -0,0 +1,311 @@
+"""
+db_indexes.py - Declarative index catalog for our collections.
+
+do_upgrades() calls reconcile_indexes() at startup to create any index in
+the catalog that is missing and to report indexes that look unused or
+redundant. Run this module directly to check that every repository query
+is served by an index:
+
+    python -m util.db_indexes --verify
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from datetime import datetime
+import sys
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+from util.database import Database, DB_NAME
+from util.logger import get_logger
+from util.search_tokens import prefix_range
+
+DISCOVERY_DB_NAME = 'discoverybot'
+QUEUE_DB_NAME = 'task_queue'
+
+# (database name, collection name) -> list of indexes we expect to exist.
+INDEX_CATALOG = {
+    (DB_NAME, 'clients'): [
+        {
+            'name': 'admin_users_list',
+            'keys': [
+                ('admin_users', ASCENDING),
+                ('active_flag', ASCENDING),
+                ('crm_state', ASCENDING),
+                ('name.last_name', ASCENDING),
+                ('name.first_name', ASCENDING),
+                ('email', ASCENDING)
+            ]
+        },
+        {'name': 'ssn_dl', 'keys': [('client_ssn', ASCENDING), ('client_dl', ASCENDING)]},
+        {'name': 'billing_id', 'keys': [('billing_id', ASCENDING)]},
+    ],
+    (DB_NAME, 'client_search'): [
+        {'name': 'admin_users_terms', 'keys': [('admin_users', ASCENDING), ('terms', ASCENDING)]},
+    ],
+    (DB_NAME, 'notes'): [
+        {'name': 'clients_id_created_id', 'keys': [('clients_id', ASCENDING), ('created_date', DESCENDING), ('_id', ASCENDING)]},
+    ],
+    (DB_NAME, 'notes_index'): [
+        {'name': 'clients_id_terms', 'keys': [('clients_id', ASCENDING), ('terms', ASCENDING)]},
+    ],
+    (DB_NAME, 'clients_contacts'): [
+        {'name': 'clients_contacts_link', 'keys': [('clients_id', ASCENDING), ('contacts_id', ASCENDING)]},
+        {
+            'name': 'clients_contacts_list_id',
+            'keys': [('clients_id', ASCENDING), ('active', ASCENDING), ('contact_sort', ASCENDING), ('_id', ASCENDING)]
+        },
+        {
+            'name': 'contacts_clients_list_id',
+            'keys': [('contacts_id', ASCENDING), ('client_sort', ASCENDING), ('_id', ASCENDING)]
+        },
+    ],
+    (DB_NAME, 'contacts'): [
+        {
+            'name': 'contacts_list_id',
+            'keys': [
+                ('name.last_name', ASCENDING),
+                ('name.first_name', ASCENDING),
+                ('organization', ASCENDING),
+                ('_id', ASCENDING)
+            ]
+        },
+        {
+            'name': 'linked_client_ids_list_id',
+            'keys': [
+                ('linked_client_ids', ASCENDING),
+                ('name.last_name', ASCENDING),
+                ('name.first_name', ASCENDING),
+                ('organization', ASCENDING),
+                ('_id', ASCENDING)
+            ]
+        },
+        {'name': 'last_edit_date', 'keys': [('last_edit_date', ASCENDING)]},
+    ],
+    (DB_NAME, 'intakes'): [
+        {'name': 'entry_number_id', 'keys': [('entry_number', DESCENDING), ('_id', ASCENDING)]},
+    ],
+    (DB_NAME, 'admins'): [
+        {'name': 'email', 'keys': [('email', ASCENDING)]},
+    ],
+    (DISCOVERY_DB_NAME, 'discovery_requests'): [
+        {'name': 'client_id_time_id', 'keys': [('client_id', ASCENDING), ('time', DESCENDING), ('_id', ASCENDING)]},
+    ],
+    (QUEUE_DB_NAME, 'task_queue'): [
+        {'name': 'status_type_created', 'keys': [('status', ASCENDING), ('task_type', ASCENDING), ('created', ASCENDING)]},
+    ],
+}
+
+# Representative versions of the queries our repositories issue. Each entry is
+# (label, database name, collection name, filter, sort).
+_ID = ObjectId('000000000000000000000000')
+QUERY_CATALOG = [
+    (
+        'DbClients.get_list', DB_NAME, 'clients',
+        {'$and': [
+            {'admin_users': {'$elemMatch': {'$eq': 'user@example.com'}}},
+            {'active_flag': {'$eq': 'Y'}},
+            {'crm_state': {'$eq': '070:retained_active'}}
+        ]},
+        [('crm_state', ASCENDING), ('name.last_name', ASCENDING), ('name.first_name', ASCENDING), ('email', ASCENDING)]
+    ),
+    (
+        'DbClientSearch.search', DB_NAME, 'client_search',
+        {'$and': [
+            {'admin_users': 'user@example.com'},
+            {'$or': [{'terms': {'$elemMatch': prefix_range('smith')}}]},
+            {'active_flag': 'Y'}
+        ]},
+        None
+    ),
+    ('DbClients.get_by_ssn', DB_NAME, 'clients', {'client_ssn': '123', 'client_dl': '456'}, None),
+    ('DbClients.get_by_billing_id', DB_NAME, 'clients', {'billing_id': '9999'}, None),
+    ('DbClientNotes.get_list', DB_NAME, 'notes', {'clients_id': _ID}, [('created_date', DESCENDING)]),
+    (
+        'DbNoteIndex.search', DB_NAME, 'notes_index',
+        {'clients_id': _ID, '$or': [{'terms': {'$elemMatch': prefix_range('hearing')}}]},
+        None
+    ),
+    ('DbClientNotes.has_any', DB_NAME, 'notes', {'clients_id': _ID}, None),
+    ('DbClientNotes.clients_having_any', DB_NAME, 'notes', {'clients_id': {'$in': [_ID]}}, None),
+    (
+        'DbClientDiscovery.get_list', DISCOVERY_DB_NAME, 'discovery_requests',
+        {'client_id': _ID}, [('time', DESCENDING)]
+    ),
+    ('DbClientDiscovery.has_any', DISCOVERY_DB_NAME, 'discovery_requests', {'client_id': _ID}, None),
+    (
+        'DbClientDiscovery.clients_having_any', DISCOVERY_DB_NAME, 'discovery_requests',
+        {'client_id': {'$in': [_ID]}}, None
+    ),
+    (
+        'DbClientsContacts.get_list', DB_NAME, 'clients_contacts',
+        {'clients_id': _ID, 'active': True}, [('contact_sort', ASCENDING)]
+    ),
+    (
+        'DbClientsContacts.get_clients', DB_NAME, 'clients_contacts',
+        {'contacts_id': _ID}, [('client_sort', ASCENDING)]
+    ),
+    ('DbClientsContacts.get_link', DB_NAME, 'clients_contacts', {'clients_id': _ID, 'contacts_id': _ID}, None),
+    (
+        'DbContacts.get_list', DB_NAME, 'contacts', {},
+        [('name.last_name', ASCENDING), ('name.first_name', ASCENDING), ('organization', ASCENDING)]
+    ),
+    (
+        'DbContacts.get_list(client_id)', DB_NAME, 'contacts',
+        {'linked_client_ids': {'$elemMatch': {'$eq': _ID}}},
+        [('name.last_name', ASCENDING), ('name.first_name', ASCENDING), ('organization', ASCENDING)]
+    ),
+    (
+        'ContactTypeahead refresh', DB_NAME, 'contacts',
+        {'last_edit_date': {'$gt': datetime(2020, 1, 1)}}, None
+    ),
+    (
+        'DbClientNotes.get_page', DB_NAME, 'notes',
+        {'clients_id': _ID}, [('created_date', DESCENDING), ('_id', ASCENDING)]
+    ),
+    (
+        'DbContacts.get_page', DB_NAME, 'contacts', {},
+        [('name.last_name', ASCENDING), ('name.first_name', ASCENDING), ('organization', ASCENDING), ('_id', ASCENDING)]
+    ),
+    (
+        'DbClientsContacts.get_list_page', DB_NAME, 'clients_contacts',
+        {'clients_id': _ID, 'active': True}, [('contact_sort', ASCENDING), ('_id', ASCENDING)]
+    ),
+    (
+        'DbClientDiscovery.get_page', DISCOVERY_DB_NAME, 'discovery_requests',
+        {'client_id': _ID}, [('time', DESCENDING), ('_id', ASCENDING)]
+    ),
+    ('DbIntakes.get_page', DB_NAME, 'intakes', {}, [('entry_number', DESCENDING), ('_id', ASCENDING)]),
+    ('DbIntakes.get_one', DB_NAME, 'intakes', {'entry_number': 1}, None),
+    ('DbIntakes.get_list', DB_NAME, 'intakes', {}, [('entry_number', DESCENDING)]),
+    ('DbAdmins.admin_record', DB_NAME, 'admins', {'email': 'user@example.com'}, None),
+    (
+        'DbQueue.claim_next', QUEUE_DB_NAME, 'task_queue',
+        {'status': 'queued', 'task_type': {'$in': ['export', 'evergreen']}}, [('created', ASCENDING)]
+    ),
+]
+
+
+def reconcile_indexes() -> dict:
+    """
+    Create missing catalog indexes and report the ones we may not need.
+
+    Nothing is ever dropped here. Indexes that are not in the catalog, that
+    have not been used since the server started, or whose keys are a prefix
+    of another index on the same collection are logged for a human to review.
+
+    Returns:
+        (dict): Lists of 'created', 'unmanaged', 'unused', and 'redundant' index names,
+                each prefixed with the namespace.
+    """
+    logger = get_logger('db_indexes')
+    report = {'created': [], 'unmanaged': [], 'unused': [], 'redundant': []}
+
+    for (db_name, collection_name), specs in INDEX_CATALOG.items():
+        namespace = f'{db_name}.{collection_name}'
+        try:
+            collection = Database(db_name).dbconn[collection_name]
+            existing = {name: _key_tuple(info['key']) for name, info in collection.index_information().items()}
+        except Exception as e:
+            logger.error("Unable to read indexes for %s: %s", namespace, e)
+            continue
+
+        existing_keys = set(existing.values())
+        missing = [spec for spec in specs if _key_tuple(spec['keys']) not in existing_keys]
+        if missing:
+            try:
+                created = collection.create_indexes([IndexModel(spec['keys'], name=spec['name']) for spec in missing])
+                report['created'] += [f'{namespace}.{name}' for name in created]
+                logger.info("Created indexes on %s: %s", namespace, ', '.join(created))
+                existing = {name: _key_tuple(info['key']) for name, info in collection.index_information().items()}
+            except Exception as e:
+                logger.error("Unable to create indexes on %s: %s", namespace, e)
+
+        managed = {_key_tuple(spec['keys']) for spec in specs}
+        for name, keys in existing.items():
+            if name == '_id_':
+                continue
+            if keys not in managed:
+                report['unmanaged'].append(f'{namespace}.{name}')
+            for other_name, other_keys in existing.items():
+                if other_name != name and len(keys) < len(other_keys) and other_keys[:len(keys)] == keys:
+                    report['redundant'].append(f'{namespace}.{name} (prefix of {other_name})')
+                    break
+
+        report['unused'] += [f'{namespace}.{name}' for name in _unused_indexes(collection)]
+
+    for key in ['unmanaged', 'unused', 'redundant']:
+        if report[key]:
+            logger.warning("Indexes to review (%s): %s", key, ', '.join(report[key]))
+    return report
+
+
+def verify_query_plans() -> list:
+    """
+    Run explain() on each query in QUERY_CATALOG.
+
+    Returns:
+        (list): One dict per query whose winning plan includes a COLLSCAN stage.
+                An empty list means every query is served by an index.
+    """
+    failures = []
+    for label, db_name, collection_name, filter_, sort in QUERY_CATALOG:
+        cursor = Database(db_name).dbconn[collection_name].find(filter_)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = cursor.limit(25).explain()
+        stages = _plan_stages(plan.get('queryPlanner', {}).get('winningPlan', {}))
+        if 'COLLSCAN' in stages:
+            failures.append({'query': label, 'namespace': f'{db_name}.{collection_name}', 'stages': stages})
+    return failures
+
+
+def _unused_indexes(collection) -> list:
+    """
+    Names of indexes on *collection* that $indexStats says have never been used.
+    Counters reset when mongod restarts, so treat this as a hint.
+    """
+    try:
+        stats = collection.aggregate([{'$indexStats': {}}])
+        return [s['name'] for s in stats if s['name'] != '_id_' and s.get('accesses', {}).get('ops', 0) == 0]
+    except Exception as e:
+        get_logger('db_indexes').debug("$indexStats unavailable for %s: %s", collection.full_name, e)
+    return []
+
+
+def _key_tuple(keys) -> tuple:
+    """
+    Normalize an index key spec, e.g. SON or list of (field, direction), to a hashable tuple.
+    """
+    if isinstance(keys, dict):
+        keys = keys.items()
+    return tuple((field, int(direction) if isinstance(direction, (int, float)) else direction) for field, direction in keys)
+
+
+def _plan_stages(plan) -> list:
+    """
+    Collect every 'stage' name in an explain() plan tree.
+    """
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages += _plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += _plan_stages(value)
+    return stages
+
+
+if __name__ == '__main__':
+    print(reconcile_indexes())
+    if '--verify' in sys.argv:
+        problems = verify_query_plans()
+        for problem in problems:
+            print(f"COLLSCAN: {problem['query']} on {problem['namespace']} ({' > '.join(problem['stages'])})")
+        if problems:
+            sys.exit(1)
+        print("All repository queries are served by indexes.")
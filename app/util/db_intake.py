@@ -8,7 +8,7 @@ Copyright (c) 2020 by Thomas J. Daley, J.D. All Rights Reserved.
 import json  # noqa
 from pymongo import DESCENDING
 
-from util.database import Database
+from util.database import Database, keyset_page
 from util.logger import get_logger
 
 COLLECTION_NAME = 'intakes'
@@ -57,6 +57,21 @@ class DbIntakes(Database):
 
         return list(intakes)
 
+    def get_page(self, where: dict = None, after: str = None, before: str = None, page_size: int = 25) -> dict:
+        """
+        Retrieve a page of intake entries using cursor pagination. See keyset_page().
+
+        Args:
+            where (dict): Filter
+            after (str): 'next' token from the previous page
+            before (str): 'prev' token from the following page
+            page_size (int): Number of documents per page (default=25)
+        Returns:
+            (dict): 'items' is the list of intakes, 'next' and 'prev' are page tokens or None.
+        """
+        order_by = [('entry_number', DESCENDING)]
+        return keyset_page(self.dbconn[COLLECTION_NAME], where or {}, order_by, after=after, before=before, page_size=page_size)
+
     def search(self, query: str, page_num: int = 1, page_size: int = 25) -> list:
         """
         Search for intakes matching the words in *query*.
@@ -0,0 +1,302 @@
+"""
+db_note_index.py - Inverted index over client notes.
+
+Each note has one document in the notes_index collection listing the
+normalized terms in its text, how often each occurs and where it first
+occurs, plus its normalized tags. DbClientNotes.save() keeps it current.
+Searches read only these small documents to rank notes and count tags,
+then ask the server for a short excerpt of each note on the page.
+
+Run this module directly to rebuild the index from the notes collection:
+
+    python -m util.db_note_index --rebuild
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import math
+import re
+import sys
+
+from bson.objectid import ObjectId
+from markupsafe import Markup, escape
+from pymongo import ReplaceOne
+
+from util.database import Database, DB_NAME
+from util.logger import get_logger
+import util.search_tokens as TOKENS
+
+COLLECTION_NAME = 'notes_index'
+NOTES_COLLECTION_NAME = 'notes'
+
+# Points added to a note's score for each query word that matches one of its tags.
+TAG_BOOST = 2.0
+
+# Size of the excerpt returned for each note, in characters, and how much of
+# it comes before the first matching word.
+SNIPPET_LENGTH = 240
+SNIPPET_LEAD = 60
+
+_CHUNKS = re.compile(r'\S+')
+_WORDS = re.compile(r'[^\W_]+')
+_TAG_SEPARATORS = re.compile(r'[,;#]+')
+
+
+class DbNoteIndex(Database):
+    """
+    Encapsulates a database accessor for the notes search index.
+    """
+    def __init__(self, db_name: str = DB_NAME):
+        super().__init__(db_name)
+        self.logger = get_logger('db_note_index')
+
+    def index_note(self, note: dict):
+        """
+        Add or refresh the index entry for one note document.
+        """
+        entry = index_entry(note)
+        self.dbconn[COLLECTION_NAME].replace_one({'_id': entry['_id']}, entry, upsert=True)
+
+    def remove_note(self, note_id):
+        """
+        Remove a note from the index.
+        """
+        self.dbconn[COLLECTION_NAME].delete_one({'_id': ObjectId(note_id)})
+
+    def search(self, clients_id: str, query: str, tag: str = None, page_num: int = 1, page_size: int = 25) -> dict:
+        """
+        Rank a client's notes against the words in *query*.
+
+        A note matches when its text or tags have a term that starts with
+        any of the query words. Notes are ranked by tf-idf, so rarer words
+        count for more, with a boost for words that match a tag. Ties go to
+        the newer note.
+
+        Args:
+            clients_id (str): ID of client whose notes are searched
+            query (str): Query string from user
+            tag (str): Only include notes having this tag (optional)
+            page_num (int): Which page number is going to be displayed? (default=1)
+            page_size (int): Number of documents per page (default=25)
+        Returns:
+            (dict): 'ids' is the list of note ObjectIds on the requested page, in rank order,
+                    'total' is the number of matching notes, 'tags' maps each tag on a
+                    matching note to the number of matching notes having it, and 'words'
+                    is the list of normalized query words.
+        """
+        words = TOKENS.query_terms(query)
+        result = {'ids': [], 'total': 0, 'tags': {}, 'words': words}
+        if not words:
+            return result
+
+        collection = self.dbconn[COLLECTION_NAME]
+        clients_id = ObjectId(clients_id)
+        filter_ = {
+            'clients_id': clients_id,
+            '$or': [{'terms': {'$elemMatch': TOKENS.prefix_range(word)}} for word in words]
+        }
+        projection = {'tf': 1, 'tags': 1, 'created_date': 1}
+        candidates = list(collection.find(filter_, projection))
+        if not candidates:
+            return result
+
+        # Matching terms per candidate per word, and the document frequency of each word.
+        matches = []
+        doc_freq = {word: 0 for word in words}
+        for candidate in candidates:
+            by_word = {}
+            for word in words:
+                hits = [(term, count) for term, count in candidate.get('tf', {}).items() if term.startswith(word)]
+                tag_hit = any(t.startswith(word) for t in candidate.get('tags', []))
+                if hits or tag_hit:
+                    by_word[word] = (hits, tag_hit)
+                    doc_freq[word] += 1
+            matches.append(by_word)
+
+        for candidate in candidates:
+            for t in candidate.get('tags', []):
+                result['tags'][t] = result['tags'].get(t, 0) + 1
+
+        if tag:
+            tag = TOKENS.compact(tag)
+            pairs = [(c, m) for c, m in zip(candidates, matches) if tag in c.get('tags', [])]
+        else:
+            pairs = list(zip(candidates, matches))
+
+        note_count = collection.count_documents({'clients_id': clients_id})
+        ranked = []
+        for candidate, by_word in pairs:
+            score = 0.0
+            for word, (hits, tag_hit) in by_word.items():
+                idf = math.log(1 + note_count / doc_freq[word])
+                score += sum(1 + math.log(count) for _, count in hits) * idf
+                if tag_hit:
+                    score += TAG_BOOST * idf
+            created = candidate.get('created_date')
+            ranked.append((-score, -(created.timestamp() if created else 0), candidate['_id']))
+        ranked.sort()
+
+        skips = page_size * (max(page_num, 1) - 1)
+        result['ids'] = [r[2] for r in ranked[skips:skips + page_size]]
+        result['total'] = len(ranked)
+        return result
+
+    def snippets(self, note_ids: list, words: list) -> list:
+        """
+        Fetch the notes in *note_ids*, in that order, with an excerpt of each
+        note's text around the first matching word in place of the full text.
+
+        Args:
+            note_ids (list): ObjectIds of notes to fetch
+            words (list): Normalized query words to highlight
+        Returns:
+            (list): Note documents without 'text' and with '_snippet', a Markup string.
+        """
+        if not note_ids:
+            return []
+
+        entries = self.dbconn[COLLECTION_NAME].find({'_id': {'$in': note_ids}}, {'first': 1})
+        starts = {entry['_id']: _snippet_start(entry.get('first', {}), words) for entry in entries}
+        start_list = [starts.get(_id, 0) for _id in note_ids]
+
+        pipeline = [
+            {'$match': {'_id': {'$in': note_ids}}},
+            {'$project': {
+                'clients_id': 1,
+                'created_by': 1,
+                'created_date': 1,
+                'tags': 1,
+                'snippet': {
+                    '$substrCP': [
+                        {'$ifNull': ['$text', '']},
+                        {'$arrayElemAt': [start_list, {'$indexOfArray': [note_ids, '$_id']}]},
+                        SNIPPET_LENGTH
+                    ]
+                },
+                'text_length': {'$strLenCP': {'$ifNull': ['$text', '']}}
+            }}
+        ]
+        notes = {note['_id']: note for note in self.dbconn[NOTES_COLLECTION_NAME].aggregate(pipeline)}
+
+        result = []
+        for _id, start in zip(note_ids, start_list):
+            note = notes.get(_id)
+            if not note:
+                continue
+            prefix = '…' if start > 0 else ''
+            suffix = '…' if start + SNIPPET_LENGTH < note.pop('text_length') else ''
+            note['_snippet'] = Markup(prefix) + highlight(note.pop('snippet'), words) + Markup(suffix)
+            result.append(note)
+        return result
+
+    def rebuild(self, batch_size: int = 500) -> int:
+        """
+        Rebuild the index from the notes collection.
+
+        Returns:
+            (int): Number of notes indexed.
+        """
+        count = 0
+        batch = []
+        seen = []
+        projection = {'clients_id': 1, 'text': 1, 'tags': 1, 'created_date': 1}
+        for note in self.dbconn[NOTES_COLLECTION_NAME].find({}, projection).batch_size(batch_size):
+            entry = index_entry(note)
+            batch.append(ReplaceOne({'_id': entry['_id']}, entry, upsert=True))
+            seen.append(entry['_id'])
+            if len(batch) >= batch_size:
+                self.dbconn[COLLECTION_NAME].bulk_write(batch, ordered=False)
+                count += len(batch)
+                batch = []
+        if batch:
+            self.dbconn[COLLECTION_NAME].bulk_write(batch, ordered=False)
+            count += len(batch)
+
+        # Remove entries for notes that no longer exist.
+        self.dbconn[COLLECTION_NAME].delete_many({'_id': {'$nin': seen}})
+        self.logger.info("Indexed %s notes for search", count)
+        return count
+
+    def ensure_built(self):
+        """
+        Build the index if it has never been built, e.g. right after this upgrade is deployed.
+        """
+        if self.dbconn[COLLECTION_NAME].estimated_document_count() == 0 \
+                and self.dbconn[NOTES_COLLECTION_NAME].estimated_document_count() > 0:
+            self.rebuild()
+
+
+def index_entry(note: dict) -> dict:
+    """
+    Build the notes_index document for a note document.
+
+    'tf' maps each term to the number of times it occurs in the note's text
+    and 'first' maps it to the character offset where it first occurs.
+    """
+    tf = {}
+    first = {}
+    for chunk in _CHUNKS.finditer(note.get('text') or ''):
+        for term in TOKENS.terms(chunk.group()):
+            tf[term] = tf.get(term, 0) + 1
+            first.setdefault(term, chunk.start())
+
+    tags = tag_terms(note.get('tags'))
+    return {
+        '_id': note['_id'],
+        'clients_id': ObjectId(note['clients_id']),
+        'created_date': note.get('created_date'),
+        'terms': sorted(set(tf) | set(tags)),
+        'tf': tf,
+        'first': first,
+        'tags': tags
+    }
+
+
+def tag_terms(tags) -> list:
+    """
+    Normalize a note's tags, e.g. 'Billing, Court Date' -> ['billing', 'courtdate'].
+    Tags are stored as the free text the user typed, separated by commas.
+    """
+    if isinstance(tags, list):
+        tags = ','.join(str(t) for t in tags)
+    result = []
+    for tag in _TAG_SEPARATORS.split(tags or ''):
+        term = TOKENS.compact(tag)
+        if term and term not in result:
+            result.append(term)
+    return result
+
+
+def highlight(text: str, words: list) -> Markup:
+    """
+    HTML-escape *text*, wrap each word that starts with a query word in <mark>
+    and turn newlines into <br />.
+    """
+    result = Markup('')
+    position = 0
+    for match in _WORDS.finditer(text):
+        term = TOKENS.compact(match.group())
+        if any(term.startswith(word) for word in words):
+            result += escape(text[position:match.start()])
+            result += Markup('<mark>') + escape(match.group()) + Markup('</mark>')
+            position = match.end()
+    result += escape(text[position:])
+    return result.replace('\n', Markup('<br />'))
+
+
+def _snippet_start(first: dict, words: list) -> int:
+    """
+    Where a note's excerpt should begin: a little before the earliest term matching a query word.
+    """
+    offsets = [offset for term, offset in first.items() if any(term.startswith(word) for word in words)]
+    if not offsets:
+        return 0
+    return max(min(offsets) - SNIPPET_LEAD, 0)
+
+
+if __name__ == '__main__':
+    if '--rebuild' in sys.argv:
+        DbNoteIndex().rebuild()
+    else:
+        print(__doc__)
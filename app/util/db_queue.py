@@ -5,7 +5,10 @@ db_queue.py - Class for access our task queue collection.
 @version 0.0.1
 Copyright (c) 2023 by Thomas J. Daley, J.D. All Rights Reserved.
 """
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, ReturnDocument
 
 from util.database import Database
 from util.logger import get_logger
@@ -13,6 +16,15 @@ from util.logger import get_logger
 
 COLLECTION_NAME = 'task_queue'
 
+# Task status values
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Times a task may be claimed before requeue_stale() gives up on it.
+MAX_ATTEMPTS = 3
+
 
 class DbQueue(Database):
     """
@@ -48,3 +60,195 @@ class DbQueue(Database):
         if result.inserted_id:
             return {'success': True, 'message': 'Image conversion task queued'}
         return {'success': False, 'message': 'Failed to queue image conversion task'}
+
+    def queue_export(self, user_email: str, list_name: str, fmt: str, params: dict = None) -> dict:
+        """
+        Queue an export of a client or contact list for the worker process.
+
+        Args:
+            user_email (str): Email of user requesting the export
+            list_name (str): 'clients' or 'contacts'
+            fmt (str): 'csv', 'parquet' or 'xlsx'
+            params (dict): Arguments for the list's get_list_export(), e.g. client_id
+        Returns:
+            (dict): success, message and, if queued, task_id
+        """
+        doc = {
+            'task_type': 'export',
+            'list_name': list_name,
+            'format': fmt,
+            'user_email': user_email,
+            'params': params or {},
+        }
+        return self._queue(doc, 'Export')
+
+    def queue_letters(self, user_email: str, list_name: str, params: dict = None) -> dict:
+        """
+        Queue a bulk letter run, one merged letter per recipient, for the worker process.
+
+        Args:
+            user_email (str): Email of user requesting the letters
+            list_name (str): 'clients' or 'contacts'
+            params (dict): Recipient selection, e.g. crm_state for clients or client_id for contacts
+        Returns:
+            (dict): success, message and, if queued, task_id
+        """
+        doc = {
+            'task_type': 'letters',
+            'list_name': list_name,
+            'user_email': user_email,
+            'params': params or {},
+        }
+        return self._queue(doc, 'Letters')
+
+    def queue_evergreen(self, user_email: str) -> dict:
+        """
+        Queue an evergreen letter run for the worker process.
+
+        Args:
+            user_email (str): Email of user sending the letters
+        Returns:
+            (dict): success, message and, if queued, task_id
+        """
+        return self._queue({'task_type': 'evergreen', 'user_email': user_email, 'params': {}}, 'Evergreen letters')
+
+    def _queue(self, doc: dict, description: str) -> dict:
+        """
+        Insert a task document with status 'queued'.
+        """
+        doc['status'] = QUEUED
+        doc['progress'] = {}
+        doc['created'] = datetime.now()
+        result = self.dbconn[COLLECTION_NAME].insert_one(doc)
+        if result.inserted_id:
+            return {'success': True, 'message': f'{description} task queued', 'task_id': str(result.inserted_id)}
+        return {'success': False, 'message': f'Failed to queue {description.lower()} task'}
+
+    def get_task(self, task_id: str, user_email: str) -> dict:
+        """
+        Return a task, if it was queued by *user_email*.
+
+        Returns:
+            (dict): The task document or None
+        """
+        try:
+            filter_ = {'_id': ObjectId(task_id), 'user_email': user_email}
+        except Exception:
+            return None
+        return self.dbconn[COLLECTION_NAME].find_one(filter_)
+
+    def claim_next(self, task_types: list, worker_id: str) -> dict:
+        """
+        Atomically take the oldest queued task of one of *task_types* and mark it running.
+        Other task types, e.g. image conversions, are left for their own consumers.
+
+        Args:
+            task_types (list): Task types this worker handles
+            worker_id (str): Identifies the worker in the task document
+        Returns:
+            (dict): The claimed task or None if there is nothing to do
+        """
+        now = datetime.now()
+        return self.dbconn[COLLECTION_NAME].find_one_and_update(
+            {'status': QUEUED, 'task_type': {'$in': task_types}},
+            {'$set': {'status': RUNNING, 'worker': worker_id, 'started': now, 'heartbeat': now}, '$inc': {'attempts': 1}},
+            sort=[('created', ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def update_progress(self, task_id, progress: dict):
+        """
+        Record a running task's progress, which also serves as its heartbeat.
+        """
+        self.dbconn[COLLECTION_NAME].update_one(
+            {'_id': ObjectId(task_id)},
+            {'$set': {'progress': progress, 'heartbeat': datetime.now()}}
+        )
+
+    def finish(self, task_id, worker_id: str, result: dict) -> bool:
+        """
+        Mark a task done and record its result, e.g. the file it produced.
+        See _end().
+        """
+        return self._end(task_id, worker_id, {'status': DONE, 'result': result})
+
+    def fail(self, task_id, worker_id: str, message: str) -> bool:
+        """
+        Mark a task failed. See _end().
+        """
+        return self._end(task_id, worker_id, {'status': FAILED, 'message': message})
+
+    def _end(self, task_id, worker_id: str, update: dict) -> bool:
+        """
+        Record how a task ended, if it is still running and claimed by
+        *worker_id*. A task that housekeeping has since failed or requeued
+        keeps that status.
+
+        Returns:
+            (bool): True if the task was updated
+        """
+        result = self.dbconn[COLLECTION_NAME].update_one(
+            {'_id': ObjectId(task_id), 'status': RUNNING, 'worker': worker_id},
+            {'$set': {**update, 'finished': datetime.now()}}
+        )
+        if not result.modified_count:
+            self.logger.warning("Task %s is no longer running on %s; left it as it is", task_id, worker_id)
+        return bool(result.modified_count)
+
+    def requeue_stale(self, task_types: list, minutes: int = 10, max_attempts: int = MAX_ATTEMPTS) -> int:
+        """
+        Put running tasks whose worker has not reported progress for *minutes*
+        back in the queue, e.g. after a worker was killed mid-task. Tasks that
+        have already been claimed *max_attempts* times are failed instead, so a
+        task that keeps killing its worker is not retried forever.
+
+        Only pass task types that are safe to run twice.
+
+        Returns:
+            (int): Number of tasks requeued
+        """
+        stale = {
+            'status': RUNNING,
+            'task_type': {'$in': task_types},
+            'heartbeat': {'$lt': datetime.now() - timedelta(minutes=minutes)}
+        }
+        self.fail_stale(
+            task_types, minutes,
+            f"Gave up after {max_attempts} attempts; the worker stopped responding each time.",
+            where={'attempts': {'$gte': max_attempts}}
+        )
+        result = self.dbconn[COLLECTION_NAME].update_many(
+            stale,
+            {'$set': {'status': QUEUED}, '$unset': {'worker': ''}}
+        )
+        if result.modified_count:
+            self.logger.warning("Requeued %s stale tasks", result.modified_count)
+        return result.modified_count
+
+    def fail_stale(self, task_types: list, minutes: int, message: str, where: dict = None) -> int:
+        """
+        Mark running tasks whose worker has not reported progress for *minutes* failed.
+        Use this for tasks that must not run twice, e.g. sending email, so that
+        a person can check what was done before running them again.
+
+        Args:
+            task_types (list): Task types to check
+            minutes (int): Minutes without progress after which a task is stale
+            message (str): Why the task failed, shown to its user
+            where (dict): Further filter on the stale tasks (optional)
+        Returns:
+            (int): Number of tasks failed
+        """
+        filter_ = {
+            'status': RUNNING,
+            'task_type': {'$in': task_types},
+            'heartbeat': {'$lt': datetime.now() - timedelta(minutes=minutes)},
+            **(where or {})
+        }
+        result = self.dbconn[COLLECTION_NAME].update_many(
+            filter_,
+            {'$set': {'status': FAILED, 'message': message, 'finished': datetime.now()}, '$unset': {'worker': ''}}
+        )
+        if result.modified_count:
+            self.logger.warning("Failed %s stale tasks: %s", result.modified_count, message)
+        return result.modified_count
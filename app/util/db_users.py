@@ -111,6 +111,7 @@ class DbUsers(Database):
             set_missing_flags(doc, flag_fields)
 
             result = self.dbconn[COLLECTION_NAME].insert_one(doc)
+            DbAdmins.invalidate(doc.get('email'))
             if result.inserted_id:
                 message = f"User record added for {user_name}"
                 return {'success': True, 'message': message}
@@ -123,6 +124,8 @@ class DbUsers(Database):
         # doc['active_flag'] = 'Y'
         set_missing_flags(doc, ['active_flag', 'prompt_on_dial_flag'])
         result = self.dbconn[COLLECTION_NAME].update_one(filter_, {'$set': doc})
+        # The email address itself may have changed, so forget every cached record.
+        DbAdmins.invalidate()
         if result.modified_count == 1:
             message = f"{user_name}'s record updated"
             return {'success': True, 'message': message}
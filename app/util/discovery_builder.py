@@ -0,0 +1,330 @@
+"""
+discovery_builder.py - Build discovery responses, one template section per request.
+
+MailMerge.merge_templates() copies the template body once per request and,
+after each copy, merges that request's fields into every copy made so far,
+so a 500 request set does 125,000 partial merges and holds the whole
+document as an element tree. Here the template body is compiled once per
+template version (see merge_engine.ParsedTemplate.get_derived) into XML text
+with a slot for each merge field. Each request's section is then rendered on
+its own by filling the slots, and the sections are written straight into the
+.docx as they are rendered, so a response of any length streams to the
+browser in constant memory.
+
+Sections are built the way merge_templates() builds them: the first section
+break takes the separator's type, and every request but the last is followed
+by the separator. Fields missing from a request are left empty, rather than
+taking the next request's values as they can with merge_templates().
+
+Time a synthetic request set, optionally against merge_templates(), with:
+
+    python -m util.discovery_builder --benchmark [requests] [--compare]
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from copy import deepcopy
+import re
+import sys
+import time
+from xml.sax.saxutils import escape
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+
+from lxml import etree
+from mailmerge import NAMESPACES
+
+from util.merge_engine import STORED_EXTENSIONS, ParsedTemplate, get_template
+
+SEPARATORS = {
+    'page_break', 'column_break', 'textWrapping_break', 'continuous_section',
+    'evenPage_section', 'nextColumn_section', 'nextPage_section', 'oddPage_section'
+}
+
+# Sections rendered between writes to the response.
+SECTIONS_PER_CHUNK = 25
+
+# Markers placed in the template body while compiling it.
+_START = 'discovery-builder-start'
+_SEPARATOR = 'discovery-builder-separator'
+_END = 'discovery-builder-end'
+_FIELD = 'discovery-builder-field:'
+_FIELD_RE = re.compile(f'<!--{_FIELD}(.*?)-->')
+
+# Characters XML 1.0 does not allow, which would make Word refuse the document.
+_INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+W = '{%(w)s}' % NAMESPACES
+
+
+class SectionTemplate(object):
+    """
+    A template compiled for rendering many sections: the document XML before,
+    between and after the sections, the section body split around its merge
+    fields, and every other package member ready to write.
+    """
+    def __init__(self, template: ParsedTemplate, separator: str = 'continuous_section'):
+        if separator not in SEPARATORS:
+            raise ValueError("Invalid separator argument")
+        break_type, separator_class = separator.split('_')
+        document = template.document()
+        self.filelist = template.filelist
+
+        self.main_info = None
+        for info, part in document.parts.items():
+            if part.getroot().tag == f'{W}document':
+                self.main_info = info
+        if self.main_info is None:
+            raise ValueError("Template has no document body")
+
+        root = document.parts[self.main_info].getroot()
+        body = root.find('w:body', namespaces=NAMESPACES)
+
+        if separator_class == 'section':
+            first_section = body.find('w:p/w:pPr/w:sectPr', namespaces=NAMESPACES)
+            if first_section is None:
+                first_section = body.find('w:sectPr', namespaces=NAMESPACES)
+            typed_section = deepcopy(first_section)
+            for child in list(typed_section):
+                if child.tag == f'{W}type':
+                    typed_section.remove(child)
+            etree.SubElement(typed_section, f'{W}type').set(f'{W}val', break_type)
+            first_section.getparent().replace(first_section, typed_section)
+
+        last_section = body.find('w:sectPr', namespaces=NAMESPACES)
+        body.remove(last_section)
+        if separator_class == 'section':
+            separator_p = etree.Element(f'{W}p')
+            etree.SubElement(separator_p, f'{W}pPr').append(deepcopy(last_section))
+        else:
+            separator_p = etree.Element(f'{W}p')
+            etree.SubElement(etree.SubElement(separator_p, f'{W}r'), f'{W}br').set(f'{W}type', break_type)
+
+        children = list(body)
+        body.clear()
+        body.append(etree.Comment(_START))
+        body.extend(children)
+        body.append(etree.Comment(_SEPARATOR))
+        body.append(separator_p)
+        body.append(etree.Comment(_END))
+        body.append(last_section)
+
+        for field in list(body.iter('MergeField')):
+            _mark_field(field)
+
+        xml = etree.tostring(root).decode()
+        head, rest = xml.split(f'<!--{_START}-->')
+        section, rest = rest.split(f'<!--{_SEPARATOR}-->')
+        between, tail = rest.split(f'<!--{_END}-->')
+        self.head = head.encode()
+        self.separator = between.encode()
+        self.tail = tail.encode()
+        self.pieces = _FIELD_RE.split(section)
+        self.fields = frozenset(self.pieces[1::2])
+
+        prefix = next((p for p, ns in root.nsmap.items() if ns == NAMESPACES['w']), None)
+        self.text_tag = f'{prefix}:t' if prefix else 't'
+        self.break_tag = f'<{prefix}:br/>' if prefix else '<br/>'
+
+        # Only the body is merged, so fields in headers and footers are left empty, as merge_templates() leaves them.
+        others = [part for info, part in document.parts.items() if info is not self.main_info]
+        if others:
+            empty = {field: '' for field in document.get_merge_fields(others)}
+            if empty:
+                document.merge(others, **empty)
+        self.members = {}
+        for info in self.filelist:
+            if info in document.parts and info is not self.main_info:
+                self.members[info.filename] = etree.tostring(document.parts[info].getroot())
+            elif info == document._settings_info:
+                self.members[info.filename] = etree.tostring(document.settings.getroot())
+            elif info is not self.main_info:
+                self.members[info.filename] = template.members[info.filename]
+
+    def render(self, fields: dict) -> str:
+        """
+        One section of the document body, merged with *fields*.
+        """
+        pieces = list(self.pieces)
+        for i in range(1, len(pieces), 2):
+            pieces[i] = self._text(fields.get(pieces[i]))
+        return ''.join(pieces)
+
+    def stream(self, sections: list):
+        """
+        Write a .docx with one section per item in *sections*, yielding it in pieces as it is written.
+
+        Args:
+            sections (list): Merge fields for each section, e.g. the discovery requests
+        Yields:
+            (bytes): The next part of the .docx file
+        """
+        output = _Output()
+        with ZipFile(output, 'w', ZIP_DEFLATED) as docx:
+            for info in self.filelist:
+                if info is self.main_info:
+                    with docx.open(info.filename, 'w') as xml:
+                        xml.write(self.head)
+                        for n, fields in enumerate(sections):
+                            if n:
+                                xml.write(self.separator)
+                            xml.write(self.render(fields).encode())
+                            if n % SECTIONS_PER_CHUNK == SECTIONS_PER_CHUNK - 1:
+                                yield from output.drain()
+                        xml.write(self.tail)
+                elif info.filename.lower().endswith(STORED_EXTENSIONS):
+                    docx.writestr(info.filename, self.members[info.filename], compress_type=ZIP_STORED)
+                else:
+                    docx.writestr(info.filename, self.members[info.filename])
+                yield from output.drain()
+        yield from output.drain()
+
+    def _text(self, value) -> str:
+        """
+        The runs MailMerge would write for *value*: one text element per line, separated by line breaks.
+        """
+        if value is None or isinstance(value, (list, dict)):
+            value = ''
+        lines = _INVALID_XML.sub('', str(value)).replace('\r', '').split('\n')
+        t = self.text_tag
+        return f'<{t}>' + f'</{t}>{self.break_tag}<{t}>'.join(escape(line) for line in lines) + f'</{t}>'
+
+
+class _Output(object):
+    """
+    A write-only file collecting what ZipFile writes until it is drained.
+    ZipFile handles its lack of seek() and tell() by writing data descriptors.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> list:
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def _mark_field(field):
+    """
+    Turn a MergeField element into the run MailMerge would make of it, with a
+    marker comment where MailMerge would put the field's text.
+    """
+    children = list(field)
+    field_name = field.attrib['name']
+    field.clear()
+    field.tag = f'{W}r'
+    field.extend(children)
+    marker = etree.Comment(f'{_FIELD}{field_name}')
+    placeholder = field.find('MergeText')
+    if placeholder is not None:
+        field.replace(placeholder, marker)
+    else:
+        field.append(marker)
+
+
+def get_section_template(path: str, separator: str = 'continuous_section') -> SectionTemplate:
+    """
+    The template at *path* compiled for *separator*, compiled once per template version.
+    """
+    return get_template(path).get_derived(('sections', separator), lambda template: SectionTemplate(template, separator))
+
+
+def stream_document(path: str, sections: list, separator: str = 'continuous_section'):
+    """
+    Merge the template at *path* once for each item of *sections* and yield the .docx in pieces.
+    See SectionTemplate.stream().
+    """
+    return get_section_template(path, separator).stream(sections)
+
+
+def _sample_template(path: str):
+    """
+    Write a discovery response template with a heading and one paragraph per request field to *path*.
+    """
+    from util.merge_engine import _write_sample_docx
+
+    fields = ['number', 'request', 'objections', 'privileges', 'withholding_statement', 'response']
+
+    def field(name):
+        return f'<w:fldSimple w:instr=" MERGEFIELD {name} \\* MERGEFORMAT "><w:r><w:t>«{name}»</w:t></w:r></w:fldSimple>'
+
+    body = (
+        f'<w:p><w:r><w:t xml:space="preserve">REQUEST FOR PRODUCTION NO. </w:t></w:r>{field("number")}</w:p>'
+        + ''.join(f'<w:p><w:r><w:t xml:space="preserve">{name.replace("_", " ").upper()}: </w:t></w:r>{field(name)}</w:p>'
+                  for name in fields[1:])
+    )
+    _write_sample_docx(path, body)
+
+
+def _benchmark(request_count: int, compare: bool):
+    """
+    Build a response to *request_count* synthetic requests with this module
+    and, if *compare* is True, with merge_templates(), whose time grows with
+    the square of the number of requests.
+    """
+    import io
+    import os
+    import random
+    import resource
+    import tempfile
+
+    from mailmerge import MailMerge
+
+    rng = random.Random(42)
+    words = ("documents communications relating to the matters alleged petition including emails texts "
+             "photographs statements accounts records agreements between you and any person since marriage").split()
+    requests = [
+        {
+            'number': str(n),
+            'request': ' '.join(rng.choice(words) for _ in range(60)).capitalize() + '.',
+            'objections': "Overly broad.\nUnduly burdensome." if n % 3 else '',
+            'privileges': '', 'withholding_statement': '',
+            'response': f"Responsive documents are produced as DEFAULT-{n:05d}.",
+        }
+        for n in range(1, request_count + 1)
+    ]
+
+    def peak_mb():
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'discovery_responses.docx')
+        _sample_template(path)
+        get_section_template(path)
+
+        baseline = peak_mb()
+        started = time.perf_counter()
+        first = None
+        size = 0
+        for chunk in stream_document(path, requests):
+            if first is None:
+                first = time.perf_counter() - started
+            size += len(chunk)
+        seconds = time.perf_counter() - started
+        print(f"section builder : {request_count} requests in {seconds:7.3f}s, {size / 1024:.0f} KB, "
+              f"first bytes after {first * 1000:.1f} ms, peak RSS +{peak_mb() - baseline:.1f} MB")
+
+        if compare:
+            baseline = peak_mb()
+            started = time.perf_counter()
+            with MailMerge(path) as document:
+                document.merge_templates(requests, separator='continuous_section')
+                buffer = io.BytesIO()
+                document.write(buffer)
+            seconds = time.perf_counter() - started
+            print(f"merge_templates : {request_count} requests in {seconds:7.3f}s, {len(buffer.getvalue()) / 1024:.0f} KB, "
+                  f"peak RSS +{peak_mb() - baseline:.1f} MB")
+
+
+if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        args = [a for a in sys.argv[1:] if not a.startswith('--')]
+        _benchmark(int(args[0]) if args else 500, '--compare' in sys.argv)
+    else:
+        print(__doc__)
@@ -20,25 +20,33 @@ DATABASE = DbClients()
 
 TEMPLATE_MANAGER = TemplateManager()
 
+# Report progress after this many clients.
+PROGRESS_EVERY = 25
 
-def send_evergreen(email: str):
+
+def send_evergreen(email: str, progress=None):
     """
     Send evergreen letters to clients.
 
     Args:
         email (str): Email address of user who wants to send letters.
+        progress (callable): Called with (clients done, clients found so far) as the letters go out (optional)
     """
-    clients = DATABASE.get_list(email, MEDIATION_RETAINER_DUE)
-    _send_email(email, clients, 'MediationRetainer')
-
-    clients = DATABASE.get_list(email, TRIAL_RETAINER_DUE)
-    _send_email(email, clients, 'TrialRetainer')
-
-    clients = DATABASE.get_list(email, EVERGREEN_PAYMENT_DUE)
-    _send_email(email, clients, 'EverGreen')
-
-
-def _send_email(from_email: str, clients: list, template: dict):
+    counts = {'done': 0, 'total': 0}
+    for flag, template in [
+        (MEDIATION_RETAINER_DUE, 'MediationRetainer'),
+        (TRIAL_RETAINER_DUE, 'TrialRetainer'),
+        (EVERGREEN_PAYMENT_DUE, 'EverGreen'),
+    ]:
+        # Each list is read after the previous one is sent, so a client sent one letter is skipped by the next.
+        clients = DATABASE.get_list(email, flag)
+        counts['total'] += len(clients)
+        _send_email(email, clients, template, progress, counts)
+        if progress:
+            progress(counts['done'], counts['total'])
+
+
+def _send_email(from_email: str, clients: list, template: dict, progress=None, counts: dict = None):
     boto_client = boto3.client(
         'ses',
         region_name=os.environ.get('AWS_REGION'),
@@ -47,7 +55,12 @@ def _send_email(from_email: str, clients: list, template: dict):
     )
     log = get_logger('email_sender')
 
+    counts = counts if counts is not None else {'done': 0, 'total': len(clients)}
     for client in clients:
+        counts['done'] += 1
+        if progress and counts['done'] % PROGRESS_EVERY == 0:
+            progress(counts['done'], counts['total'])
+
         # Don't send if trust balance has never been updated
         if 'trust_balance_update' not in client:
             continue
@@ -0,0 +1,343 @@
+"""
+export_engine.py - Stream a MongoDB query to CSV, Parquet or XLSX.
+
+Documents are read from a batched cursor and written out a few hundred rows
+at a time, so an export uses the same memory whether it has ten rows or
+ten thousand. Which columns are written, and so which fields are fetched,
+is set by an ExportProfile. Pass the generator from stream_export() to a
+Flask Response:
+
+    return Response(stream_with_context(stream_export(...)), mimetype=EXPORT_FORMATS[fmt]['mimetype'])
+
+CSV writes every value as text, as our exports always have. Parquet and XLSX
+keep the column types declared in the profile: dates, money and flags.
+pyarrow and xlsxwriter are only imported when those formats are requested.
+
+Run this module directly to time each format for a synthetic client list:
+
+    python -m util.export_engine --benchmark [client_count]
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import csv
+import io
+import sys
+import tempfile
+import time
+
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from util.export_profiles import DATE, DATETIME, FLAG, MONEY, MONEY_DIGITS, ExportProfile, typed_value
+from util.logger import get_logger
+
+# Documents per cursor batch, rows per chunk of CSV text handed to the response,
+# and rows per Parquet row group.
+BATCH_SIZE = 500
+ROWS_PER_CHUNK = 200
+ROWS_PER_ROW_GROUP = 10000
+
+# Size of the pieces an XLSX file is sent in.
+FILE_CHUNK_SIZE = 64 * 1024
+
+EXPORT_FORMATS = {
+    'csv': {'mimetype': 'text/csv', 'extension': 'csv'},
+    'parquet': {'mimetype': 'application/vnd.apache.parquet', 'extension': 'parquet'},
+    'xlsx': {'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'extension': 'xlsx'},
+}
+
+LOGGER = get_logger('export_engine')
+
+
+def stream_export(fmt: str, collection, filter_: dict, profile: ExportProfile, order_by: list = None, progress=None):
+    """
+    Generate an export in format *fmt*, one chunk at a time. See EXPORT_FORMATS.
+
+    Args:
+        fmt (str): 'csv', 'parquet' or 'xlsx'
+        collection (Collection): Collection to query
+        filter_ (dict): Filter
+        profile (ExportProfile): Columns to export
+        order_by (list): List of (field, direction) tuples (optional)
+        progress (callable): Called with the number of rows read so far, once per batch (optional)
+    Yields:
+        (str|bytes): The file, in pieces
+    """
+    writers = {'csv': stream_csv, 'parquet': stream_parquet, 'xlsx': stream_xlsx}
+    if fmt not in writers:
+        raise ValueError(f"Unsupported export format: {fmt}")
+    return writers[fmt](collection, filter_, profile, order_by, progress)
+
+
+def stream_csv(collection, filter_: dict, profile: ExportProfile, order_by: list = None, progress=None):
+    """
+    Generate a CSV export of the documents matching *filter_*, one chunk of text at a time.
+
+    Args:
+        collection (Collection): Collection to query
+        filter_ (dict): Filter
+        profile (ExportProfile): Columns to export
+        order_by (list): List of (field, direction) tuples (optional)
+        progress (callable): Called with the number of rows read so far (optional)
+    Yields:
+        (str): CSV text, beginning with the header row
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(profile.headers())
+    yield _drain(buffer)
+
+    count = 0
+    for document in _documents(collection, filter_, profile, order_by, 'csv', progress):
+        writer.writerow([_cell(value) for value in profile.row(document)])
+        count += 1
+        if count % ROWS_PER_CHUNK == 0:
+            yield _drain(buffer)
+
+    text = _drain(buffer)
+    if text:
+        yield text
+
+
+def stream_parquet(collection, filter_: dict, profile: ExportProfile, order_by: list = None, progress=None):
+    """
+    Generate a zstd-compressed Parquet export, one row group at a time.
+
+    Args: See stream_csv().
+    Yields:
+        (bytes): The Parquet file, in pieces
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    arrow_types = {
+        DATE: pa.date32(),
+        DATETIME: pa.timestamp('ms'),
+        MONEY: pa.decimal128(MONEY_DIGITS, 2),
+        FLAG: pa.bool_(),
+    }
+    headers = profile.headers(index_heading=profile.index_field or '')
+    types = profile.column_types()
+    schema = pa.schema([pa.field(h, arrow_types.get(t, pa.string())) for h, t in zip(headers, types)])
+
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema, compression='zstd')
+    columns = [[] for _ in headers]
+
+    def write_row_group():
+        writer.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema))
+        for column in columns:
+            column.clear()
+
+    for document in _documents(collection, filter_, profile, order_by, 'parquet', progress):
+        for column, value, column_type in zip(columns, profile.row(document), types):
+            column.append(typed_value(value, column_type))
+        if len(columns[0]) >= ROWS_PER_ROW_GROUP:
+            write_row_group()
+            yield sink.drain()
+
+    if columns[0]:
+        write_row_group()
+    writer.close()
+    yield sink.drain()
+
+
+def stream_xlsx(collection, filter_: dict, profile: ExportProfile, order_by: list = None, progress=None):
+    """
+    Generate an XLSX export. Rows are written in xlsxwriter's constant memory
+    mode to a temporary file, which is sent once the workbook is complete.
+
+    Args: See stream_csv().
+    Yields:
+        (bytes): The XLSX file, in pieces
+    """
+    import xlsxwriter
+
+    with tempfile.TemporaryFile() as output:
+        workbook = xlsxwriter.Workbook(output, {'constant_memory': True, 'remove_timezone': True})
+        worksheet = workbook.add_worksheet(profile.name[:31])
+        formats = {
+            DATE: workbook.add_format({'num_format': 'yyyy-mm-dd'}),
+            DATETIME: workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm'}),
+            MONEY: workbook.add_format({'num_format': '$#,##0.00'}),
+        }
+        worksheet.write_row(0, 0, profile.headers(index_heading=profile.index_field or ''), workbook.add_format({'bold': True}))
+        worksheet.freeze_panes(1, 0)
+
+        types = profile.column_types()
+        row_number = 0
+        for document in _documents(collection, filter_, profile, order_by, 'xlsx', progress):
+            row_number += 1
+            for column_number, (value, column_type) in enumerate(zip(profile.row(document), types)):
+                value = typed_value(value, column_type)
+                if value is None:
+                    continue
+                if column_type in [DATE, DATETIME]:
+                    worksheet.write_datetime(row_number, column_number, value, formats[column_type])
+                elif column_type == MONEY:
+                    worksheet.write_number(row_number, column_number, float(value), formats[MONEY])
+                elif column_type == FLAG:
+                    worksheet.write_boolean(row_number, column_number, value)
+                else:
+                    worksheet.write_string(row_number, column_number, value)
+        workbook.close()
+
+        output.seek(0)
+        while True:
+            chunk = output.read(FILE_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def with_total(progress, collection, filter_: dict):
+    """
+    Adapt a *progress* callback that takes (rows, total) to the one stream_export()
+    calls with rows alone. The total is counted once, before the export starts.
+
+    Returns:
+        (callable): The adapted callback, or None if *progress* is None
+    """
+    if progress is None:
+        return None
+    total = collection.count_documents(filter_)
+    progress(0, total)
+    return lambda rows: progress(rows, total)
+
+
+def _documents(collection, filter_: dict, profile: ExportProfile, order_by: list, fmt: str, progress=None):
+    """
+    The documents to export, fetched with the profile's projection. Reports the
+    row count to *progress* after each batch and logs the number of rows and
+    BSON bytes fetched when the export finishes.
+    """
+    started = time.perf_counter()
+
+    # Raw documents tell us how many bytes came over the wire before we decode them.
+    raw_collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    cursor = raw_collection.find(filter_, profile.projection()).batch_size(BATCH_SIZE)
+    if order_by:
+        cursor = cursor.sort(order_by)
+
+    count = 0
+    fetched = 0
+    for raw in cursor:
+        fetched += len(raw.raw)
+        count += 1
+        yield bson.decode(raw.raw, collection.codec_options)
+        if progress and count % BATCH_SIZE == 0:
+            progress(count)
+
+    if progress:
+        progress(count)
+
+    LOGGER.info(
+        "Exported %s as %s: %s rows, %s bytes fetched from %s in %.2fs",
+        profile.name, fmt, count, fetched, collection.name, time.perf_counter() - started
+    )
+
+
+class _ChunkSink(object):
+    """
+    A write-only file that holds what has been written until it is drained,
+    so that a Parquet file can be sent while it is being written.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _cell(value) -> str:
+    """
+    Format one value for the CSV file. Missing values are blank.
+    """
+    if value is None:
+        return ''
+    return str(value)
+
+
+def _drain(buffer: io.StringIO) -> str:
+    """
+    Return the text written to *buffer* so far and empty it.
+    """
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    return text
+
+
+def _benchmark(client_count: int):
+    """
+    Load *client_count* synthetic clients into a scratch database and report
+    the time to write and the size of the client list in each format.
+    """
+    import random
+    from datetime import datetime, timedelta
+
+    from util.database import Database, DB_NAME
+    from util.export_profiles import CLIENT_LIST
+
+    clients = Database(f'{DB_NAME}_bench').dbconn['clients']
+    clients.drop()
+    rng = random.Random(42)
+    docs = []
+    for n in range(client_count):
+        docs.append({
+            'billing_id': str(1000 + n), 'matter_id': '1', 'matter_title': 'Divorce',
+            'name': {'title': 'Ms.', 'first_name': f'First{n}', 'middle_name': '', 'last_name': f'Last{n % 997}', 'suffix': ''},
+            'address': {'street': f'{n} Main St', 'city': 'Plano', 'state': 'TX', 'postal_code': '75024'},
+            'email': f'client{n}@example.com', 'telephone': f'+1214{n:07d}',
+            'crm_state': '070:retained_active', 'case_county': 'Collin',
+            'cause_number': f'{rng.randint(199, 471)}-{n:05d}-2021',
+            'payment_due': round(rng.uniform(0, 10000), 2), 'trust_balance': round(rng.uniform(-500, 20000), 2),
+            'refresh_trigger': 2500.0, 'target_retainer': 10000.0,
+            'trust_balance_update': datetime(2021, 1, 1) + timedelta(minutes=n),
+            'retained_date': f'2021-{n % 12 + 1:02d}-{n % 28 + 1:02d}',
+            'trial_retainer_flag': rng.choice(['Y', 'N']), 'mediation_retainer_flag': rng.choice(['Y', 'N']),
+            'client_ssn': f'{n % 1000:03d}', 'client_dl': f'{n % 1000:03d}', 'check_digit': 'Q',
+            'children': [{'name': {'first_name': 'Kid'}, 'dob': '2010-01-01'}] * 3,
+        })
+        if len(docs) == 5000:
+            clients.insert_many(docs)
+            docs = []
+    if docs:
+        clients.insert_many(docs)
+
+    for fmt in EXPORT_FORMATS:
+        started = time.perf_counter()
+        size = sum(len(chunk.encode() if isinstance(chunk, str) else chunk) for chunk in stream_export(fmt, clients, {}, CLIENT_LIST))
+        print(f"{fmt:8} {client_count:,} clients: {size / 1024 / 1024:8.2f} MB in {time.perf_counter() - started:6.2f}s")
+
+    clients.drop()
+
+
+if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        args = [a for a in sys.argv[1:] if not a.startswith('--')]
+        _benchmark(int(args[0]) if args else 50000)
+    else:
+        print(__doc__)
@@ -0,0 +1,202 @@
+"""
+export_profiles.py - The columns each export contains.
+
+A profile lists the columns of an export and the document field each one
+comes from. Only those fields are read from the database, and a field
+added to the documents later stays out of every export until a profile
+names it.
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from datetime import date, datetime
+from decimal import Decimal, InvalidOperation
+import os
+import re
+
+# Column types. The CSV writer writes every value as text; the typed writers
+# (Parquet and XLSX) convert values to these types with typed_value().
+TEXT = 'text'
+DATE = 'date'
+DATETIME = 'datetime'
+MONEY = 'money'
+FLAG = 'flag'
+
+# Total digits of a MONEY value, two of them after the decimal point.
+MONEY_DIGITS = 18
+
+
+class ExportProfile(object):
+    """
+    The columns of one export.
+
+    Each column is either a dotted field path, whose last part is the column
+    heading, e.g. 'name.first_name' -> 'first_name', or a (heading, path) tuple.
+    *computed* maps a heading to a (fields, function) tuple: the fields the
+    function needs and a function that takes the document and returns the value.
+    *types* maps a heading to its column type; columns not listed are TEXT.
+    """
+    def __init__(self, name: str, columns: list, computed: dict = None, types: dict = None, index_field: str = '_id'):
+        self.name = name
+        self.columns = [c if isinstance(c, tuple) else (c.split('.')[-1], c) for c in columns]
+        self.computed = computed or {}
+        self.types = types or {}
+        self.index_field = index_field
+
+    def headers(self, index_heading: str = '') -> list:
+        """
+        The heading row. The index column, if any, has a blank heading by
+        default, as pandas' to_csv() wrote it.
+        """
+        headers = [heading for heading, _ in self.columns] + list(self.computed)
+        if self.index_field:
+            headers.insert(0, index_heading)
+        return headers
+
+    def column_types(self) -> list:
+        """
+        The type of each column, in the order of headers().
+        """
+        return [self.types.get(heading, TEXT) for heading in self.headers()]
+
+    def projection(self) -> dict:
+        """
+        The MongoDB projection that fetches only the fields this profile uses.
+        """
+        paths = [path for _, path in self.columns]
+        for fields, _ in self.computed.values():
+            paths.extend(fields)
+        if self.index_field:
+            paths.append(self.index_field)
+
+        # A projection may not name both a field and one of its subfields.
+        paths = sorted(set(paths))
+        projection = {}
+        for path in paths:
+            if not any(path.startswith(parent + '.') for parent in projection):
+                projection[path] = 1
+        if '_id' not in projection:
+            projection['_id'] = 0
+        return projection
+
+    def row(self, document: dict) -> list:
+        """
+        The values of the columns for one document.
+        """
+        values = [_get_path(document, path) for _, path in self.columns]
+        values.extend(function(document) for _, function in self.computed.values())
+        if self.index_field:
+            values.insert(0, _get_path(document, self.index_field))
+        return values
+
+
+def typed_value(value, column_type: str):
+    """
+    Convert a document value to the Python type a typed writer expects for
+    *column_type*: date, datetime, Decimal, bool or str. Values that can't be
+    converted, or money too large for MONEY_DIGITS, become None.
+    """
+    if value is None or value == '':
+        return None
+    try:
+        if column_type == DATE:
+            if isinstance(value, datetime):
+                return value.date()
+            return date.fromisoformat(str(value)[:10])
+        if column_type == DATETIME:
+            if isinstance(value, datetime):
+                return value
+            return datetime.fromisoformat(str(value))
+        if column_type == MONEY:
+            if isinstance(value, str):
+                value = re.sub(r'[^0-9.\-]', '', value)
+            amount = Decimal(str(value)).quantize(Decimal('0.01'))
+            return amount if abs(amount) < Decimal(10) ** (MONEY_DIGITS - 2) else None
+        if column_type == FLAG:
+            if isinstance(value, bool):
+                return value
+            return str(value).upper() in ['Y', 'TRUE']
+    except (ValueError, TypeError, InvalidOperation):
+        return None
+    return str(value)
+
+
+def payment_link(client: dict) -> str:
+    """
+    The client's payment link.
+    """
+    our_pay_url = os.environ.get('OUR_PAY_URL')
+    return f"{our_pay_url}{client.get('client_ssn', '')}{client.get('client_dl', '')}{client.get('check_digit', '')}"
+
+
+def _get_path(document: dict, path: str):
+    """
+    The value at a dotted *path* in *document*, or None.
+    """
+    value = document
+    for key in path.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+NAME_COLUMNS = ['name.title', 'name.first_name', 'name.middle_name', 'name.last_name', 'name.suffix', 'name.salutation']
+ADDRESS_COLUMNS = ['address.street', 'address.city', 'address.state', 'address.postal_code', 'address.country']
+
+CLIENT_TYPES = {
+    **{field: MONEY for field in [
+        'payment_due', 'target_retainer', 'refresh_trigger', 'trial_retainer', 'mediation_retainer',
+        'trust_balance', 'unbilled_fees', 'unbilled_costs'
+    ]},
+    **{field: DATE for field in [
+        'client_dob', 'marriage_date', 'separation_date', 'retained_date', 'filed_date', 'trial_date',
+        'completion_date'
+    ]},
+    **{field: DATETIME for field in ['trust_balance_update', 'evergreen_sent_date']},
+    **{field: FLAG for field in [
+        'email_statements_flag', 'final_bill_flag', 'trial_retainer_flag', 'mediation_retainer_flag',
+        'engagement_letter_flag', 'all_parties_in_flag', 'our_disclosures_served_flag', 'restore_maiden_name_flag'
+    ]}
+}
+
+CLIENT_LIST = ExportProfile(
+    'client_list',
+    ['billing_id', 'matter_id', 'matter_title', 'matter_description', 'reference'] +
+    NAME_COLUMNS + ADDRESS_COLUMNS + [
+        'email', 'telephone', 'alt_telephone', 'alt_telephone_desc', 'home_phone', 'cell_phone',
+        'email_cc_list', 'email_statements_flag', 'attorney_initials', 'crm_state', 'notes',
+        'payment_due', 'target_retainer', 'refresh_trigger', 'trial_retainer', 'mediation_retainer',
+        'trust_balance', 'trust_balance_update', 'unbilled_fees', 'unbilled_costs', 'evergreen_sent_date',
+        'final_bill_flag', 'trial_retainer_flag', 'mediation_retainer_flag',
+        'case_county', 'court_type', 'court_name', 'cause_number', 'case_type', 'oag_number', 'case_style',
+        'our_side', 'engagement_letter_flag', 'all_parties_in_flag', 'our_disclosures_served_flag',
+        'client_dob', 'client_dl_state', 'place_of_birth', 'maiden_name', 'restore_maiden_name_flag',
+        'marriage_date', 'marriage_place', 'separation_date', 'retained_date', 'filed_date', 'trial_date',
+        'completion_date', 'next_hearing'
+    ],
+    computed={'payment_link': (['client_ssn', 'client_dl', 'check_digit'], payment_link)},
+    types=CLIENT_TYPES
+)
+
+DEADLINE_CHECKLIST = ExportProfile(
+    'deadline_checklist',
+    [
+        'billing_id', 'matter_id', 'matter_title', 'matter_description',
+        'name.first_name', 'name.middle_name', 'name.last_name',
+        'case_county', 'court_type', 'court_name', 'cause_number', 'case_type', 'oag_number', 'case_style',
+        'our_side', 'engagement_letter_flag', 'all_parties_in_flag', 'our_disclosures_served_flag',
+        'next_hearing'
+    ],
+    types=CLIENT_TYPES
+)
+
+CONTACT_LIST = ExportProfile(
+    'contact_list',
+    NAME_COLUMNS + ADDRESS_COLUMNS + [
+        'organization', 'job_title', 'office_phone', 'cell_phone', 'fax', 'email', 'email_cc', 'notes'
+    ]
+)
+
+EXPORT_PROFILES = {profile.name: profile for profile in [CLIENT_LIST, DEADLINE_CHECKLIST, CONTACT_LIST]}
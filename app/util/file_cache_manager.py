@@ -1,18 +1,85 @@
 """
 file_cache_manager.py - Manage a local cache of files synchronized through S3
 
+The bucket holds a manifest, MANIFEST_KEY, listing every file with the
+SHA-256 of its contents and a version number that goes up with each upload.
+synchronize_file() updates it. Each process reads the manifest when it first
+needs it and then polls it every MANIFEST_POLL_SECONDS with a conditional GET,
+which costs one small request per interval. Files that changed are
+downloaded in parallel in the background, so a lookup only compares the local
+file's hash with the manifest and makes no S3 request at all.
+
+Build the manifest for a bucket that doesn't have one with:
+
+    python -m util.file_cache_manager --build-manifest [bucket]
+
+Without a manifest we fall back to comparing modified times. Every process
+shares one S3 client and a cache of each file's S3 modified time, including
+the fact that a file is not in S3 at all, which is the usual answer for
+per-user templates. Cached times older than FILE_CACHE_REVALIDATE seconds are
+still used, but are refreshed in the background; they are dropped after
+FILE_CACHE_TTL.
+
 Copyright (c) 2020 by Thomas J. Daley, J.D.
 """
-import boto3
-from boto3.s3.transfer import TransferConfig
 from botocore.exceptions import ClientError
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timezone
+import hashlib
+import json
 import os
+import sys
+import threading
+import time
 from dotenv import load_dotenv
 from util.logger import get_logger
+import util.s3_transfer as S3_TRANSFER
+from util.ttl_cache import MISSING, TTLCache
 
 
 load_dotenv()
 
+# (bucket, key) -> (S3 modified timestamp or 0.0 if absent, time.monotonic() when fetched)
+METADATA_CACHE = TTLCache(
+    max_size=int(os.environ.get('FILE_CACHE_SIZE', 1024)),
+    ttl_seconds=float(os.environ.get('FILE_CACHE_TTL', 600))
+)
+REVALIDATE_SECONDS = float(os.environ.get('FILE_CACHE_REVALIDATE', 60))
+
+MANIFEST_KEY = '_manifest.json'
+MANIFEST_POLL_SECONDS = float(os.environ.get('MANIFEST_POLL_SECONDS', 30))
+PREFETCH_WORKERS = 4
+
+# Attempts to update the manifest when another node updates it at the same time.
+MANIFEST_UPDATE_ATTEMPTS = 5
+
+METRICS = {
+    'lookups': 0,
+    'local_hits': 0,
+    'negative_hits': 0,
+    'downloads': 0,
+    'uploads': 0,
+    's3_head_calls': 0,
+    'background_revalidations': 0,
+    'manifest_polls': 0,
+    'manifest_changes': 0,
+    'prefetches': 0,
+}
+_METRICS_LOCK = threading.Lock()
+_REVALIDATOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='fcm-revalidate')
+_REVALIDATING = set()
+_PREFETCHER = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix='fcm-prefetch')
+
+# (bucket, local path) -> ManifestSync
+_SYNCS = {}
+_SYNCS_LOCK = threading.Lock()
+
+# Local path -> ((st_mtime_ns, st_size), sha256), so each file is hashed once per change.
+_LOCAL_HASHES = {}
+
+# Local path -> number of uploads of it still running. Those files are never replaced by a download.
+_PENDING_UPLOADS = {}
+
 
 class FileCacheManager(object):
     """
@@ -50,52 +117,440 @@ class FileCacheManager(object):
         Returns:
             (str): The absolute path of the file or None if not found.
         """
-        s3 = _connect()
-        self.logger.debug("Searching S3 bucket '%s' for key '%s'", self.s3_path, filename)
-        s3_modified_date = _s3_modified_date(s3, self.s3_path, filename)
+        _count('lookups')
+        local_filename = os.path.join(self.local_path, filename)
+        files = _manifest_sync(self.s3_path, self.local_path).files()
+        if files is not None:
+            return self._get_from_manifest(filename, files.get(filename))
+
+        s3_modified_date = self._s3_modified_date(filename)
         self.logger.debug("S3 modified: %s", s3_modified_date)
         local_modified_date = _local_modified_date(self.local_path, filename)
         self.logger.debug("Local modified: %s", local_modified_date)
-        local_filename = os.path.join(self.local_path, filename)
         self.logger.debug("Local filename: %s", local_filename)
 
         # See if file exists anywhere
         if not s3_modified_date and not local_modified_date:
-            self.logger.error("Template %s not found locally or on S3.", filename)
+            _count('negative_hits')
+            self.logger.debug("Template %s not found locally or on S3.", filename)
             return None
 
         # See if our file is newer than the S3 file
         if local_modified_date >= s3_modified_date:
+            _count('local_hits')
             self.logger.debug("Local file is newer than S3")
             return local_filename
 
         # S3 file is newer . . . download it.
         self.logger.debug("S3 file is newer than local file")
-        config = TransferConfig(use_threads=False)
-        s3.Object(self.s3_path, filename).download_file(local_filename, Config=config)
+        _download(self.s3_path, filename, local_filename)
         self.logger.debug("%s downloaded from S3", local_filename)
         return local_filename
 
     def synchronize_file(self, filename: str) -> bool:
         """
         Copy a local file to the remote S3 service so that other
-        nodes can pick it up.
+        nodes can pick it up, and record the new version in the manifest.
+        """
+        local_filename = os.path.join(self.local_path, filename)
+        sha256 = _local_sha256(local_filename)
+        _upload_started(local_filename)
+        try:
+            S3_TRANSFER.upload(local_filename, self.s3_path, filename)
+            self._uploaded(filename, sha256)
+        finally:
+            _upload_finished(local_filename)
+        return True
+
+    def synchronize_file_async(self, filename: str) -> Future:
+        """
+        Like synchronize_file(), but the upload runs in the background so that
+        the request can answer before it finishes. Use it only for large or
+        optional files whose caller checks the Future; templates an admin saves
+        go through synchronize_file() so that a failed upload is reported.
+
+        Returns:
+            (Future): Resolves when the file is uploaded and the manifest updated
+        """
+        local_filename = os.path.join(self.local_path, filename)
+        sha256 = _local_sha256(local_filename)
+        _upload_started(local_filename)
+        future = S3_TRANSFER.upload_async(
+            local_filename, self.s3_path, filename, then=lambda: self._uploaded(filename, sha256)
+        )
+        future.add_done_callback(lambda _: _upload_finished(local_filename))
+        return future
+
+    def _uploaded(self, filename: str, sha256: str):
+        """
+        Record a finished upload in the manifest or, if the bucket has none, in METADATA_CACHE.
+
+        Args:
+            filename (str): The file uploaded
+            sha256 (str): Hash of the file as it was when the upload started
+        """
+        _count('uploads')
+        local_filename = os.path.join(self.local_path, filename)
+        if _manifest_sync(self.s3_path, self.local_path).record_upload(filename, sha256):
+            return
+
+        # Give our copy the S3 copy's time so that we never download it back.
+        s3_modified_date = _s3_modified_date(self.s3_path, filename)
+        if s3_modified_date:
+            os.utime(local_filename, (s3_modified_date, s3_modified_date))
+        METADATA_CACHE.put((self.s3_path, filename), (s3_modified_date, time.monotonic()))
+
+    def _get_from_manifest(self, filename: str, entry: dict) -> str:
+        """
+        Return our copy of *filename* if its hash matches the manifest *entry*,
+        downloading the listed version first if it doesn't. A file that is not
+        in the manifest is only used if we have it locally, and a file saved
+        here since the manifest entry was written is never replaced.
         """
-        s3 = _connect()
         local_filename = os.path.join(self.local_path, filename)
-        s3.Bucket(self.s3_path).upload_file(local_filename, filename)
+        if entry is None:
+            if os.path.exists(local_filename):
+                _count('local_hits')
+                return local_filename
+            _count('negative_hits')
+            self.logger.debug("Template %s not found locally or in the manifest.", filename)
+            return None
+
+        if _local_sha256(local_filename) == entry['sha256']:
+            _count('local_hits')
+            return local_filename
+
+        if _saved_locally(local_filename, entry):
+            _count('local_hits')
+            self.logger.debug("Keeping %s, which is newer than version %s", filename, entry['version'])
+            return local_filename
+
+        self.logger.debug("Downloading version %s of %s", entry['version'], filename)
+        _download(self.s3_path, filename, local_filename, entry)
+        return local_filename
+
+    def _s3_modified_date(self, filename: str) -> float:
+        """
+        The S3 modified time of *filename*, or 0.0 if it is not in S3, from
+        METADATA_CACHE if we have it. A cached time older than REVALIDATE_SECONDS
+        is returned as is and refreshed in the background.
+        """
+        key = (self.s3_path, filename)
+        cached = METADATA_CACHE.get(key)
+        if cached is MISSING:
+            self.logger.debug("Searching S3 bucket '%s' for key '%s'", self.s3_path, filename)
+            modified = _s3_modified_date(self.s3_path, filename)
+            METADATA_CACHE.put(key, (modified, time.monotonic()))
+            return modified
+
+        modified, fetched = cached
+        if time.monotonic() - fetched > REVALIDATE_SECONDS:
+            _revalidate(key)
+        return modified
+
+
+class ManifestSync(object):
+    """
+    This process's copy of one bucket's manifest, polled every MANIFEST_POLL_SECONDS
+    by a background thread that also prefetches the files that changed.
+    """
+    def __init__(self, bucket: str, local_path: str):
+        self.bucket = bucket
+        self.local_path = local_path
+        self.logger = get_logger('fcm')
+        self.lock = threading.Lock()
+        self.manifest = None
+        self.etag = None
+        self.poll()
+        self.thread = threading.Thread(target=self._run, name='fcm-manifest', daemon=True)
+        self.thread.start()
+
+    def files(self) -> dict:
+        """
+        The manifest's {filename: entry} or None if the bucket has no manifest.
+        """
+        manifest = self.manifest
+        return manifest['files'] if manifest is not None else None
+
+    def poll(self) -> bool:
+        """
+        Fetch the manifest if it changed since we last read it and prefetch
+        the files whose hash no longer matches our copy.
+
+        Returns:
+            (bool): True if the manifest changed
+        """
+        _count('manifest_polls')
+        try:
+            manifest, etag = _read_manifest(self.bucket, self.etag)
+        except Exception as e:
+            self.logger.warning("Unable to read the manifest for %s: %s", self.bucket, e)
+            return False
+        if etag is None or etag == self.etag:
+            return False
+
+        with self.lock:
+            previous = self.files() or {}
+            self.manifest, self.etag = manifest, etag
+        _count('manifest_changes')
+
+        changed = [
+            filename for filename, entry in manifest['files'].items()
+            if previous.get(filename, {}).get('version') != entry['version']
+            and _local_sha256(os.path.join(self.local_path, filename)) != entry['sha256']
+            and not _saved_locally(os.path.join(self.local_path, filename), entry)
+        ]
+        for filename in changed:
+            _PREFETCHER.submit(self._prefetch, filename, manifest['files'][filename])
+        if changed:
+            self.logger.info("Manifest version %s: prefetching %s", manifest['version'], ', '.join(changed))
+        return True
+
+    def record_upload(self, filename: str, sha256: str) -> bool:
+        """
+        Record a new version of *filename* in the bucket's manifest. The manifest
+        is written only if no one else changed it since we read it; otherwise
+        we read it again and retry.
+
+        Returns:
+            (bool): False if the bucket has no manifest or it could not be updated
+        """
+        for _ in range(MANIFEST_UPDATE_ATTEMPTS):
+            manifest, etag = _read_manifest(self.bucket)
+            if manifest is None:
+                # A manifest listing only this file would hide all the others.
+                self.logger.warning("%s has no manifest; run --build-manifest to create one", self.bucket)
+                return False
+            entry = manifest['files'].get(filename, {})
+            manifest['version'] += 1
+            manifest['files'][filename] = {
+                'sha256': sha256,
+                'version': entry.get('version', 0) + 1,
+                'updated': datetime.utcnow().isoformat(),
+            }
+            try:
+                etag = _write_manifest(self.bucket, manifest, etag)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ['PreconditionFailed', 'ConditionalRequestConflict', '412', '409']:
+                    continue
+                raise
+            with self.lock:
+                self.manifest, self.etag = manifest, etag
+            return True
+        self.logger.error("Unable to update the manifest for %s after %s attempts", filename, MANIFEST_UPDATE_ATTEMPTS)
+        return False
+
+    def _prefetch(self, filename: str, entry: dict):
+        """
+        Download a changed file in the background.
+        """
+        try:
+            _download(self.bucket, filename, os.path.join(self.local_path, filename), entry)
+            _count('prefetches')
+        except Exception as e:
+            self.logger.warning("Unable to prefetch %s: %s", filename, e)
+
+    def _run(self):
+        while True:
+            time.sleep(MANIFEST_POLL_SECONDS)
+            self.poll()
+
+
+def build_manifest(bucket: str) -> dict:
+    """
+    Write a manifest listing every object in *bucket*, hashing each one.
+    Use this once for a bucket that has no manifest.
+
+    Returns:
+        (dict): The manifest
+    """
+    client = _connect()
+    manifest = {'version': 1, 'files': {}}
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket):
+        for obj in page.get('Contents', []):
+            if obj['Key'] == MANIFEST_KEY:
+                continue
+            digest = hashlib.sha256()
+            for chunk in client.get_object(Bucket=bucket, Key=obj['Key'])['Body'].iter_chunks():
+                digest.update(chunk)
+            manifest['files'][obj['Key']] = {
+                'sha256': digest.hexdigest(),
+                'version': 1,
+                'updated': obj['LastModified'].isoformat(),
+            }
+    _write_manifest(bucket, manifest)
+    return manifest
+
+
+def file_cache_stats() -> dict:
+    """
+    Statistics for the S3 metadata cache and the S3 requests we made.
+    """
+    stats = METADATA_CACHE.stats()
+    with _METRICS_LOCK:
+        stats.update(METRICS)
+    stats['revalidate_seconds'] = REVALIDATE_SECONDS
+    return stats
 
 
 def _connect():
     """
-    Connects to the S3 service and returns a Boto3 object.
+    The S3 client shared by this process, see s3_transfer.
+    """
+    return S3_TRANSFER.get_client()
+
+
+def _manifest_sync(bucket: str, local_path: str) -> ManifestSync:
+    """
+    The ManifestSync for *bucket*, started on first use.
+    """
+    key = (bucket, local_path)
+    sync = _SYNCS.get(key)
+    if sync is None:
+        with _SYNCS_LOCK:
+            sync = _SYNCS.get(key)
+            if sync is None:
+                sync = ManifestSync(bucket, local_path)
+                _SYNCS[key] = sync
+    return sync
+
+
+def _read_manifest(bucket: str, etag: str = None) -> tuple:
+    """
+    Read the manifest, unless its ETag is still *etag*.
+
+    Returns:
+        (tuple): (manifest, ETag), (None, None) if there is no manifest,
+                 or (None, *etag*) if it has not changed
+    """
+    kwargs = {'IfNoneMatch': etag} if etag else {}
+    try:
+        response = _connect().get_object(Bucket=bucket, Key=MANIFEST_KEY, **kwargs)
+    except ClientError as e:
+        code = e.response.get('Error', {}).get('Code')
+        if code in ['304', 'NotModified']:
+            return None, etag
+        if code in ['404', 'NoSuchKey']:
+            return None, None
+        raise
+    return json.loads(response['Body'].read()), response['ETag']
+
+
+def _write_manifest(bucket: str, manifest: dict, etag: str = None) -> str:
+    """
+    Write the manifest if its ETag is still *etag*, or if there is none yet when *etag* is None.
+
+    Returns:
+        (str): The new ETag
+    """
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    body = json.dumps(manifest, indent=1, sort_keys=True).encode()
+    response = _connect().put_object(
+        Bucket=bucket, Key=MANIFEST_KEY, Body=body, ContentType='application/json', **condition
+    )
+    return response['ETag']
+
+
+def _download(bucket: str, filename: str, local_filename: str, entry: dict = None):
+    """
+    Download a file, see s3_transfer.download(). A file downloaded for a
+    manifest *entry* is given the entry's time, so that _saved_locally() can
+    tell it from a file saved here afterwards.
     """
-    return boto3.resource('s3')
+    S3_TRANSFER.download(bucket, filename, local_filename)
+    if entry is not None:
+        updated = _updated_timestamp(entry)
+        os.utime(local_filename, (updated, updated))
+    _count('downloads')
 
 
-def _s3_modified_date(s3_client, bucket, filename) -> float:
+def _saved_locally(local_filename: str, entry: dict) -> bool:
+    """
+    True if *local_filename* is being uploaded or was modified after the manifest *entry* was written.
+    """
+    with _METRICS_LOCK:
+        if _PENDING_UPLOADS.get(local_filename):
+            return True
     try:
-        return s3_client.Bucket(bucket).Object(filename).last_modified.timestamp()
+        return os.path.getmtime(local_filename) > _updated_timestamp(entry)
+    except FileNotFoundError:
+        return False
+
+
+def _updated_timestamp(entry: dict) -> float:
+    """
+    A manifest entry's 'updated' time as a timestamp. Times written without a zone are UTC.
+    """
+    updated = datetime.fromisoformat(entry['updated'])
+    if updated.tzinfo is None:
+        updated = updated.replace(tzinfo=timezone.utc)
+    return updated.timestamp()
+
+
+def _upload_started(local_filename: str):
+    with _METRICS_LOCK:
+        _PENDING_UPLOADS[local_filename] = _PENDING_UPLOADS.get(local_filename, 0) + 1
+
+
+def _upload_finished(local_filename: str):
+    with _METRICS_LOCK:
+        _PENDING_UPLOADS[local_filename] -= 1
+        if not _PENDING_UPLOADS[local_filename]:
+            del _PENDING_UPLOADS[local_filename]
+
+
+def _local_sha256(local_filename: str) -> str:
+    """
+    SHA-256 of a local file, or None if it doesn't exist. Hashes are kept
+    until the file's modified time or size changes.
+    """
+    try:
+        stat = os.stat(local_filename)
+    except FileNotFoundError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _LOCAL_HASHES.get(local_filename)
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(local_filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(64 * 1024), b''):
+            digest.update(chunk)
+    _LOCAL_HASHES[local_filename] = (signature, digest.hexdigest())
+    return digest.hexdigest()
+
+
+def _revalidate(key: tuple):
+    """
+    Refresh the cached S3 modified time for *key* in the background, once at a time.
+    """
+    with _METRICS_LOCK:
+        if key in _REVALIDATING:
+            return
+        _REVALIDATING.add(key)
+        METRICS['background_revalidations'] += 1
+
+    def refresh():
+        try:
+            METADATA_CACHE.put(key, (_s3_modified_date(*key), time.monotonic()))
+        except Exception as e:
+            get_logger('fcm').warning("Unable to revalidate %s: %s", key, e)
+        finally:
+            with _METRICS_LOCK:
+                _REVALIDATING.discard(key)
+
+    _REVALIDATOR.submit(refresh)
+
+
+def _count(metric: str):
+    with _METRICS_LOCK:
+        METRICS[metric] += 1
+
+
+def _s3_modified_date(bucket, filename) -> float:
+    _count('s3_head_calls')
+    try:
+        return _connect().head_object(Bucket=bucket, Key=filename)['LastModified'].timestamp()
     except ClientError:
         pass
 
@@ -110,3 +565,12 @@ def _local_modified_date(local_path, filename) -> float:
         pass
 
     return 0.0
+
+
+if __name__ == '__main__':
+    if '--build-manifest' in sys.argv:
+        args = [a for a in sys.argv[1:] if not a.startswith('--')]
+        manifest = build_manifest(args[0] if args else os.environ['DOCX_S3_PATH'])
+        print(f"Manifest lists {len(manifest['files'])} files")
+    else:
+        print(__doc__)
@@ -1,7 +1,13 @@
 """
 flatten_dict.py - Flatten a multi-level dict
 """
-import collections
+from collections.abc import MutableMapping
+import sys
+import time
+
+# Fields the name fix-ups read, and the field they derive from them.
+NAME_FIELDS = ['name_title', 'name_first_name', 'name_middle_name', 'name_last_name', 'name_suffix', 'job_title']
+DERIVED_FIELDS = {'name_full_name'}
 
 
 def flatten_dict(d: dict, parent_key: str = '', sep: str = '_') -> dict:
@@ -34,15 +40,57 @@ def flatten_dict(d: dict, parent_key: str = '', sep: str = '_') -> dict:
     items = []
     for k, v in d.items():
         new_key = parent_key + sep + k if parent_key else k
-        if isinstance(v, collections.MutableMapping):
+        if isinstance(v, MutableMapping):
             items.extend(flatten_dict(v, new_key, sep=sep).items())
         else:
             items.append((new_key, v))
 
-    new_dict = dict(items)
+    return _fix_up(dict(items))
+
+
+def compile_flattener(fields, sep: str = '_'):
+    """
+    Make a flatten_dict() that only produces *fields*, for merging into a
+    template that uses only those fields (see merge_engine.get_flattener()).
+    It descends only into the inner dicts those fields are found in, so
+    large parts of a document that the template does not use, such as
+    children or insurance, cost nothing. The name fields and name_full_name
+    are always produced, since callers name their files with them.
+
+    Args:
+        fields (iterable): Flattened field names, e.g. MailMerge.get_merge_fields()
+        sep (str): separator between keys, default = "_"
+    Returns:
+        (callable): Takes a dict and returns the wanted part of flatten_dict()'s result
+    """
+    wanted = (frozenset(fields) | frozenset(NAME_FIELDS)) - DERIVED_FIELDS
+    # Flattened keys of the inner dicts the wanted fields are found in, e.g. 'name' and 'address'.
+    prefixes = frozenset(field[:i] for field in wanted for i, c in enumerate(field) if c == sep)
+
+    def extract(d: dict, parent_key: str, flat: dict):
+        for k, v in d.items():
+            new_key = parent_key + sep + k if parent_key else k
+            if isinstance(v, MutableMapping):
+                if new_key in prefixes:
+                    extract(v, new_key, flat)
+            elif new_key in wanted:
+                flat[new_key] = v
+
+    def flatten(d: dict) -> dict:
+        flat = {}
+        extract(d, '', flat)
+        return _fix_up(flat)
+
+    flatten.fields = wanted | DERIVED_FIELDS
+    return flatten
 
+
+def _fix_up(new_dict: dict) -> dict:
+    """
+    Adjust the name fields and derive name_full_name.
+    """
     # A fix to handle attorney's differently.
-    if 'attorney' in new_dict.get('job_title', '').lower():
+    if 'attorney' in (new_dict.get('job_title') or '').lower():
         new_dict['name_title'] = None
         new_dict['name_suffix'] = "Esq."
 
@@ -61,3 +109,44 @@ def flatten_dict(d: dict, parent_key: str = '', sep: str = '_') -> dict:
     new_dict['name_full_name'] = name
 
     return new_dict
+
+
+def _benchmark(iterations: int):
+    """
+    Time flatten_dict() and a compiled flattener for a letterhead's fields on a large client document.
+    """
+    client = {
+        'name': {'title': 'Ms.', 'first_name': 'Jane', 'middle_name': 'Q', 'last_name': 'Public', 'suffix': ''},
+        'address': {'street': '100 Main St', 'city': 'Plano', 'state': 'TX', 'postal_code': '75024'},
+        'email': 'jane@example.com', 'case_style': 'In the Interest of J.P. and K.P., Children',
+        'cause_number': '401-01234-2025', 'case_county': 'Collin', 'court_name': '401st District Court',
+        'children': [{'name': {'first_name': f'Child{n}'}, 'dob': '2015-01-01'} for n in range(4)],
+        'op': {'name': {'first_name': 'John', 'last_name': 'Public'}, 'address': {'street': '1 Elm', 'city': 'Frisco'},
+               'employer': {'name': 'Acme', 'address': {'street': '2 Oak', 'city': 'Dallas'}}},
+        'employment': {f'job{n}': {'employer': f'Employer {n}', 'address': {'street': f'{n} Pine'}, 'salary': n}
+                       for n in range(10)},
+        'health_ins': {'carrier': 'Carrier', 'policy': {'number': '123', 'group': '456'}, 'premium': 100},
+        'dental_ins': {'carrier': 'Carrier', 'policy': {'number': '789', 'group': '012'}, 'premium': 50},
+        'cs_tools_enforcement': {f'month{n}': {'due': 1000, 'paid': 900, 'balance': 100} for n in range(120)},
+        'case_events': [{'date': '2025-01-01', 'event': f'Event {n}'} for n in range(50)],
+    }
+    fields = ['name_full_name', 'name_last_name', 'address_street', 'address_city', 'address_state',
+              'address_postal_code', 'case_style', 'cause_number', 'case_county', 'court_name', 'email']
+    flatten = compile_flattener(fields)
+    full = flatten_dict(client)
+    assert all(flatten(client).get(field) == full.get(field) for field in flatten.fields)
+
+    for label, function in [('flatten_dict', flatten_dict), ('compiled', flatten)]:
+        started = time.perf_counter()
+        for _ in range(iterations):
+            function(client)
+        seconds = time.perf_counter() - started
+        print(f"{label:12}: {seconds * 1e6 / iterations:8.1f} us per document, {len(function(client))} fields")
+
+
+if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        args = [a for a in sys.argv[1:] if not a.startswith('--')]
+        _benchmark(int(args[0]) if args else 10000)
+    else:
+        print(__doc__)
@@ -0,0 +1,214 @@
+"""
+s3_transfer.py - Shared S3 client and file transfers.
+
+Every S3 upload and download in the app goes through here, so they share
+one client per set of credentials, one tuned TransferConfig and one set of
+throughput metrics. Files of MULTIPART_THRESHOLD or more move in parts,
+MAX_CONCURRENCY at a time. upload_async() returns a Future so a request can
+answer before a large or optional upload finishes; its failures are only
+logged unless the caller checks the Future.
+
+Set S3_ENDPOINT_URL to point the clients at a local S3 stand-in, such as
+moto's server mode or MinIO. Under moto's in-process mock, call
+reset_clients() after the mock starts so that clients are created inside it.
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import threading
+import time
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+from util.logger import get_logger
+
+MB = 1024 * 1024
+MULTIPART_THRESHOLD = int(os.environ.get('S3_MULTIPART_THRESHOLD_MB', 8)) * MB
+MULTIPART_CHUNKSIZE = int(os.environ.get('S3_MULTIPART_CHUNKSIZE_MB', 8)) * MB
+MAX_CONCURRENCY = int(os.environ.get('S3_MAX_CONCURRENCY', 8))
+UPLOAD_WORKERS = int(os.environ.get('S3_UPLOAD_WORKERS', 4))
+ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL') or None
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=MULTIPART_CHUNKSIZE,
+    max_concurrency=MAX_CONCURRENCY,
+    use_threads=True
+)
+
+# Each client's connection pool must hold every concurrent part of every
+# upload running in the background, plus the requests being served.
+CLIENT_CONFIG = Config(
+    max_pool_connections=MAX_CONCURRENCY * (UPLOAD_WORKERS + 1),
+    retries={'max_attempts': 5, 'mode': 'standard'}
+)
+
+LOGGER = get_logger('s3_transfer')
+METRICS = {
+    'uploads': 0,
+    'upload_bytes': 0,
+    'upload_seconds': 0.0,
+    'downloads': 0,
+    'download_bytes': 0,
+    'download_seconds': 0.0,
+    'failures': 0,
+    'pending_uploads': 0,
+}
+RECENT_TRANSFERS = deque(maxlen=50)
+_METRICS_LOCK = threading.Lock()
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+_UPLOADER = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix='s3-upload')
+
+
+def get_client(credentials: dict = None):
+    """
+    The S3 client for *credentials*, created on first use and shared by every
+    thread in this process.
+
+    Args:
+        credentials (dict): region_name, aws_access_key_id and aws_secret_access_key
+                            (default=boto3's usual environment and config lookup)
+    """
+    credentials = credentials or {}
+    key = tuple(sorted(credentials.items()))
+    client = _CLIENTS.get(key)
+    if client is None:
+        with _CLIENTS_LOCK:
+            client = _CLIENTS.get(key)
+            if client is None:
+                client = boto3.client('s3', endpoint_url=ENDPOINT_URL, config=CLIENT_CONFIG, **credentials)
+                _CLIENTS[key] = client
+    return client
+
+
+def reset_clients():
+    """
+    Forget the shared clients, e.g. after starting a mock S3.
+    """
+    with _CLIENTS_LOCK:
+        _CLIENTS.clear()
+
+
+def upload(local_filename: str, bucket: str, key: str, extra_args: dict = None, credentials: dict = None) -> dict:
+    """
+    Upload a file.
+
+    Args:
+        local_filename (str): File to upload
+        bucket (str): Bucket name
+        key (str): Object key
+        extra_args (dict): ExtraArgs for boto3, e.g. {'Expires': datetime} (optional)
+        credentials (dict): See get_client() (optional)
+    Returns:
+        (dict): The transfer's metrics, see _record()
+    """
+    size = os.path.getsize(local_filename)
+    started = time.perf_counter()
+    try:
+        get_client(credentials).upload_file(local_filename, bucket, key, ExtraArgs=extra_args, Config=TRANSFER_CONFIG)
+    except Exception:
+        _count_failure('upload', bucket, key)
+        raise
+    return _record('upload', bucket, key, size, time.perf_counter() - started)
+
+
+def upload_async(local_filename: str, bucket: str, key: str, extra_args: dict = None, credentials: dict = None,
+                 then=None) -> Future:
+    """
+    Upload a file in the background. See upload() for the arguments.
+
+    Args:
+        then (callable): Called with no arguments in the background once the upload succeeds (optional)
+    Returns:
+        (Future): Resolves to upload()'s metrics or raises its exception
+    """
+    with _METRICS_LOCK:
+        METRICS['pending_uploads'] += 1
+
+    def run():
+        try:
+            result = upload(local_filename, bucket, key, extra_args, credentials)
+            if then:
+                then()
+            return result
+        except Exception as e:
+            LOGGER.error("Background upload of %s to s3://%s/%s failed: %s", local_filename, bucket, key, e)
+            raise
+        finally:
+            with _METRICS_LOCK:
+                METRICS['pending_uploads'] -= 1
+
+    return _UPLOADER.submit(run)
+
+
+def download(bucket: str, key: str, local_filename: str, credentials: dict = None) -> dict:
+    """
+    Download an object. It is written under a temporary name and renamed
+    once complete, so that a reader never sees it half-written.
+
+    Returns:
+        (dict): The transfer's metrics, see _record()
+    """
+    tmp_filename = f'{local_filename}.{threading.get_ident()}.part'
+    started = time.perf_counter()
+    try:
+        get_client(credentials).download_file(bucket, key, tmp_filename, Config=TRANSFER_CONFIG)
+        os.replace(tmp_filename, local_filename)
+    except Exception:
+        _count_failure('download', bucket, key)
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+    return _record('download', bucket, key, os.path.getsize(local_filename), time.perf_counter() - started)
+
+
+def transfer_stats() -> dict:
+    """
+    Totals and average throughput by direction, plus the most recent transfers.
+    """
+    with _METRICS_LOCK:
+        stats = dict(METRICS)
+        recent = list(RECENT_TRANSFERS)
+    for direction in ['upload', 'download']:
+        seconds = stats[f'{direction}_seconds']
+        stats[f'{direction}_mb_per_second'] = round(stats[f'{direction}_bytes'] / MB / seconds, 2) if seconds else 0.0
+        stats[f'{direction}_seconds'] = round(seconds, 3)
+    stats['recent'] = recent
+    return stats
+
+
+def _record(direction: str, bucket: str, key: str, size: int, seconds: float) -> dict:
+    """
+    Add a finished transfer to METRICS and RECENT_TRANSFERS.
+
+    Returns:
+        (dict): direction, bucket, key, bytes, seconds and mb_per_second
+    """
+    transfer = {
+        'direction': direction,
+        'bucket': bucket,
+        'key': key,
+        'bytes': size,
+        'seconds': round(seconds, 3),
+        'mb_per_second': round(size / MB / seconds, 2) if seconds else 0.0,
+    }
+    with _METRICS_LOCK:
+        METRICS[f'{direction}s'] += 1
+        METRICS[f'{direction}_bytes'] += size
+        METRICS[f'{direction}_seconds'] += seconds
+        RECENT_TRANSFERS.append(transfer)
+    LOGGER.debug("%s s3://%s/%s: %s bytes in %.3fs", direction, bucket, key, size, seconds)
+    return transfer
+
+
+def _count_failure(direction: str, bucket: str, key: str):
+    with _METRICS_LOCK:
+        METRICS['failures'] += 1
+    LOGGER.warning("%s s3://%s/%s failed", direction, bucket, key)
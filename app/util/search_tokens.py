@@ -0,0 +1,95 @@
+"""
+search_tokens.py - Normalize text into search terms.
+
+Every search index in the app runs text through these functions so that
+the terms stored at index time and the terms derived from a user's query
+always agree.
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+import re
+import unicodedata
+
+_NON_ALNUM = re.compile(r'[^0-9a-z]+')
+_NON_DIGIT = re.compile(r'[^0-9]+')
+
+
+def normalize(text) -> str:
+    """
+    Lower-case *text* and strip accents, e.g. 'José' -> 'jose'.
+    """
+    if text is None:
+        return ''
+    text = str(text)
+    if text.isascii():
+        return text.lower()
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return text.lower()
+
+
+def tokens(text) -> list:
+    """
+    Split *text* into alphanumeric terms, e.g. "O'Brien-Smith" -> ['o', 'brien', 'smith'].
+    """
+    return [t for t in _NON_ALNUM.split(normalize(text)) if t]
+
+
+def compact(text) -> str:
+    """
+    Collapse *text* to a single term with punctuation and spaces removed,
+    e.g. '416-55555-2021' -> '416555552021'.
+    """
+    return _NON_ALNUM.sub('', normalize(text))
+
+
+def terms(text) -> list:
+    """
+    All of the terms we index for *text*: its tokens plus the compact form, so
+    that both 'brien' and 'obrien' find "O'Brien".
+    """
+    result = tokens(text)
+    whole = compact(text)
+    if whole and whole not in result:
+        result.append(whole)
+    return result
+
+
+def phone_terms(telephone) -> list:
+    """
+    Digit strings to index for a telephone number. For an E.164 number like
+    '+12145551212' that is the full number and the national number without
+    the country code.
+    """
+    digits = _NON_DIGIT.sub('', str(telephone or ''))
+    if not digits:
+        return []
+    result = [digits]
+    if len(digits) == 11 and digits.startswith('1'):
+        result.append(digits[1:])
+    return result
+
+
+def query_terms(query: str) -> list:
+    """
+    Turn what the user typed into the terms we look up. Each whitespace
+    separated word becomes one compact term, so '416-5555' searches for the
+    prefix '4165555'.
+    """
+    result = []
+    for word in (query or '').split():
+        term = compact(word)
+        if term and term not in result:
+            result.append(term)
+    return result
+
+
+def prefix_range(term: str) -> dict:
+    """
+    A MongoDB range condition matching every string that starts with *term*.
+    On an array field wrap it in $elemMatch, otherwise the two bounds may be
+    satisfied by different elements, e.g. {'terms': {'$elemMatch': prefix_range('smi')}}.
+    """
+    return {'$gte': term, '$lt': term + '\uffff'}
@@ -0,0 +1,85 @@
+"""
+ttl_cache.py - A small, thread-safe, size-bounded cache whose entries expire.
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+# Returned by get() when a key is not cached, so that None can be cached.
+MISSING = object()
+
+
+class TTLCache(object):
+    """
+    Least-recently-used cache of at most *max_size* entries, each of which
+    is dropped *ttl_seconds* after it was stored.
+    """
+    def __init__(self, max_size: int = 256, ttl_seconds: float = 60.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, default=MISSING):
+        """
+        Return the value cached for *key* or *default* if it is missing or expired.
+        """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """
+        Cache *value* for *key*, evicting the least recently used entry if the cache is full.
+        """
+        expires = time.monotonic() + self.ttl_seconds
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=MISSING):
+        """
+        Drop *key* from the cache, or every entry if no key is given.
+        """
+        with self.lock:
+            if key is MISSING:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        """
+        Return a snapshot of the cache statistics.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
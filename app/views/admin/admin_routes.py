@@ -7,7 +7,7 @@ Copyright (c) 2020 by Thomas J. Daley. All Rights Reserved.
 """
 import uuid
 import os
-from flask import Blueprint, flash, redirect, render_template, request, Response, session, url_for, send_file
+from flask import Blueprint, flash, jsonify, redirect, render_template, request, Response, session, url_for, send_file, stream_with_context
 import urllib
 import requests
 
@@ -18,20 +18,25 @@ from .forms.TemplateForm import TemplateForm
 from .forms.UserForm import UserForm
 from util.template_manager import TemplateManager
 from util.template_name import template_name
-from util.email_sender import send_evergreen
-from util.file_cache_manager import FileCacheManager
+from util.file_cache_manager import FileCacheManager, file_cache_stats
 from util.dialer import Dialer
 import msftconfig
 
-from util.db_admins import DbAdmins
+from util.db_admins import DbAdmins, admin_cache_stats
 from util.db_clients import DbClients
+from util.db_queue import DbQueue, DONE
 from util.database import multidict2dict
-from util.database import Database
+from util.database import Database, identity_map_stats, pool_stats
 from util.db_users import DbUsers
+from util.export_engine import EXPORT_FORMATS
+from util.export_profiles import DEADLINE_CHECKLIST
+from util.merge_engine import merge_engine_stats
 from util.msftgraph import MicrosoftGraph
+from util.s3_transfer import transfer_stats
 from util.userlist import Users
 DBUSERS = DbUsers()
 DBCLIENTS = DbClients()
+DBQUEUE = DbQueue()
 MSFT = MicrosoftGraph()
 USERS = None  # We need an authenticated user before we can populate the list
 
@@ -324,8 +329,11 @@ def list_clients():
 @DECORATORS.auth_send_evergreens
 def send_evergreens():
     user_email = session['user']['preferred_username']
-    send_evergreen(user_email)
-    return redirect(url_for('admin_routes.list_clients'))
+    result = DBQUEUE.queue_evergreen(user_email)
+    if not result['success']:
+        flash(result['message'], 'danger')
+        return redirect(url_for('admin_routes.list_clients'))
+    return redirect(url_for('admin_routes.task_status', task_id=result['task_id']))
 
 
 @admin_routes.route('/dashboard', methods=['GET'])
@@ -349,10 +357,51 @@ def dashboard_main():
         'dashboard_main.html',
         db_stats=db_stats,
         db_status_class=db_status_class,
-        collections=collections
+        collections=collections,
+        pool_stats=pool_stats(),
+        admin_cache_stats=admin_cache_stats(),
+        identity_map_stats=identity_map_stats(),
+        file_cache_stats=file_cache_stats(),
+        s3_transfer_stats=transfer_stats(),
+        merge_engine_stats=merge_engine_stats()
     )
 
 
+@admin_routes.route('/dashboard/db_pool', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_super_user
+def dashboard_db_pool():
+    return jsonify(pool_stats())
+
+
+@admin_routes.route('/dashboard/admin_cache', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_super_user
+def dashboard_admin_cache():
+    return jsonify(admin_cache_stats())
+
+
+@admin_routes.route('/dashboard/file_cache', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_super_user
+def dashboard_file_cache():
+    return jsonify(file_cache_stats())
+
+
+@admin_routes.route('/dashboard/s3_transfers', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_super_user
+def dashboard_s3_transfers():
+    return jsonify(transfer_stats())
+
+
+@admin_routes.route('/dashboard/merge_engine', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_super_user
+def dashboard_merge_engine():
+    return jsonify(merge_engine_stats())
+
+
 @admin_routes.route("/clients/csv/list", methods=['GET'])
 @DECORATORS.is_logged_in
 @DECORATORS.is_admin_user
@@ -361,7 +410,7 @@ def download_clients_csv():
     user_email = session['user']['preferred_username']
     clients = DBCLIENTS.get_list_as_csv(user_email)
     return Response(
-        clients,
+        stream_with_context(clients),
         mimetype='text/csv',
         headers={
             'Content-Disposition': 'attachment; filename=clients.csv'
@@ -369,94 +418,88 @@ def download_clients_csv():
     )
 
 
+@admin_routes.route("/clients/export/<string:fmt>", methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.is_admin_user
+@DECORATORS.auth_download_clients
+def download_clients_export(fmt: str):
+    user_email = session['user']['preferred_username']
+    export_format = EXPORT_FORMATS.get(fmt)
+    if export_format is None:
+        flash(f"Unsupported export format: {fmt}", 'danger')
+        return redirect(url_for('admin_routes.list_clients'))
+    result = DBQUEUE.queue_export(user_email, 'clients', fmt)
+    if not result['success']:
+        flash(result['message'], 'danger')
+        return redirect(url_for('admin_routes.list_clients'))
+    return redirect(url_for('admin_routes.task_status', task_id=result['task_id']))
+
+
+@admin_routes.route("/tasks/<string:task_id>/", methods=['GET'])
+@DECORATORS.is_logged_in
+def task_status(task_id: str):
+    user_email = session['user']['preferred_username']
+    task = DBQUEUE.get_task(task_id, user_email)
+    if task is None:
+        flash("Task not found", 'danger')
+        return redirect(url_for('crm_routes.list_clients'))
+    return render_template('task_status.html', task=_task_status(task))
+
+
+@admin_routes.route("/tasks/<string:task_id>/status", methods=['GET'])
+@DECORATORS.is_logged_in
+def task_status_json(task_id: str):
+    user_email = session['user']['preferred_username']
+    task = DBQUEUE.get_task(task_id, user_email)
+    if task is None:
+        return jsonify({'success': False, 'message': "Task not found"}), 404
+    return jsonify({'success': True, **_task_status(task)})
+
+
+@admin_routes.route("/tasks/<string:task_id>/download", methods=['GET'])
+@DECORATORS.is_logged_in
+def task_download(task_id: str):
+    user_email = session['user']['preferred_username']
+    task = DBQUEUE.get_task(task_id, user_email)
+    result = (task or {}).get('result') or {}
+    if not result.get('path') or not os.path.isfile(result['path']):
+        flash("That export is not available. It may have expired; please export again.", 'warning')
+        return redirect(url_for('admin_routes.task_status', task_id=task_id) if task else url_for('crm_routes.list_clients'))
+    return send_file(result['path'], mimetype=result['mimetype'], as_attachment=True, attachment_filename=result['filename'])
+
+
+def _task_status(task: dict) -> dict:
+    """
+    The parts of a task document the user may see.
+    """
+    status = {
+        'task_id': str(task['_id']),
+        'task_type': task['task_type'],
+        'list_name': task.get('list_name'),
+        'format': task.get('format'),
+        'status': task['status'],
+        'progress': task.get('progress', {}),
+        'message': task.get('message'),
+        'download_url': None,
+    }
+    if task['status'] == DONE and task.get('result', {}).get('path'):
+        status['download_url'] = url_for('admin_routes.task_download', task_id=status['task_id'])
+    return status
+
+
 @admin_routes.route("/clients/csv/deadline_checklist", methods=['GET'])
 @DECORATORS.is_logged_in
 @DECORATORS.is_admin_user
 @DECORATORS.auth_download_clients
 def download_clients_csv_deadline_checklist():
     user_email = session['user']['preferred_username']
-    drop_cols = [
-        '_id',
-        'active_flag',
-        'address',
-        'address1',
-        'admin_users',
-        'attorney_initials',
-        'check_digit',
-        'client_dl',
-        'client_name',
-        'client_ssn',
-        'city',
-        'client_dob',
-        'completion_date',
-        'crm_state',
-        'email',
-        'filed_date',
-        'final_bill_flag',
-        'marriage_date',
-        'mediation_date',
-        'mediation_retainer',
-        'mediation_retainer_flag',
-        'name',
-        'notes',
-        'payment_due',
-        'payment_link',
-        'postal_code',
-        'reference',
-        'refresh_trigger',
-        'retained_date',
-        'salutation',
-        'separation_date',
-        'state',
-        'street',
-        'suffix',
-        'target_retainer',
-        'telephone',
-        'title',
-        'trial_date',
-        'trial_retainer',
-        'trial_retainer_flag',
-        'trust_balance',
-        'trust_balance_update',
-        'unbilled_costs',
-        'unbilled_fees',
-        'billing_address',
-        'cell_phone',
-        'children',
-        'client_dl_state',
-        'client_vehicle',
-        'country',
-        'dental_ins',
-        'email_statements_flag',
-        'employment',
-        'health_ins',
-        'home_phone',
-        'in_county_90_days_flag',
-        'in_state_6_months_flag',
-        'maiden_name',
-        'marriage_place',
-        'op',
-        'place_of_birth',
-        'referrer',
-        'restore_maiden_name_flag',
-        'alt_telephone',
-        'alt_telephone_desc',
-        'csrf_token',
-        'email_cc_list',
-        'evergreen_sent_date',
-        'm365_plan_id',
-        'dob',
-        'home_state',
-        'sex',
-        'ssn'
-    ]
     clients = DBCLIENTS.get_list_as_csv(
         user_email,
-        drop_cols=drop_cols,
+        profile=DEADLINE_CHECKLIST,
         crm_state='070:retained_active'
     )
     return Response(
-        clients,
+        stream_with_context(clients),
         mimetype='text/csv',
         headers={
             'Content-Disposition': 'attachment; filename=client_checklist.csv'
@@ -4,28 +4,31 @@ crm_routes.py - Direct a client to the payment page
 Copyright (c) 2020 by Thomas J. Daley. All Rights Reserved.
 """
 import datetime as dt
-from flask import Blueprint, flash, redirect, render_template, request, session, url_for, json, jsonify, send_file, Response
+from flask import Blueprint, flash, redirect, render_template, request, session, url_for, json, jsonify, send_file, Response, stream_with_context
 import io
 import json  # noqa
-from mailmerge import MailMerge
 # from requests.sessions import Session
 import msftconfig
 import random
 import requests
 import os
+import time
 # from csutils import combined_payment_schedule, payments_made, compliance_report, violations, enforcement_report
 
 # pylint: disable=no-name-in-module
 # pylint: disable=import-error
 from util.db_admins import DbAdmins
 from util.database import multidict2dict
-from util.db_clients import DbClients, intake_to_client
-from util.db_client_discovery import DbClientDiscovery
+from util.db_clients import DbClients, intake_to_client, make_email_subject
+from util.client_enrichment import enrich_clients, client_email_cc_list as _client_email_cc_list
 from util.db_clients_contacts import DbClientsContacts
 from util.db_client_notes import DbClientNotes
+from util.contact_typeahead import TYPEAHEAD
 from util.db_contacts import DbContacts
-from util.flatten_dict import flatten_dict
+from util.merge_engine import DOCX_MIMETYPE, get_flattener, merge_document
 from util.db_intake import DbIntakes
+from util.db_queue import DbQueue
+from util.export_engine import EXPORT_FORMATS
 import views.decorators as DECORATORS
 from util.court_directory import CourtDirectory
 from util.dialer import Dialer
@@ -43,9 +46,9 @@ DBADMINS = DbAdmins()
 DBCONTACTS = DbContacts()
 DBCLIENTS = DbClients()
 DBCLIENT_CONTACTS = DbClientsContacts()
-DBDISCOVERY = DbClientDiscovery()
 DBNOTES = DbClientNotes()
 DBINTAKES = DbIntakes()
+DBQUEUE = DbQueue()
 MSFT = MicrosoftGraph()
 PLAN_TEMPLATES = PlanTemplates()
 USERS = None
@@ -86,7 +89,14 @@ def list_contacts(page_num: int = 1):
     user_email = session['user']['preferred_username']
     user = DBADMINS.admin_record(user_email)
     user_ccs = user.get('default_cc_list', '').replace(',', ';').split(';')
-    contacts = DBCONTACTS.get_list(user_email, page_num=page_num)
+    cursors = {}
+    if page_num > 1:
+        # Numbered pages are still served for links saved before cursor paging.
+        contacts = DBCONTACTS.get_list(user_email, page_num=page_num)
+    else:
+        page = DBCONTACTS.get_page(user_email, after=request.args.get('after'), before=request.args.get('before'))
+        contacts = page['items']
+        cursors = {'prev_cursor': page['prev'], 'next_cursor': page['next']}
     for contact in contacts:
         contact_ccs = contact.get('cc_list', '').replace(',', ';').split(';')
         contact['cc_list'] = ';'.join(user_ccs + contact_ccs)
@@ -99,7 +109,8 @@ def list_contacts(page_num: int = 1):
         prev_page_num=page_num - 1,
         next_page_num=page_num + 1,
         client_name=None,
-        email_subject=''
+        email_subject='',
+        **cursors
     )
 
 
@@ -197,12 +208,9 @@ def list_clients():
     user = DBADMINS.admin_record(user_email)
     clients = DBCLIENTS.get_list(user_email)
     authorizations = _get_authorizations(user_email)
+    enrich_clients(clients, user_email, user.get('default_cc_list'))
     for client in clients:
         client['_class'] = _client_row_class(client)
-        client['_email_subject'] = DBCLIENTS.get_email_subject(client['_id'])
-        client['_notes_flag'] = DBNOTES.has_any(client['_id'])
-        client['_discovery_flag'] = DBDISCOVERY.has_any(client['_id'])
-        client['_email_cc_list'] = _client_email_cc_list(client.get('email_cc_list'), user.get('default_cc_list'), user_email)
     return render_template(
         'crm/clients.html',
         clients=clients,
@@ -219,21 +227,24 @@ def search_clients(page_num: int = 1):
     query = request.form.get('query', None)
     authorizations = _get_authorizations(user_email)
     if query:
-        clients = DBCLIENTS.search(user_email, query=query, page_num=page_num, crm_state='*', include_inactive=True)
+        result = DBCLIENTS.search(user_email, query=query, page_num=page_num, crm_state='*', include_inactive=True)
+        clients = result['clients']
+        last_page_num = max((result['total'] + result['page_size'] - 1) // result['page_size'], 1)
     else:
         clients = DBCLIENTS.get_list(user_email)
+        page_num, last_page_num = 1, 1
+    enrich_clients(clients, user_email, user.get('default_cc_list'))
     for client in clients:
         client['_class'] = _client_row_class(client)
-        client['_email_subject'] = DBCLIENTS.get_email_subject(client['_id'])
-        client['_notes_flag'] = DBNOTES.has_any(client['_id'])
-        client['_discovery_flag'] = DBDISCOVERY.has_any(client['_id'])
-        client['_email_cc_list'] = _client_email_cc_list(client.get('email_cc_list'), user.get('default_cc_list'), user_email)
 
     return render_template(
         'crm/clients.html',
         clients=clients,
         authorizations=authorizations,
-        show_crm_state=True
+        show_crm_state=True,
+        query=query,
+        page_num=page_num,
+        last_page_num=last_page_num
     )
 
 
@@ -260,6 +271,7 @@ def add_client():
     return render_template(
         "crm/client.html",
         client=client,
+        court_directory_url=_court_directory_url(),
         form=form,
         new_child=child_form,
         new_event=CaseEventForm(),
@@ -304,6 +316,7 @@ def save_client():
     return render_template(
         'crm/client.html',
         client=client,
+        court_directory_url=_court_directory_url(),
         form=form,
         new_child=child_form,
         new_event=CaseEventForm(),
@@ -333,13 +346,14 @@ def show_client(id):
     authorizations = _get_authorizations(user_email)
     our_pay_url = os.environ.get('OUR_PAY_URL', None)
     client_email_cc_list = _client_email_cc_list(client.get('email_cc_list'), user.get('default_cc_list'), user_email)
-    client['_email_subject'] = DBCLIENTS.get_email_subject(id)
+    client['_email_subject'] = make_email_subject(client)
     client['_email_cc_list'] = client_email_cc_list
     contacts = _client_contacts(user_email, id)
 
     return render_template(
         'crm/client.html',
         client=client,
+        court_directory_url=_court_directory_url(),
         form=form,
         new_child=child_form,
         new_event=event_form,
@@ -373,11 +387,17 @@ def search_notes(page_num: int = 1):
     user_email = session['user']['preferred_username']
     query = request.form.get('query', None)
     clients_id = request.form.get('client-id', None)
+    tag = request.form.get('tag', None)
     client_name = DBCLIENTS.get_client_name(clients_id)
     if query:
-        notes = DBNOTES.search(user_email, clients_id, query, page_num)
+        result = DBNOTES.search(user_email, clients_id, query, page_num, tag=tag)
+        notes = result['notes']
+        tag_facets = sorted(result['tags'].items(), key=lambda t: (-t[1], t[0]))
+        last_page_num = max((result['total'] + result['page_size'] - 1) // result['page_size'], 1)
     else:
         notes = DBNOTES.get_list(user_email, clients_id, page_num=page_num)
+        tag_facets = []
+        last_page_num = None
     authorizations = _get_authorizations(user_email)
     return render_template(
         'crm/notes.html',
@@ -386,7 +406,12 @@ def search_notes(page_num: int = 1):
         client_name=client_name,
         prev_page_num=page_num - 1,
         next_page_num=page_num + 1,
-        authorizations=authorizations
+        authorizations=authorizations,
+        query=query,
+        tag=tag,
+        tag_facets=tag_facets,
+        page_num=page_num,
+        last_page_num=last_page_num
     )
 
 
@@ -396,7 +421,14 @@ def search_notes(page_num: int = 1):
 @DECORATORS.auth_crm_user
 def show_notes(clients_id, page_num: int = 1):
     user_email = session['user']['preferred_username']
-    notes = DBNOTES.get_list(user_email, clients_id, page_num=page_num)
+    cursors = {}
+    if page_num > 1:
+        # Numbered pages are still served for links saved before cursor paging.
+        notes = DBNOTES.get_list(user_email, clients_id, page_num=page_num)
+    else:
+        page = DBNOTES.get_page(user_email, clients_id, after=request.args.get('after'), before=request.args.get('before'))
+        notes = page['items']
+        cursors = {'prev_cursor': page['prev'], 'next_cursor': page['next']}
     client_name = DBCLIENTS.get_client_name(clients_id)
     authorizations = _get_authorizations(user_email)
     return render_template(
@@ -406,7 +438,8 @@ def show_notes(clients_id, page_num: int = 1):
         client_name=client_name,
         prev_page_num=page_num - 1,
         next_page_num=page_num + 1,
-        authorizations=authorizations
+        authorizations=authorizations,
+        **cursors
     )
 
 
@@ -519,7 +552,7 @@ def download_contacts(client_id: str = ''):
     user_email = session['user']['preferred_username']  # noqa
     contacts = DBCONTACTS.get_list_as_csv(user_email, client_id=client_id)
     return Response(
-        contacts,
+        stream_with_context(contacts),
         mimetype='text/csv',
         headers={
             'Content-Disposition': 'attachment; filename=contacts.csv'
@@ -527,27 +560,40 @@ def download_contacts(client_id: str = ''):
     )
 
 
+@crm_routes.route('/crm/util/contacts/export/<string:fmt>/', methods=['GET'])
+@crm_routes.route('/crm/util/contacts/export/<string:fmt>/<string:client_id>/', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_download_contacts
+def download_contacts_export(fmt: str, client_id: str = ''):
+    user_email = session['user']['preferred_username']  # noqa
+    export_format = EXPORT_FORMATS.get(fmt)
+    if export_format is None:
+        flash(f"Unsupported export format: {fmt}", 'danger')
+        return redirect(url_for('crm_routes.list_contacts'))
+    result = DBQUEUE.queue_export(user_email, 'contacts', fmt, {'client_id': client_id or None})
+    if not result['success']:
+        flash(result['message'], 'danger')
+        return redirect(url_for('crm_routes.list_contacts'))
+    return redirect(url_for('admin_routes.task_status', task_id=result['task_id']))
+
+
 @crm_routes.route('/crm/util/client_letter/<string:client_id>/', methods=['GET'])
 @DECORATORS.is_logged_in
 def client_letter(client_id: str):
     user_email = session['user']['preferred_username']  # noqa
     client = DBCLIENTS.get_one(client_id)
-    flat_client = flatten_dict(client)
     template_file_name = template_name('letterhead', user_email)
-    merged_file_name = os.path.join(os.environ.get('DOCX_PATH'), f'tmp-{user_email}-letterhead.docx')
     today = _get_filename_date()
-    attachment_name = f"{flat_client['name_last_name']} - {today} - Letter to {flat_client['name_full_name']}.docx"
 
     try:
-        with MailMerge(template_file_name) as document:
-            document.merge(**flat_client)
-            document.write(merged_file_name)
-        return send_file(merged_file_name, as_attachment=True, cache_timeout=30, attachment_filename=attachment_name)
+        flat_client = get_flattener(template_file_name)(client)
+        attachment_name = f"{flat_client['name_last_name']} - {today} - Letter to {flat_client['name_full_name']}.docx"
+        merged = merge_document(template_file_name, flat_client)
+        return send_file(merged, mimetype=DOCX_MIMETYPE, as_attachment=True, cache_timeout=30, attachment_filename=attachment_name)
     except Exception as e:
         LOGGER.error("Error merging client letter: %s", str(e))
         LOGGER.error("\tUser Email: %s", user_email)
         LOGGER.error("\tTemplate  : %s", template_file_name)
-        LOGGER.error("\tMerged    : %s", merged_file_name)
     flash("Error merging client letter - Check logs.", 'danger')
     return redirect(url_for('crm_routes.list_clients'))
 
@@ -570,26 +616,47 @@ def contact_letter(contact_id: str, client_id: str):
         client_name = ''
 
     # Flatten dictionary andn do the merge.
-    flat_contact = flatten_dict(contact)
-    today = _get_filename_date()
-    attachment_name = f"{client_name}{today} - Letter to {flat_contact['name_full_name']}.docx"
     template_file_name = template_name('contact-letterhead', user_email)
-    merged_file_name = os.path.join(os.environ.get('DOCX_PATH'), f'tmp-{user_email}-letterhead.docx')
+    today = _get_filename_date()
 
     try:
-        with MailMerge(template_file_name) as document:
-            document.merge(**flat_contact)
-            document.write(merged_file_name)
-        return send_file(merged_file_name, as_attachment=True, cache_timeout=30, attachment_filename=attachment_name)
+        flat_contact = get_flattener(template_file_name)(contact)
+        attachment_name = f"{client_name}{today} - Letter to {flat_contact['name_full_name']}.docx"
+        merged = merge_document(template_file_name, flat_contact)
+        return send_file(merged, mimetype=DOCX_MIMETYPE, as_attachment=True, cache_timeout=30, attachment_filename=attachment_name)
     except Exception as e:
         LOGGER.error("Error merging client letter: %s", str(e))
         LOGGER.error("\tUser Email: %s", user_email)
         LOGGER.error("\tTemplate  : %s", template_file_name)
-        LOGGER.error("\tMerged    : %s", merged_file_name)
     flash("Error merging contact letter - Check logs.", 'danger')
     return redirect(url_for('crm_routes.list_clients'))
 
 
+@crm_routes.route('/crm/util/bulk_letters/clients/', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_crm_user
+def bulk_client_letters():
+    user_email = session['user']['preferred_username']
+    crm_state = request.args.get('crm_state', '070:retained_active')
+    result = DBQUEUE.queue_letters(user_email, 'clients', {'crm_state': crm_state})
+    if not result['success']:
+        flash(result['message'], 'danger')
+        return redirect(url_for('crm_routes.list_clients'))
+    return redirect(url_for('admin_routes.task_status', task_id=result['task_id']))
+
+
+@crm_routes.route('/crm/util/bulk_letters/contacts/<string:client_id>/', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_crm_user
+def bulk_contact_letters(client_id: str):
+    user_email = session['user']['preferred_username']
+    result = DBQUEUE.queue_letters(user_email, 'contacts', {'client_id': client_id})
+    if not result['success']:
+        flash(result['message'], 'danger')
+        return redirect(url_for('crm_routes.list_clients'))
+    return redirect(url_for('admin_routes.task_status', task_id=result['task_id']))
+
+
 @crm_routes.route('/crm/data/client_ids/', methods=['GET'])
 @DECORATORS.is_logged_in
 @DECORATORS.auth_crm_user
@@ -617,18 +684,83 @@ def get_vcard(contact_id, type_name):
     return send_file(fp, as_attachment=True, attachment_filename=vcard_name)
 
 
+@crm_routes.route('/crm/data/contacts/typeahead/', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_crm_user
+def contacts_typeahead():
+    query = request.args.get('q', '')
+    try:
+        limit = max(1, min(int(request.args.get('limit', 10)), 50))
+    except ValueError:
+        limit = 10
+    started = time.perf_counter()
+    contacts = TYPEAHEAD.lookup(query, limit=limit)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    return jsonify({
+        'success': True,
+        'contacts': contacts,
+        'elapsed_ms': round(elapsed_ms, 2),
+        'memory': TYPEAHEAD.stats()
+    })
+
+
 @crm_routes.route('/crm/data/court_types/<string:county>/', methods=['GET'])
 @DECORATORS.is_logged_in
 @DECORATORS.auth_crm_user
 def get_court_types(county):
-    return jsonify(DIRECTORY.get_court_types(county))
+    return _court_directory_response(lambda: DIRECTORY.get_court_types(county))
 
 
 @crm_routes.route('/crm/data/court_names/<string:county>/<string:court_type>/', methods=['GET'])
 @DECORATORS.is_logged_in
 @DECORATORS.auth_crm_user
 def get_court_names(county, court_type):
-    return jsonify(DIRECTORY.get_courts(county, court_type))
+    return _court_directory_response(lambda: DIRECTORY.get_courts(county, court_type))
+
+
+@crm_routes.route('/crm/data/court_directory/<string:etag>.json', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_crm_user
+def get_court_directory(etag):
+    """
+    The whole county -> court type -> courts tree. Its URL names the hash of
+    its contents, so the browser may keep it as long as it likes. An old hash
+    is redirected to the current one.
+    """
+    bundle = DIRECTORY.bundle()
+    if etag != bundle['etag']:
+        return redirect(url_for('crm_routes.get_court_directory', etag=bundle['etag']))
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': 'private, max-age=31536000, immutable',
+        'Vary': 'Accept-Encoding'
+    }
+    if 'gzip' in request.accept_encodings:
+        headers['Content-Encoding'] = 'gzip'
+        return Response(bundle['gzip'], mimetype='application/json', headers=headers)
+    return Response(bundle['json'], mimetype='application/json', headers=headers)
+
+
+@crm_routes.route('/crm/data/court_personnel/search/', methods=['GET'])
+@DECORATORS.is_logged_in
+@DECORATORS.auth_crm_user
+def search_court_personnel():
+    query = request.args.get('q', '')
+    try:
+        limit = max(1, min(int(request.args.get('limit', 20)), 100))
+    except ValueError:
+        limit = 20
+    started = time.perf_counter()
+    people = DIRECTORY.search(query, limit=limit)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    return jsonify({
+        'success': True,
+        'people': people,
+        'elapsed_ms': round(elapsed_ms, 2)
+    })
 
 
 @crm_routes.route('/crm/data/save_note/<string:text>/<string:tags>/<string:client_id>/<string:note_id>/', methods=['GET'])
@@ -1179,6 +1311,27 @@ def _vcard(contact: dict, is_pro: bool) -> str:
     return _vcard21(contact, is_pro)
 
 
+def _court_directory_response(lookup):
+    """
+    Answer a court directory lookup, or 304 if the browser's copy came from
+    the same directory snapshot. *lookup* is only called when the answer is sent.
+    """
+    etag = DIRECTORY.bundle()['etag']
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+    response = jsonify(lookup())
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def _court_directory_url() -> str:
+    """
+    The URL of the current court directory bundle.
+    """
+    return url_for('crm_routes.get_court_directory', etag=DIRECTORY.bundle()['etag'])
+
+
 def _client_contacts(user_email: str, client_id: str) -> list:
     """
     Get a list of contacts linked to the given client account.
@@ -1196,7 +1349,7 @@ def _client_contacts(user_email: str, client_id: str) -> list:
         return []
 
     for contact in contacts:
-        contact_ccs = _client_contact_email_cc_list(client, contact['_contact'], user_email)
+        contact_ccs = _client_contact_email_cc_list(client, contact['_contact'], user_email, contact_link=contact)
         contact['cc_list'] = contact_ccs
 
     return contacts
@@ -1270,38 +1423,7 @@ def _search_client_plan_id(search_client_id):
     return None
 
 
-def _client_email_cc_list(client_cc_list: str, user_cc_list: str, user_email: str) -> str:
-    """
-    Create a fixed-up and filtered email cc list for emails to the client.
-    The client can have a cc-list
-    that is specific to that client. If so, use that. If not, use the default
-    cc-list for this user. Remove this user from the cc-list.
-
-    Args:
-        client_cc_list (str): Delimited list of email-ccs for this client
-        user_cc_list (str): Delimited list of email-ccs for this user
-        user_email (str): This user's email address
-
-    Returns:
-        (str): Delimited list of emails to cc on an email for this case.
-    """
-    my_email = user_email.replace(' ', '').lower()
-    if client_cc_list:
-        ccs = client_cc_list.replace(' ', '').replace(',', ';').lower()
-        ccs = ccs.split(';')
-        ccs = [email for email in ccs if email != my_email]
-        return ';'.join(ccs)
-
-    if user_cc_list:
-        ccs = user_cc_list.replace(' ', '').replace(',', ';').lower()
-        ccs = ccs.split(';')
-        ccs = [email for email in ccs if email != my_email]
-        return ';'.join(ccs)
-
-    return ''
-
-
-def _client_contact_email_cc_list(client: dict, contact: dict, user_email: str) -> str:
+def _client_contact_email_cc_list(client: dict, contact: dict, user_email: str, contact_link: dict = None) -> str:
     """
     Create an email CC list for emails directed to a contact that is linked
     to a client case.
@@ -1310,13 +1432,15 @@ def _client_contact_email_cc_list(client: dict, contact: dict, user_email: str)
         client (dict): The document from the clients collection.
         contact (dict): The document from the contacts collection.
         user_email (str): This user's email address
+        contact_link (dict): The clients_contacts document linking them, if the caller has it.
 
     Returns:
         (str): Delimted list of emails to cc on an email to this contact for this case.
     """
     my_email = user_email.replace(' ', '').lower()
 
-    contact_link = DBCLIENT_CONTACTS.get_link(my_email, client['_id'], contact['_id'])
+    if contact_link is None:
+        contact_link = DBCLIENT_CONTACTS.get_link(my_email, client['_id'], contact['_id'])
     if contact_link is None:
         # This is a data integrity error or an application error
         return ''
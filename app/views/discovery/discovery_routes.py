@@ -4,9 +4,8 @@ discovery_routes.py - Handle dicovery-related views.
 Copyright (c) 2021 by Thomas J. Daley. All Rights Reserved.
 """
 import datetime as dt
-from flask import Blueprint, flash, redirect, render_template, request, session, url_for, json, jsonify, send_file, Response
-from mailmerge import MailMerge
-import os
+from flask import Blueprint, flash, redirect, render_template, request, session, url_for, json, jsonify, send_file, Response, stream_with_context
+from urllib.parse import quote
 
 # pylint: disable=no-name-in-module
 # pylint: disable=import-error
@@ -16,6 +15,8 @@ from util.db_clients import DbClients, intake_to_client
 from util.db_client_discovery import DbClientDiscovery
 import views.decorators as DECORATORS
 from util.template_name import template_name
+from util.discovery_builder import get_section_template
+from util.merge_engine import DOCX_MIMETYPE
 from util.logger import get_logger
 from util.flatten_dict import flatten_dict
 # pylint: enable=no-name-in-module
@@ -74,7 +75,6 @@ def discovery_response(client_id: str, discovery_requests_id: str):
     user_email = session['user']['preferred_username']  # noqa
     client = DBCLIENTS.get_one(client_id)
     template_file_name = template_name('discovery_responses', user_email)
-    merged_file_name = os.path.join(os.environ.get('DOCX_PATH'), f'tmp-{user_email}-discovery_responses.docx')
     doc = DBDISCOVERY.get_one(discovery_requests_id)
     requests = doc.get('requests', [])
 
@@ -84,15 +84,20 @@ def discovery_response(client_id: str, discovery_requests_id: str):
     attachment_name = f"{cl_last_name} - {today} - {discovery_type} Responses.docx"
 
     try:
-        with MailMerge(template_file_name) as document:
-            document.merge_templates(requests, separator='continuous_section')
-            document.write(merged_file_name)
-        return send_file(merged_file_name, as_attachment=True, cache_timeout=30, attachment_filename=attachment_name)
+        # Compile the template before the response starts, so that a bad template is reported here.
+        sections = get_section_template(template_file_name, separator='continuous_section')
+        return Response(
+            stream_with_context(sections.stream(requests)),
+            mimetype=DOCX_MIMETYPE,
+            headers={
+                'Content-Disposition': f"attachment; filename*=UTF-8''{quote(attachment_name)}",
+                'Cache-Control': 'private, max-age=30'
+            }
+        )
     except Exception as e:
         LOGGER.error("Error merging discovery responses: %s", str(e))
         LOGGER.error("\tUser Email: %s", user_email)
         LOGGER.error("\tTemplate  : %s", template_file_name)
-        LOGGER.error("\tMerged    : %s", merged_file_name)
     flash("Error merging discovery responses - Check logs.", 'danger')
     return redirect(url_for('discovery_routes.discovery_requests', client_id=client_id, discovery_requests_id=discovery_requests_id))
 
@@ -26,6 +26,7 @@ from util.db_admins import DbAdmins
 from util.db_clients import DbClients
 from util.logger import get_logger
 from util.msftgraph import MicrosoftGraph
+import util.s3_transfer as S3_TRANSFER
 # pylint: enable=no-name-in-module
 # pylint: enable=import-error
 from falconlib.falconlib import FalconLib
@@ -200,13 +201,14 @@ class FalconManager():
 
         try:
             # Copy the file to the async processing bucket on S3
-            s3 = boto3.resource('s3', **self.boto3_credentials)  # pylint: disable=invalid-name
-            assert s3.meta is not None, "S3 resource is not available"
             ttl = int(os.environ.get('QUEUED_DOC_TTL_SECONDS', '86400'))
             try:
                 now = datetime.utcnow()
                 expires = now + timedelta(seconds=ttl)
-                s3.meta.client.upload_file(file_path, self.bucket, key_path, ExtraArgs={'Expires': expires})
+                S3_TRANSFER.upload(
+                    file_path, self.bucket, key_path,
+                    extra_args={'Expires': expires}, credentials=self.boto3_credentials
+                )
             except Exception as e:  # pylint: disable=broad-except,invalid-name
                 LOGGER.error("%s", str(e))
                 return None
@@ -0,0 +1,297 @@
+"""
+worker.py - Background worker for the task queue.
+
+Exports, bulk letters and evergreen letter runs are queued in the task_queue collection by
+the web server (see util.db_queue) and carried out here, in a separate
+process, so that no HTTP thread waits on them. The worker writes progress to
+the task document as it goes and leaves finished exports in EXPORT_DIR, from
+which the web server sends them to the user who asked for them.
+
+    python worker.py [--once]
+
+--once processes whatever is queued and exits instead of polling.
+
+@author Thomas J. Daley, J.D.
+@version 0.0.1
+Copyright (c) 2026 by Thomas J. Daley, J.D. All Rights Reserved.
+"""
+from datetime import datetime
+import os
+import platform
+import signal
+import sys
+import threading
+import time
+
+import dotenv
+dotenv.load_dotenv()
+
+from util.bulk_letters import write_letters_zip  # noqa: E402
+from util.db_clients import DbClients  # noqa: E402
+from util.db_clients_contacts import DbClientsContacts  # noqa: E402
+from util.db_contacts import DbContacts  # noqa: E402
+from util.db_queue import DbQueue  # noqa: E402
+from util.email_sender import send_evergreen  # noqa: E402
+from util.export_engine import EXPORT_FORMATS  # noqa: E402
+from util.logger import get_logger  # noqa: E402
+from util.merge_engine import get_flattener  # noqa: E402
+from util.template_name import template_name  # noqa: E402
+
+# Where finished exports are kept, and for how long.
+TMP_DIR = os.environ.get('TMP_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp')
+EXPORT_DIR = os.environ.get('EXPORT_DIR') or os.path.join(TMP_DIR, 'exports')
+EXPORT_RETENTION_HOURS = float(os.environ.get('EXPORT_RETENTION_HOURS', '24'))
+
+# Seconds between looks at an empty queue, and minutes a running task may go
+# without reporting progress before we assume its worker died.
+POLL_SECONDS = float(os.environ.get('WORKER_POLL_SECONDS', '2'))
+STALE_MINUTES = int(os.environ.get('WORKER_STALE_MINUTES', '30'))
+HOUSEKEEPING_SECONDS = 3600
+
+# Most contacts on one matter that a bulk letter run will write to.
+MAX_CONTACT_LETTERS = 1000
+
+# Client fields copied into each contact's letter, as contact_letter does.
+CLIENT_FIELDS = ['case_style', 'case_county', 'cause_number', 'court_name']
+
+DBCLIENTS = DbClients()
+DBCLIENTSCONTACTS = DbClientsContacts()
+DBCONTACTS = DbContacts()
+DBQUEUE = DbQueue()
+LOGGER = get_logger('worker')
+STOPPING = threading.Event()
+
+
+def run_export(task: dict) -> dict:
+    """
+    Write a client or contact list export to EXPORT_DIR.
+
+    The file is written under a temporary name and renamed when complete, so
+    a download never sees a partial file.
+
+    Returns:
+        (dict): The task result: path, filename, mimetype and size of the export
+    """
+    fmt = task['format']
+    export_format = EXPORT_FORMATS[fmt]
+    lists = {'clients': DBCLIENTS, 'contacts': DBCONTACTS}
+    if task['list_name'] not in lists:
+        raise ValueError(f"Unknown list: {task['list_name']}")
+
+    chunks = lists[task['list_name']].get_list_export(task['user_email'], fmt, progress=_progress(task), **task.get('params', {}))
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"{task['_id']}.{export_format['extension']}")
+    with open(path + '.part', 'wb') as output:
+        for chunk in chunks:
+            output.write(chunk.encode() if isinstance(chunk, str) else chunk)
+    os.replace(path + '.part', path)
+
+    return {
+        'path': path,
+        'filename': f"{task['list_name']}.{export_format['extension']}",
+        'mimetype': export_format['mimetype'],
+        'size': os.path.getsize(path),
+    }
+
+
+def run_letters(task: dict) -> dict:
+    """
+    Merge a letter for every client in a CRM state, or every contact on a
+    matter, and write them to a ZIP file in EXPORT_DIR.
+
+    Returns:
+        (dict): The task result: path, filename, mimetype and size of the ZIP file
+    """
+    user_email = task['user_email']
+    params = task.get('params', {})
+    template_type = {'clients': 'letterhead', 'contacts': 'contact-letterhead'}.get(task['list_name'])
+    if template_type is None:
+        raise ValueError(f"Unknown list: {task['list_name']}")
+    template_path = template_name(template_type, user_email)
+    if not template_path:
+        raise ValueError("No letterhead template found")
+
+    if task['list_name'] == 'clients':
+        recipients, total = _client_letters(user_email, params.get('crm_state'), get_flattener(template_path))
+    else:
+        recipients, total = _contact_letters(user_email, params['client_id'], get_flattener(template_path))
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"{task['_id']}.zip")
+    try:
+        write_letters_zip(template_path, recipients, total, path + '.part', progress=_progress(task))
+    except Exception:
+        if os.path.exists(path + '.part'):
+            os.remove(path + '.part')
+        raise
+    os.replace(path + '.part', path)
+
+    return {
+        'path': path,
+        'filename': f"{_filename_date()} - Letters to {task['list_name']}.zip",
+        'mimetype': 'application/zip',
+        'size': os.path.getsize(path),
+    }
+
+
+def _client_letters(user_email: str, crm_state: str, flatten) -> tuple:
+    """
+    The letters to write to each client in *crm_state*, named as client_letter names them.
+
+    Returns:
+        (tuple): A generator of (attachment name, merge fields), and the number of clients
+    """
+    clients = DBCLIENTS.get_list(user_email, crm_state=crm_state) or []
+    today = _filename_date()
+
+    def letters():
+        for client in clients:
+            flat_client = flatten(client)
+            yield f"{flat_client['name_last_name']} - {today} - Letter to {flat_client['name_full_name']}.docx", flat_client
+
+    return letters(), len(clients)
+
+
+def _contact_letters(user_email: str, client_id: str, flatten) -> tuple:
+    """
+    The letters to write to each contact on a client's matter, named as contact_letter names them.
+
+    Returns:
+        (tuple): A generator of (attachment name, merge fields), and the number of contacts
+    """
+    client = DBCLIENTS.get_one(client_id)
+    if not client:
+        raise ValueError(f"Client not found: {client_id}")
+    links = DBCLIENTSCONTACTS.get_list(user_email, client_id, page_size=MAX_CONTACT_LETTERS) or []
+    contacts = DBCONTACTS.get_many([link['contacts_id'] for link in links])
+    client_name = f"{client['name']['last_name']} - "
+    today = _filename_date()
+
+    def letters():
+        for link in links:
+            contact = contacts.get(link['contacts_id'])
+            if not contact:
+                continue
+            for cf in CLIENT_FIELDS:
+                contact[cf] = client.get(cf)
+            flat_contact = flatten(contact)
+            yield f"{client_name}{today} - Letter to {flat_contact['name_full_name']}.docx", flat_contact
+
+    return letters(), len(contacts)
+
+
+def run_evergreen(task: dict) -> dict:
+    """
+    Send the evergreen letters for the user who queued the task.
+    """
+    send_evergreen(task['user_email'], progress=_progress(task))
+    return {}
+
+
+HANDLERS = {
+    'export': run_export,
+    'letters': run_letters,
+    'evergreen': run_evergreen,
+}
+
+# Tasks that can safely be run again if their worker dies. The rest, such as
+# evergreen runs that email clients, are failed for a person to check and re-run.
+RETRYABLE = ['export', 'letters']
+
+
+def run_task(task: dict):
+    """
+    Run one claimed task and record how it ended.
+    """
+    started = time.perf_counter()
+    try:
+        result = HANDLERS[task['task_type']](task)
+    except Exception as e:
+        LOGGER.exception("Task %s (%s) failed", task['_id'], task['task_type'])
+        DBQUEUE.fail(task['_id'], task['worker'], str(e))
+        return
+    DBQUEUE.finish(task['_id'], task['worker'], result)
+    LOGGER.info("Task %s (%s) done in %.2fs", task['_id'], task['task_type'], time.perf_counter() - started)
+
+
+def _progress(task: dict):
+    """
+    A callback recording (rows done, total rows) as the task's progress.
+    """
+    def progress(rows: int, total: int):
+        percent = round(rows * 100 / total) if total else 100
+        DBQUEUE.update_progress(task['_id'], {'rows': rows, 'total': total, 'percent': percent})
+    return progress
+
+
+def _filename_date() -> str:
+    """
+    Today's date in YYYY.MM.DD format for use in file names.
+    """
+    return datetime.today().strftime('%Y.%m.%d')
+
+
+def remove_expired_exports() -> int:
+    """
+    Delete exports older than EXPORT_RETENTION_HOURS.
+
+    Returns:
+        (int): Number of files deleted
+    """
+    if not os.path.isdir(EXPORT_DIR):
+        return 0
+    cutoff = time.time() - EXPORT_RETENTION_HOURS * 3600
+    removed = 0
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except OSError as e:
+                LOGGER.warning("Unable to remove %s: %s", entry.path, e)
+    if removed:
+        LOGGER.info("Removed %s expired exports", removed)
+    return removed
+
+
+def main(once: bool = False):
+    """
+    Claim and run tasks until stopped, or until the queue is empty if *once* is True.
+    """
+    worker_id = f'{platform.node()}:{os.getpid()}'
+    LOGGER.info("Worker %s started for %s", worker_id, ', '.join(HANDLERS))
+    next_housekeeping = 0.0
+
+    while not STOPPING.is_set():
+        if time.monotonic() >= next_housekeeping:
+            DBQUEUE.requeue_stale(RETRYABLE, STALE_MINUTES)
+            DBQUEUE.fail_stale(
+                [task_type for task_type in HANDLERS if task_type not in RETRYABLE], STALE_MINUTES,
+                "The worker stopped responding partway through. Check what was sent before running it again."
+            )
+            remove_expired_exports()
+            next_housekeeping = time.monotonic() + HOUSEKEEPING_SECONDS
+
+        task = DBQUEUE.claim_next(list(HANDLERS), worker_id)
+        if task:
+            run_task(task)
+        elif once:
+            break
+        else:
+            STOPPING.wait(POLL_SECONDS)
+
+    LOGGER.info("Worker %s stopped", worker_id)
+
+
+def _stop(signum, frame):
+    """
+    Finish the current task, then stop.
+    """
+    STOPPING.set()
+
+
+if __name__ == '__main__':
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    main(once='--once' in sys.argv)